@@ -42,11 +42,14 @@ cmH2OReading = namedtuple("cmH2OReading", ["cmH2O"])
 class HoneywellSSC(object):
     """Read Honeywell SSC sensor readings over I2C"""
 
+    RAW_READ_LEN = 2
+
     def __init__(self, range=HONEYWELL_SSC_RANGES['015PG'], transferfunc=HONEYWELL_TRANSFER_FUNCS['A'], address=HONEYWELL_SSC_DEFAULT_I2C_ADDR_2, bus=RASPI_DEFAULT_I2C_BUS):
         self.range = range
         self.transferfunc = transferfunc
         self.scale_factor = (self.range.max - self.range.min) / (self.transferfunc.report_max - self.transferfunc.report_min)
         self.address = address
+        self.bus = None
         self._device = None
         if bus is not None:
             self.open(bus)
@@ -60,6 +63,7 @@ class HoneywellSSC(object):
         devicename = '/dev/i2c-{0}'.format(bus)
         try:
             self._device = open(devicename, 'r+b', buffering=0)
+            self.bus = bus
             self._select_device(self.address)
             print('Opened {} for device communications'.format(devicename))
         except IOError:
@@ -91,14 +95,17 @@ class HoneywellSSC(object):
         assert self._device is not None, 'Bus must be opened before operations are made against it!'
         return self._device.read(number)
 
-    def read_value(self):
-        bytes = self.read_bytes(2)
+    def decode_raw(self, bytes):
+        """Convert a RAW_READ_LEN byte measurement response to counts"""
         (report,) = struct.unpack(">H", bytes)
         if report & 0xc000:
             raise Exception("Honeywell sensor diagnostic condition reported. Sensor may have failed.")
         pressure_raw = report & 0x3fff
         return pressure_raw
 
+    def read_value(self):
+        return self.decode_raw(self.read_bytes(self.RAW_READ_LEN))
+
     def scale_value(self, reported):
         return ((self.scale_factor * (reported - self.transferfunc.report_min)) + self.range.min) * self.range.convFactor
 
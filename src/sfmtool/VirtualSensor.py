@@ -1,12 +1,31 @@
+import time, math, random
 
 
-import time, math
+class VirtualClock(object):
+    """A clock that only advances when slept on, for deterministic tests and benchmarks
+
+    Pass `clock` and `sleep` wherever a time source is injectable (clocked, FakeFlow, ...).
+    """
+
+    def __init__(self, t0=0.0):
+        self.t = t0
+
+    def clock(self):
+        return self.t
+
+    def sleep(self, dt):
+        self.t = self.t + max(0.0, dt)
+
 
 class FakeFlow(object):
-    def __init__(self, min=-30.0, max=30.0, freq=1./3.):
+    def __init__(self, min=-30.0, max=30.0, freq=1./3., phase=0.0, clock=time.time, noise=0.0, seed=None):
         self.min = min
         self.range = max - min
         self.freq = freq
+        self.phase = phase
+        self.clock = clock
+        self.noise = noise
+        self.rng = random.Random(seed)
 
     def __enter__(self):
         return self
@@ -18,16 +37,22 @@ class FakeFlow(object):
         pass
 
     def read_scaled(self):
-        v = (time.time() % 3.0) * (2 * math.pi) * self.freq
+        v = ((self.clock() + self.phase) % 3.0) * (2 * math.pi) * self.freq
         r = (math.sin(v) + 1.0) * 0.5 * self.range
+        if self.noise:
+            r = r + self.rng.gauss(0.0, self.noise)
         return  r + self.min
 
 
 class FakePressure(object):
-    def __init__(self, min=2, max=20, freq=1./3.):
+    def __init__(self, min=2, max=20, freq=1./3., phase=0.0, clock=time.time, noise=0.0, seed=None):
         self.min = min
         self.range = max - min
         self.freq = freq
+        self.phase = phase
+        self.clock = clock
+        self.noise = noise
+        self.rng = random.Random(seed)
 
     def __enter__(self):
         return self
@@ -39,6 +64,8 @@ class FakePressure(object):
         pass
 
     def read_scaled(self):
-        v = (time.time() % 3.0) * (2 * math.pi) * self.freq
+        v = ((self.clock() + self.phase) % 3.0) * (2 * math.pi) * self.freq
         r = (math.copysign(1, math.sin(v)) + 1.0) * 0.5 * self.range
+        if self.noise:
+            r = r + self.rng.gauss(0.0, self.noise)
         return  r + self.min
@@ -0,0 +1,353 @@
+import os, sys, time, json, struct, argparse, asyncio
+
+import numpy as np
+
+from calculations import CircularBuffer
+from netstream import *
+from alarms import RAISED, CLEARED
+
+
+"""Central aggregation of many splitvent units
+
+One asyncio process follows any number of netstream servers, reconnecting
+when a unit drops off, and merges their streams per patient (a channel of a
+unit). Recent waveforms are kept in a fixed-size ring per patient, so memory
+is bounded however long it runs, and every breath and alarm event is
+appended to a BreathStore on local disk. Ingest rates and end-to-end latency, from sample
+time on the unit to arrival here, are reported as it runs; latency assumes
+the units' clocks are synchronized with this one (NTP), as they are when the
+load generator runs on the same host.
+"""
+
+BREATH_STORE_DTYPE = np.dtype([
+    ("t", "<f8"),              # breath end, unit clock
+    ("received", "<f8"),       # arrival at the aggregator
+    ("patient", "<u4"),        # id in the store's patient index
+    ("VTi", "<f8"),
+    ("VTe", "<f8"),
+    ("RR", "<f8"),
+    ("MVe", "<f8"),
+    ("PPk", "<f8"),
+    ("PEEP", "<f8"),
+])
+
+BREATHS_FILE = "breaths.bin"
+PATIENTS_FILE = "patients.jsonl"
+ALARMS_FILE = "alarms.jsonl"
+
+
+class BreathStore(object):
+    """Append-only store of breath records in a directory
+
+    breaths.bin holds fixed-width little-endian BREATH_STORE_DTYPE records,
+    written in batches at flush(); patients.jsonl maps the patient ids used
+    in them to units and channels, one line per patient as first seen, and
+    alarms.jsonl holds alarm events. All are only ever appended to, so a store can be reopened and extended
+    across restarts, and read while it is being written.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.ids = dict((p["key"], p["id"]) for p in read_patients(directory))
+        self.index = open(os.path.join(directory, PATIENTS_FILE), "a")
+        self.f = open(os.path.join(directory, BREATHS_FILE), "ab")
+        self.alarms = open(os.path.join(directory, ALARMS_FILE), "a")
+        self.pending = []
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def patient_id(self, key, **info):
+        pid = self.ids.get(key)
+        if pid is None:
+            pid = len(self.ids)
+            self.ids[key] = pid
+            self.index.write(json.dumps(dict(info, id=pid, key=key)) + "\n")
+            self.index.flush()
+        return pid
+
+    def append(self, patient, t, received, tidal):
+        self.pending.append((t, received, patient) + tuple(tidal))
+
+    def append_alarm(self, patient, received, event):
+        self.alarms.write(json.dumps(dict(event, patient=patient, received=received)) + "\n")
+
+    def flush(self):
+        self.alarms.flush()
+        if self.pending:
+            self.f.write(np.array(self.pending, dtype=BREATH_STORE_DTYPE).tobytes())
+            self.written = self.written + len(self.pending)
+            self.pending = []
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.index.close()
+            self.alarms.close()
+            self.f = None
+
+
+def read_patients(directory):
+    """The patient index of a BreathStore directory, as a list of dicts with "id" and "key" """
+    try:
+        with open(os.path.join(directory, PATIENTS_FILE)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def read_breaths(directory, patient=None):
+    """Memory-map the breath records of a BreathStore directory, optionally of one patient"""
+    filename = os.path.join(directory, BREATHS_FILE)
+    # A crash can leave a partial trailing record; it is ignored
+    nrecords = os.path.getsize(filename) // BREATH_STORE_DTYPE.itemsize if os.path.exists(filename) else 0
+    if nrecords == 0:
+        return np.zeros(0, dtype=BREATH_STORE_DTYPE)
+    records = np.memmap(filename, dtype=BREATH_STORE_DTYPE, mode="r", shape=(nrecords,))
+    if patient is not None:
+        records = records[records["patient"] == patient]
+    return records
+
+
+class PatientRing(object):
+    """The most recent `window` seconds of one patient's waveform, its latest breath and its active alarms"""
+
+    def __init__(self, key, name, sample_rate, window):
+        self.key = key
+        self.name = name
+        self.sample_rate = sample_rate
+        self.samples = CircularBuffer(max(1, int(window * sample_rate)), dtype=WIRE_DTYPE)
+        self.tidal = None
+        self.t_tidal = None
+        self.alarms = {}
+        self.pid = None
+
+    def recent(self, seconds=None):
+        """The latest samples, oldest first, as a view"""
+        n = min(self.samples.count, self.samples.n)
+        if seconds is not None:
+            n = min(n, int(seconds * self.sample_rate))
+        return self.samples.last(n)
+
+
+class IngestStats(object):
+    """Counts and latencies of ingested frames since the last snapshot"""
+
+    def __init__(self, latencies=16384):
+        self.latencies = latencies
+        self.reset(time.time())
+
+    def reset(self, now):
+        self.t0 = now
+        self.frames = 0
+        self.samples = 0
+        self.breaths = 0
+        self.alarms = 0
+        self.bytes = 0
+        self.latency = CircularBuffer(self.latencies, dtype=np.float64)
+
+    def snapshot(self, now=None, reset=True):
+        now = time.time() if now is None else now
+        elapsed = max(now - self.t0, 1e-9)
+        latency = self.latency.last(min(self.latency.count, self.latency.n)) * 1000.0
+        stats = {"seconds": elapsed, "frames/s": self.frames / elapsed, "samples/s": self.samples / elapsed,
+                 "breaths/s": self.breaths / elapsed, "alarms": self.alarms, "MB/s": self.bytes / elapsed / 1e6}
+        if latency.size:
+            stats.update({"latency_ms_p50": float(np.percentile(latency, 50)),
+                          "latency_ms_p99": float(np.percentile(latency, 99)),
+                          "latency_ms_max": float(latency.max())})
+        if reset:
+            self.reset(now)
+        return stats
+
+
+class Aggregator(object):
+    """Follow many netstream servers, keeping bounded per-patient rings and persisting breaths"""
+
+    def __init__(self, store=None, window=60.0, default_rate=200.0, decimate=1):
+        self.store = store
+        self.window = window
+        self.default_rate = default_rate
+        self.decimate = decimate
+        self.patients = {}
+        self.connected = set()
+        self.stats = IngestStats()
+        self.total = IngestStats()
+
+    def register(self, node, hello):
+        """Create or reuse the rings of a unit's channels from its HELLO; returns {channel: PatientRing}"""
+        rings = {}
+        for channel in hello["channels"]:
+            key = "{}/{}".format(node, channel["channel"])
+            ring = self.patients.get(key)
+            if ring is None:
+                rate = (channel.get("sample_rate") or self.default_rate) / self.decimate
+                ring = PatientRing(key, channel.get("name"), rate, self.window)
+                if self.store is not None:
+                    ring.pid = self.store.patient_id(key, node=node, channel=channel["channel"], name=channel.get("name"))
+                self.patients[key] = ring
+            rings[channel["channel"]] = ring
+        return rings
+
+    def ingest(self, rings, ftype, body, nbytes, received):
+        for stats in (self.stats, self.total):
+            stats.frames = stats.frames + 1
+            stats.bytes = stats.bytes + nbytes
+        if ftype == FRAME_WAVEFORM:
+            channel, decimation, records = body
+            ring = rings.get(channel)
+            if ring is None or not records.size:
+                return
+            ring.samples.extend(records)
+            latency = received - float(records["t"][-1])
+            for stats in (self.stats, self.total):
+                stats.samples = stats.samples + records.size
+                stats.latency.append(latency)
+        elif ftype == FRAME_TIDAL:
+            channel, t, tidal = body
+            ring = rings.get(channel)
+            if ring is None:
+                return
+            ring.tidal = tidal
+            ring.t_tidal = t
+            for stats in (self.stats, self.total):
+                stats.breaths = stats.breaths + 1
+            if self.store is not None:
+                self.store.append(ring.pid, t, received, tidal)
+        elif ftype == FRAME_ALARM:
+            ring = rings.get(body["channel"])
+            if ring is None:
+                return
+            if body["state"] == RAISED:
+                ring.alarms[body["name"]] = body
+            elif body["state"] == CLEARED:
+                ring.alarms.pop(body["name"], None)
+            for stats in (self.stats, self.total):
+                stats.alarms = stats.alarms + 1
+            if self.store is not None:
+                self.store.append_alarm(ring.pid, received, body)
+
+    async def follow(self, address, retry=1.0, max_retry=30.0):
+        """Ingest one unit's stream until cancelled, reconnecting with backoff when it drops"""
+        host, port = address
+        node = "{}:{}".format(host, port)
+        delay = retry
+        while True:
+            client = StreamClient(host, port)
+            try:
+                hello = await client.connect(decimate=self.decimate)
+                rings = self.register(node, hello)
+                self.connected.add(node)
+                delay = retry
+                while True:
+                    length, ftype = FRAME_HEADER.unpack(await client.reader.readexactly(FRAME_HEADER.size))
+                    payload = await client.reader.readexactly(length - 1)
+                    self.ingest(rings, ftype, decode_payload(ftype, payload), length + 4, time.time())
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            except (struct.error, ValueError, KeyError, IndexError, TypeError) as ex:
+                # A malformed frame or HELLO ends this connection only; the unit is reconnected as for a drop
+                print("Warning: protocol error from {}: {!r}".format(node, ex))
+            finally:
+                self.connected.discard(node)
+                client.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_retry)
+
+    async def run(self, addresses, duration=None, report=5.0, out=print):
+        """Follow every address, reporting and flushing the store every `report` seconds"""
+        followers = [asyncio.ensure_future(self.follow(address)) for address in addresses]
+        t_end = None if duration is None else time.time() + duration
+        self.stats.reset(time.time())
+        self.total.reset(time.time())
+        try:
+            while t_end is None or time.time() < t_end:
+                await asyncio.sleep(report if t_end is None else max(0.0, min(report, t_end - time.time())))
+                if self.store is not None:
+                    self.store.flush()
+                if out is not None:
+                    out(self.format_stats(self.stats.snapshot()))
+        finally:
+            for f in followers:
+                f.cancel()
+            await asyncio.gather(*followers, return_exceptions=True)
+            if self.store is not None:
+                self.store.flush()
+        return self.total.snapshot(reset=False)
+
+    def format_stats(self, stats):
+        line = "{:>4}/{} units {:>4} patients  {:>8.0f} samples/s {:>6.0f} frames/s {:>5.1f} breaths/s {:>6.2f} MB/s {:>4} alarms {:>3} active".format(
+            len(self.connected), self.nodes_seen(), len(self.patients), stats["samples/s"], stats["frames/s"],
+            stats["breaths/s"], stats["MB/s"], stats["alarms"], sum(len(ring.alarms) for ring in self.patients.values()))
+        if "latency_ms_p50" in stats:
+            line += "  latency p50 {:.1f} p99 {:.1f} max {:.1f} ms".format(
+                stats["latency_ms_p50"], stats["latency_ms_p99"], stats["latency_ms_max"])
+        return line
+
+    def nodes_seen(self):
+        return len(set(key.rsplit("/", 1)[0] for key in self.patients))
+
+
+def parse_nodes(specs):
+    """Expand "host:port" and "host:first-last" specs into (host, port) pairs"""
+    addresses = []
+    for spec in specs:
+        host, _, ports = spec.rpartition(":")
+        if not host:
+            host, ports = ports, str(DEFAULT_PORT)
+        first, _, last = ports.partition("-")
+        addresses.extend((host, port) for port in range(int(first), int(last or first) + 1))
+    return addresses
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Aggregate the streams of many splitvent units in one place.')
+
+    parser.add_argument("--node", dest='nodes', action='append', default=[], metavar="HOST:PORT[-PORT]",
+                        help='A unit to follow, or a range of ports on one host; repeat for more')
+
+    parser.add_argument("--store", dest='store', default=None, metavar="DIR",
+                        help='Append every breath to the breath store in this directory')
+
+    parser.add_argument("--window", dest='window', type=float, default=60.0,
+                        help='Seconds of waveform kept in memory per patient')
+
+    parser.add_argument("--decimate", dest='decimate', type=int, default=1,
+                        help='Ask units for every Nth sample')
+
+    parser.add_argument("--report", dest='report', type=float, default=5.0,
+                        help='Seconds between throughput and latency reports')
+
+    parser.add_argument("--duration", dest='duration', type=float, default=None,
+                        help='Stop after this many seconds')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    addresses = parse_nodes(args.nodes)
+    if not addresses:
+        sys.exit("No units to follow; give --node HOST:PORT")
+    store = BreathStore(args.store) if args.store else None
+    aggregator = Aggregator(store, args.window, decimate=args.decimate)
+    try:
+        asyncio.run(aggregator.run(addresses, args.duration, args.report))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if store is not None:
+            store.close()
+            print("{} breaths in {}".format(store.written, args.store))
+
+
+if __name__ == "__main__":
+    main()
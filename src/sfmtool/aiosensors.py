@@ -0,0 +1,160 @@
+import time, asyncio, contextlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sfm3x00 import SFM3x00
+from calculations import FlowPressureReading, sensor_info
+from scheduler import wallclock
+from metrics import METRICS
+
+
+"""Asyncio sensor drivers: poll devices on different I2C buses concurrently
+
+combined_readings reads flow and then pressure, so the time per sample grows
+with every device added. Here each device is wrapped in an AsyncSensor with
+awaitable prepare(), read_raw() and read_scaled(). Blocking transactions run
+on one worker thread per /dev/i2c-N bus: devices on the same bus stay
+serialized in the order they were asked for, while separate buses are read
+in parallel (the kernel I/O releases the GIL). Sensors without a bus, such
+as the virtual and simulated ones, are read inline on the event loop.
+
+Every reading is a DeviceReading stamped with the middle of its own
+transaction, so a sample carries one timestamp per device.
+concurrent_combined_readings is the synchronous generator wrapper, a
+drop-in combiner for stream_readings.
+"""
+
+DeviceReading = namedtuple("DeviceReading", ["t", "value"])
+TimedFlowPressureReading = namedtuple("TimedFlowPressureReading", ["flow", "pressure"])
+
+
+class BusExecutors(object):
+    """One single-threaded executor per I2C bus, created on first use"""
+
+    def __init__(self):
+        self.executors = {}
+
+    def get(self, bus):
+        if bus not in self.executors:
+            self.executors[bus] = ThreadPoolExecutor(max_workers=1, thread_name_prefix="i2c-{}".format(bus))
+        return self.executors[bus]
+
+    def close(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
+        self.executors = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class AsyncSensor(object):
+    """Awaitable interface to an opened synchronous driver (SFM3x00, HoneywellSSC, MuxedSensor or a virtual sensor)
+
+    :param executors: BusExecutors shared by every device that may share a bus
+    :param clock: Timestamp source for readings
+    :param histogram: Name of a METRICS histogram for the read latency in milliseconds
+    """
+
+    def __init__(self, sensor, executors, clock=wallclock, histogram=None):
+        self.sensor = sensor
+        self.bus = getattr(sensor, "bus", None)
+        self.executor = executors.get(self.bus) if self.bus is not None else None
+        self.clock = clock
+        self.latency = METRICS.histogram(histogram) if histogram else None
+        if hasattr(sensor, "read_value"):
+            self._read = sensor.read_value
+            self.scale_value = sensor.scale_value
+        else:
+            # Virtual sensors have no raw counts; they report scaled values directly
+            self._read = sensor.read_scaled
+            self.scale_value = lambda value: value
+
+    async def _call(self, fn, *args):
+        if self.executor is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _timed_read(self):
+        t = self.clock()
+        t0 = time.perf_counter()
+        value = self._read()
+        elapsed = time.perf_counter() - t0
+        return DeviceReading(t + elapsed / 2, value), elapsed
+
+    async def prepare(self):
+        if isinstance(self.sensor, SFM3x00):
+            # Wait out the start-up delay on the event loop rather than holding the bus worker
+            await self._call(self.sensor.start_sensor)
+            await asyncio.sleep(self.sensor.START_DELAY)
+            await self._call(self.sensor.read_value)
+        else:
+            await self._call(self.sensor.prepare)
+
+    async def read_raw(self):
+        """A DeviceReading of raw counts, stamped with the middle of the transaction"""
+        reading, elapsed = await self._call(self._timed_read)
+        if self.latency is not None:
+            self.latency.observe(elapsed * 1000.0)
+        return reading
+
+    async def read_scaled(self):
+        reading = await self.read_raw()
+        return DeviceReading(reading.t, self.scale_value(reading.value))
+
+
+async def read_pairs(pairs):
+    """Read every (flow, pressure) AsyncSensor pair concurrently, returning one TimedFlowPressureReading per pair"""
+    readings = await asyncio.gather(*[sensor.read_scaled() for pair in pairs for sensor in pair])
+    return [TimedFlowPressureReading(readings[i], readings[i + 1]) for i in range(0, len(readings), 2)]
+
+
+async def async_combined_readings(flowClass, pressureClass, info=None, clock=wallclock):
+    """Async generator of TimedFlowPressureReadings; flow and pressure are read concurrently if on different buses"""
+    with flowClass() as s, pressureClass() as p, BusExecutors() as executors:
+        if info is not None:
+            info.update(sensor_info(s, p))
+        pair = (AsyncSensor(s, executors, clock, "read.flow_ms"), AsyncSensor(p, executors, clock, "read.pressure_ms"))
+        await asyncio.gather(*[sensor.prepare() for sensor in pair])
+        while True:
+            (reading,) = await read_pairs([pair])
+            yield reading
+
+
+async def async_multi_readings(channels, clock=wallclock):
+    """Async generator of lists with one TimedFlowPressureReading per ChannelSpec, all read concurrently"""
+    with contextlib.ExitStack() as stack:
+        executors = stack.enter_context(BusExecutors())
+        pairs = []
+        for c, ch in enumerate(channels):
+            s = stack.enter_context(ch.flow())
+            p = stack.enter_context(ch.pressure())
+            pairs.append((AsyncSensor(s, executors, clock, "read.ch{}.flow_ms".format(c)),
+                          AsyncSensor(p, executors, clock, "read.ch{}.pressure_ms".format(c))))
+        await asyncio.gather(*[sensor.prepare() for pair in pairs for sensor in pair])
+        while True:
+            yield await read_pairs(pairs)
+
+
+def iterate_async(agen):
+    """Drive an async generator from synchronous code on a private event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
+
+
+def concurrent_combined_readings(flowClass, pressureClass, info=None):
+    """Like combined_readings, but flow and pressure on different buses are read at the same time"""
+    for reading in iterate_async(async_combined_readings(flowClass, pressureClass, info)):
+        yield FlowPressureReading(reading.flow.value, reading.pressure.value)
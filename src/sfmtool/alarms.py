@@ -0,0 +1,385 @@
+import re, sys, time, argparse
+from collections import namedtuple, deque
+
+import numpy as np
+
+
+"""Alarm rules evaluated inline on the sample stream
+
+An AlarmEngine examines every sample once, at constant cost per sample and
+rule, so an alarm is raised on the sample that satisfies its rule rather than
+at the next window analysis. A rule is one or more conditions on a signal,
+all of which must hold, optionally for a sustained time:
+
+    disconnect: cmH2O < 1 hyst 1 and |slm| < 1 for 0.5 priority high
+    high_pressure: cmH2O > 40 hyst 5 latch priority high
+    apnea: breath_age > 20 priority high
+
+Signals are the sample fields slm, cmH2O and V; |x| for a magnitude; d(x)
+for a rate of change per second over the engine's rate window; and
+breath_age, the seconds since flow last rose through the inspiration onset
+threshold. A condition's hysteresis widens it once the alarm is raised, so
+it does not chatter. Every episode of a rule is reported, RAISED when it
+starts and CLEARED when it ends; a latched alarm additionally stays active
+for display after its condition clears, until acknowledged, so a listener
+that never acknowledges (the network server, the aggregator) still sees
+every repeat episode.
+
+Detection delay, from the first sample meeting a rule to the event, is at
+most the rule's hold time plus one sample; measure_latency() checks it on
+simulated patients, including the half filter length the integrated stream
+lags the sensors by.
+"""
+
+PRIORITY_LOW = "low"
+PRIORITY_MEDIUM = "medium"
+PRIORITY_HIGH = "high"
+PRIORITIES = (PRIORITY_LOW, PRIORITY_MEDIUM, PRIORITY_HIGH)
+
+RAISED = "raised"
+CLEARED = "cleared"
+ACKNOWLEDGED = "acknowledged"
+
+AlarmEvent = namedtuple("AlarmEvent", ["t", "name", "state", "priority", "value", "message"])
+
+DEFAULT_RULES = [
+    "disconnect: cmH2O < 1 hyst 1 and |slm| < 1 for 0.5 priority high",
+    "high_pressure: cmH2O > 40 hyst 5 latch priority high",
+    "apnea: breath_age > 20 priority high",
+]
+
+SIGNAL_RE = re.compile(r"^(?:\|(\w+)\||d\((\w+)\)|(\w+))$")
+SAMPLE_FIELDS = ("slm", "cmH2O", "V")
+
+
+class Condition(object):
+    """`signal op threshold`, where op is "<" or ">", widened by `hysteresis` while the alarm is raised"""
+
+    def __init__(self, signal, op, threshold, hysteresis=0.0):
+        if op not in ("<", ">"):
+            raise ValueError("Alarm condition operator must be '<' or '>'")
+        if SIGNAL_RE.match(signal) is None:
+            raise ValueError("Bad alarm signal '{}'".format(signal))
+        self.signal = signal
+        self.op = op
+        self.threshold = float(threshold)
+        self.hysteresis = float(hysteresis)
+
+    def holds(self, value, raised):
+        widen = self.hysteresis if raised else 0.0
+        if self.op == ">":
+            return value > self.threshold - widen
+        return value < self.threshold + widen
+
+    def __repr__(self):
+        return "{} {} {:g}".format(self.signal, self.op, self.threshold) + (
+            " hyst {:g}".format(self.hysteresis) if self.hysteresis else "")
+
+
+class AlarmRule(object):
+    """A named alarm: all `conditions` holding for `hold` seconds raises it; failing for `clear_hold` clears it"""
+
+    def __init__(self, name, conditions, hold=0.0, clear_hold=0.0, latch=False, priority=PRIORITY_MEDIUM, message=None):
+        if priority not in PRIORITIES:
+            raise ValueError("Alarm priority must be one of " + ", ".join(PRIORITIES))
+        self.name = name
+        self.conditions = list(conditions)
+        self.hold = float(hold)
+        self.clear_hold = float(clear_hold)
+        self.latch = latch
+        self.priority = priority
+        self.message = message or " and ".join(repr(c) for c in self.conditions)
+
+    def __repr__(self):
+        spec = "{}: {}".format(self.name, " and ".join(repr(c) for c in self.conditions))
+        if self.hold:
+            spec += " for {:g}".format(self.hold)
+        if self.clear_hold:
+            spec += " clear {:g}".format(self.clear_hold)
+        if self.latch:
+            spec += " latch"
+        return spec + " priority " + self.priority
+
+
+def parse_rule(spec):
+    """Parse "name: signal op value [hyst h] [and ...] [for s] [clear s] [latch] [priority p]" into an AlarmRule"""
+    name, sep, body = spec.partition(":")
+    if not sep or not name.strip():
+        raise ValueError("Alarm rule '{}' has no name".format(spec))
+    tokens = body.split()
+    conditions = []
+    options = {}
+    i = 0
+    while i < len(tokens):
+        word = tokens[i].lower()
+        if word == "and":
+            i = i + 1
+        elif word in ("for", "clear", "priority"):
+            if i + 1 >= len(tokens):
+                raise ValueError("Alarm rule '{}': '{}' needs a value".format(spec, word))
+            options[word] = tokens[i + 1]
+            i = i + 2
+        elif word == "latch":
+            options["latch"] = True
+            i = i + 1
+        elif word == "hyst":
+            if not conditions or i + 1 >= len(tokens):
+                raise ValueError("Alarm rule '{}': 'hyst' must follow a condition".format(spec))
+            conditions[-1].hysteresis = float(tokens[i + 1])
+            i = i + 2
+        else:
+            if i + 2 >= len(tokens):
+                raise ValueError("Alarm rule '{}': incomplete condition".format(spec))
+            conditions.append(Condition(tokens[i], tokens[i + 1], tokens[i + 2]))
+            i = i + 3
+    if not conditions:
+        raise ValueError("Alarm rule '{}' has no conditions".format(spec))
+    return AlarmRule(name.strip(), conditions, hold=float(options.get("for", 0.0)),
+                     clear_hold=float(options.get("clear", 0.0)), latch=options.get("latch", False),
+                     priority=options.get("priority", PRIORITY_MEDIUM).lower())
+
+
+def parse_rules(specs=None, defaults=DEFAULT_RULES):
+    """The default rules, replaced by name by any in `specs`; "name: off" removes one"""
+    rules = dict((rule.name, rule) for rule in (parse_rule(s) for s in defaults))
+    for spec in specs or []:
+        name, _, body = spec.partition(":")
+        if body.strip().lower() == "off":
+            rules.pop(name.strip(), None)
+        else:
+            rule = parse_rule(spec)
+            rules[rule.name] = rule
+    return list(rules.values())
+
+
+class _RuleState(object):
+    def __init__(self):
+        self.raised = False
+        self.latched = False
+        self.since = None         # first sample of the current run meeting (or failing) the rule
+        self.value = None
+
+
+class AlarmEngine(object):
+    """Evaluate alarm rules on each sample as it arrives
+
+    push() and process() return the AlarmEvents raised or cleared, and
+    acknowledge() those acknowledged, each timestamped with the sample that
+    caused it.
+    """
+
+    def __init__(self, rules=None, sample_rate=50.0, rate_window=0.1, onset_slm=5.0, onset_hysteresis=3.0):
+        self.rules = parse_rules() if rules is None else list(rules)
+        self.states = [_RuleState() for rule in self.rules]
+        self.onset_slm = onset_slm
+        self.onset_hysteresis = onset_hysteresis
+        self.inspiring = False
+        self.onset_t = None
+        self.t = None
+        self.lag = max(1, int(round(rate_window * sample_rate)))
+        self.rate_window = self.lag / float(sample_rate)
+        signals = set(c.signal for rule in self.rules for c in rule.conditions)
+        self.history = {}
+        self.derived = []
+        for signal in sorted(signals):
+            magnitude, rate, plain = SIGNAL_RE.match(signal).groups()
+            field = magnitude or rate or plain
+            if field not in SAMPLE_FIELDS and signal != "breath_age":
+                raise ValueError("Unknown alarm signal '{}'".format(signal))
+            if rate:
+                self.history[field] = deque(maxlen=self.lag + 1)
+            self.derived.append((signal, magnitude, rate))
+
+    def signals(self, t, slm, cmH2O, V):
+        sample = {"slm": slm, "cmH2O": cmH2O, "V": V}
+        # Inspiration onset: flow rising through the threshold, having fallen below it by the hysteresis
+        if self.onset_t is None:
+            self.onset_t = t
+        if self.inspiring:
+            self.inspiring = slm > self.onset_slm - self.onset_hysteresis
+        elif slm > self.onset_slm:
+            self.inspiring = True
+            self.onset_t = t
+        for field, history in self.history.items():
+            history.append(sample[field])
+        values = {}
+        for signal, magnitude, rate in self.derived:
+            if magnitude:
+                values[signal] = abs(sample[magnitude])
+            elif rate:
+                history = self.history[rate]
+                values[signal] = (history[-1] - history[0]) / self.rate_window if len(history) > self.lag else 0.0
+            elif signal == "breath_age":
+                values[signal] = t - self.onset_t
+            else:
+                values[signal] = sample[signal]
+        return values
+
+    def push(self, t, slm, cmH2O, V=0.0):
+        """Add one sample. Returns a list of AlarmEvents, usually empty"""
+        self.t = t
+        values = self.signals(t, slm, cmH2O, V)
+        events = []
+        for rule, state in zip(self.rules, self.states):
+            meets = True
+            for c in rule.conditions:
+                if not c.holds(values[c.signal], state.raised):
+                    meets = False
+                    break
+            value = values[rule.conditions[0].signal]
+            if meets == state.raised:
+                # No change in progress
+                state.since = None
+                if state.raised:
+                    state.value = value
+                continue
+            if state.since is None:
+                state.since = t
+            if t - state.since < (rule.clear_hold if state.raised else rule.hold):
+                continue
+            state.since = None
+            if meets:
+                # Raised for every episode; the latch only keeps the alarm on display
+                state.raised = True
+                state.value = value
+                state.latched = state.latched or rule.latch
+                events.append(AlarmEvent(t, rule.name, RAISED, rule.priority, value, rule.message))
+            else:
+                state.raised = False
+                events.append(AlarmEvent(t, rule.name, CLEARED, rule.priority, value, rule.message))
+        return events
+
+    def process(self, t, slm, cmH2O, V):
+        """Add arrays of samples. Returns the list of AlarmEvents they caused"""
+        events = []
+        for ti, si, pi, vi in zip(np.asarray(t).tolist(), np.asarray(slm).tolist(),
+                                  np.asarray(cmH2O).tolist(), np.asarray(V).tolist()):
+            events.extend(self.push(ti, si, pi, vi))
+        return events
+
+    def acknowledge(self, name=None):
+        """Acknowledge latched alarms (all, or the one named); those whose conditions have cleared leave the display"""
+        events = []
+        for rule, state in zip(self.rules, self.states):
+            if state.latched and (name is None or rule.name == name):
+                state.latched = False
+                events.append(AlarmEvent(self.t, rule.name, ACKNOWLEDGED, rule.priority, state.value, rule.message))
+        return events
+
+    def active(self):
+        """AlarmRules currently raised or latched, highest priority first"""
+        rules = [rule for rule, state in zip(self.rules, self.states) if state.raised or state.latched]
+        return sorted(rules, key=lambda rule: -PRIORITIES.index(rule.priority))
+
+
+def event_dict(event, channel=None):
+    """An AlarmEvent as a JSON-serializable dict, for logs and the network"""
+    d = event._asdict()
+    if channel is not None:
+        d["channel"] = channel
+    return d
+
+
+def format_event(event):
+    return "{} ALARM {:<13} {:<12} {:<6} {}".format(
+        time.strftime("%H:%M:%S", time.localtime(event.t)), event.name, event.state, event.priority, event.message)
+
+
+def measure_latency(rules, sr=50.0, seconds=600.0, seed=0, patients=8):
+    """Run simulated patients with disconnections and high pressures through integration and the alarm engine
+
+    Onsets are where a copy of each rule with no hold first holds on the
+    simulator's own output. Each episode lasting at least the rule's hold
+    plus the filter length must be raised by the engine on the integrated
+    stream (shorter ones may rightly be smoothed away or end within the
+    hold). The integrated stream lags the sensors by half the filter length,
+    which is added to every delay. An expected raise that never comes is
+    missed, and one after the bound is late.
+    Returns {rule name: (onsets, max delay, bound, missed, late)}.
+    """
+    from lungsim import LungSimulator, parse_settings
+    from calculations import BlockIntegrator, makefilter
+
+    lag = (makefilter(sr).size // 2) / sr
+    results = dict((rule.name, ([], 0, 0)) for rule in rules)
+    for p in range(patients):
+        settings = parse_settings("pc,peep=5,pinsp={},disconnects=30,disconnect_time=25".format(30 if p % 2 else 40))
+        t, slm, cmH2O = LungSimulator(settings, sr, seed + p).block(int(seconds * sr))
+        iv = BlockIntegrator(sr).process(np.arange(t.size), t, np.full(t.size, 1.0 / sr), slm[0], cmH2O[0])
+        engine = AlarmEngine(rules, sr)
+        raised = dict((rule.name, []) for rule in rules)
+        for e in engine.process(iv.t, iv.slm, iv.cmH2O, iv.V):
+            if e.state == RAISED:
+                raised[e.name].append(e.t)
+        for rule in rules:
+            bound = rule.hold + 1.0 / sr + lag
+            instant = AlarmEngine([AlarmRule(rule.name, rule.conditions, priority=rule.priority)], sr)
+            episodes = []
+            for e in instant.process(t, slm[0], cmH2O[0], np.zeros(t.size)):
+                if e.state == RAISED:
+                    episodes.append([e.t, t[-1]])
+                elif episodes:
+                    episodes[-1][1] = e.t
+            times = np.array(raised[rule.name])
+            delays, missed, late = results[rule.name]
+            # Onsets before the filter has filled never reach the integrated stream
+            for onset, end in episodes:
+                if onset < iv.t[0] or end - onset < rule.hold + 2 * lag:
+                    continue
+                k = np.searchsorted(times, onset - lag)
+                if k >= times.size or times[k] > end + lag:
+                    missed = missed + 1
+                    continue
+                delay = times[k] - onset + lag
+                delays.append(delay)
+                if delay > bound + 1e-9:
+                    late = late + 1
+            results[rule.name] = (delays, missed, late)
+    return dict((rule.name, (len(delays), max(delays) if delays else None, rule.hold + 1.0 / sr + lag, missed, late))
+                for rule, (delays, missed, late) in ((rule, results[rule.name]) for rule in rules))
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Measure alarm detection delay on simulated patients.')
+
+    parser.add_argument("--alarm", dest='alarms', action='append', default=None, metavar="RULE",
+                        help='Add or replace an alarm rule, e.g. "high_pressure: cmH2O > 35 latch"; "name: off" removes one')
+
+    parser.add_argument("--samplerate", dest='sample_rate', type=float, default=50.0,
+                        help='Sampling rate')
+
+    parser.add_argument("--duration", dest='duration', type=float, default=600.0,
+                        help='Simulated seconds per patient')
+
+    parser.add_argument("--patients", dest='patients', type=int, default=8,
+                        help='Number of simulated patients')
+
+    parser.add_argument("--seed", dest='seed', type=int, default=0,
+                        help='Random seed')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    rules = parse_rules(args.alarms)
+    for rule in rules:
+        print(rule)
+    results = measure_latency(rules, args.sample_rate, args.duration, args.seed, args.patients)
+    failed = False
+    for name, (count, worst, bound, missed, late) in results.items():
+        print("{:<14} {:>4} onsets  max delay {}  bound {:.3f} s  {} missed  {} late".format(
+            name, count, "{:.3f} s".format(worst) if worst is not None else "   -   ", bound, missed, late))
+        failed = failed or missed > 0 or late > 0
+    t0 = time.perf_counter()
+    engine = AlarmEngine(rules, args.sample_rate)
+    n = 100000
+    engine.process(np.arange(n) / args.sample_rate, np.sin(np.arange(n) * 0.1) * 30.0, np.full(n, 10.0), np.zeros(n))
+    print("{:.2f} us/sample for {} rules".format((time.perf_counter() - t0) / n * 1e6, len(rules)))
+    if failed:
+        print("FAILED: alarms missed or raised after their bound")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
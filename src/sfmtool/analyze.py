@@ -0,0 +1,185 @@
+import os, re, time, json, argparse, itertools
+
+import numpy as np
+
+from calculations import *
+from binlog import *
+
+
+"""Offline analysis of recorded sessions
+
+Runs a log through the same filtering, integration and breath detection as the
+live monitor, block by block and with no sleeping, and writes a per-breath
+table plus summary statistics.
+"""
+
+BREATH_DTYPE = np.dtype([
+    ("t", np.float64),
+    ("channel", np.int16),
+    ("VTi", np.float64),
+    ("VTe", np.float64),
+    ("RR", np.float64),
+    ("MVe", np.float64),
+    ("PPk", np.float64),
+    ("PEEP", np.float64),
+])
+
+SUMMARY_FIELDS = ["VTi", "VTe", "RR", "MVe", "PPk", "PEEP"]
+
+
+def log_blocks(filename, t_start=None, t_end=None, blocksize=65536):
+    """Yield (t, slm, cmH2O, channel) array blocks from a binary or JSON-lines log, streaming the file"""
+    if is_binary_log(filename):
+        for block in iter_blocks(BinaryLog(filename).between(t_start, t_end), blocksize):
+            yield block["t"], block["slm"], block["cmH2O"], block["channel"]
+        return
+    rows = read_jsonl(filename)
+    while True:
+        chunk = list(itertools.islice(rows, blocksize))
+        if not chunk:
+            return
+        t, slm, cmH2O = np.array(chunk, dtype=np.float64).T
+        keep = np.ones(t.size, dtype=bool)
+        if t_start is not None:
+            keep &= t >= t_start
+        if t_end is not None:
+            keep &= t < t_end
+            if t[0] >= t_end:
+                return
+        yield t[keep], slm[keep], cmH2O[keep], np.zeros(keep.sum(), dtype=np.uint8)
+
+
+def log_sample_rate(filename, default=None):
+    if is_binary_log(filename):
+        sr = BinaryLog(filename).sample_rate
+        if sr:
+            return sr
+    m = re.search(r"-(\d+)hz-", os.path.basename(filename))
+    return float(m.group(1)) if m else default
+
+
+class ChannelAnalysis(object):
+    """Integration and breath detection state for one channel of a recording"""
+
+    def __init__(self, channel, sr, taps=23, hysteresis=25.0):
+        self.channel = channel
+        self.sr = sr
+        self.integrator = BlockIntegrator(sr, taps)
+        self.detector = BreathDetector(hysteresis)
+        self.last_t = None
+        self.n = 0
+        self.breaths = []
+
+    def process(self, t, slm, cmH2O):
+        if t.size == 0:
+            return
+        dT = np.diff(t, prepend=(t[0] - 1.0 / self.sr) if self.last_t is None else self.last_t)
+        self.last_t = t[-1]
+        n = np.arange(self.n, self.n + t.size)
+        self.n = self.n + t.size
+        iv = self.integrator.process(n, t, dT, slm, cmH2O)
+        for bt, tidal in self.detector.process(iv.t, iv.V, iv.cmH2O):
+            self.breaths.append((bt, self.channel) + tuple(tidal))
+
+
+def analyze_file(filename, sr=None, taps=23, hysteresis=25.0, t_start=None, t_end=None, warmup=0.0, blocksize=65536):
+    """Analyze one log, or the [t_start, t_end) part of it
+
+    `warmup` seconds before t_start are processed to settle the filter and breath
+    state, but breaths completing in them are not reported. Samples are read for
+    one filter length past t_end, so breaths completing just before t_end are
+    still found despite the filter delay; consecutive ranges therefore report
+    every breath exactly once.
+    :return: (BREATH_DTYPE array of breaths, number of samples in [t_start, t_end))
+    """
+    sr = sr or log_sample_rate(filename)
+    if not sr:
+        raise ValueError("Sample rate of {} is unknown; pass --samplerate".format(filename))
+    read_from = None if t_start is None else t_start - warmup
+    read_to = None if t_end is None else t_end + float(taps) / sr
+    channels = {}
+    samples = 0
+    for t, slm, cmH2O, channel in log_blocks(filename, read_from, read_to, blocksize):
+        inside = np.ones(t.size, dtype=bool)
+        if t_start is not None:
+            inside &= t >= t_start
+        if t_end is not None:
+            inside &= t < t_end
+        samples = samples + int(inside.sum())
+        for c in np.unique(channel).tolist():
+            if c not in channels:
+                channels[c] = ChannelAnalysis(c, sr, taps, hysteresis)
+            sel = channel == c
+            channels[c].process(t[sel], slm[sel], cmH2O[sel])
+    breaths = np.array([b for c in sorted(channels) for b in channels[c].breaths], dtype=BREATH_DTYPE)
+    if t_start is not None:
+        breaths = breaths[breaths["t"] >= t_start]
+    if t_end is not None:
+        breaths = breaths[breaths["t"] < t_end]
+    return breaths, samples
+
+
+def summarize(breaths):
+    """Summary statistics of a breath table, per channel"""
+    summary = {}
+    for c in np.unique(breaths["channel"]).tolist():
+        b = breaths[breaths["channel"] == c]
+        stats = {"breaths": int(b.size), "first_t": float(b["t"][0]), "last_t": float(b["t"][-1])}
+        for field in SUMMARY_FIELDS:
+            v = b[field]
+            stats[field] = {
+                "mean": float(v.mean()), "std": float(v.std()), "min": float(v.min()),
+                "median": float(np.median(v)), "max": float(v.max()),
+            }
+        summary[str(c)] = stats
+    return summary
+
+
+def write_breaths(filename, breaths):
+    np.savetxt(filename, breaths, delimiter=",", header=",".join(BREATH_DTYPE.names), comments="",
+               fmt=["%.3f", "%d"] + ["%.2f"] * len(SUMMARY_FIELDS))
+
+
+def output_paths(filename, outdir=None):
+    base = os.path.splitext(os.path.basename(filename))[0]
+    outdir = outdir or os.path.dirname(filename) or "."
+    return os.path.join(outdir, base + ".breaths.csv"), os.path.join(outdir, base + ".summary.json")
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze a recorded splitvent session as fast as possible.')
+
+    parser.add_argument("log", help="Binary (.svlog) or JSON-lines (.log) session log")
+
+    parser.add_argument("--samplerate", dest='sample_rate', type=float, default=None,
+                        help='Sampling rate, if not recorded in the log or its filename')
+
+    parser.add_argument("--taps", dest='taps', type=int, default=23,
+                        help='Number of low-pass FIR filter taps')
+
+    parser.add_argument("--hysteresis", dest='hysteresis', type=float, default=25.0,
+                        help='Breath detection hysteresis in ml')
+
+    parser.add_argument("--outdir", dest='outdir', default=None,
+                        help='Directory for the breath table and summary (default: beside the log)')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    t0 = time.time()
+    breaths, samples = analyze_file(args.log, args.sample_rate, args.taps, args.hysteresis)
+    elapsed = time.time() - t0
+    breathfile, summaryfile = output_paths(args.log, args.outdir)
+    write_breaths(breathfile, breaths)
+    summary = {"log": args.log, "samples": samples, "seconds": elapsed, "channels": summarize(breaths)}
+    with open(summaryfile, "w") as f:
+        json.dump(summary, f, indent=2)
+    print("{}: {} samples, {} breaths in {:.2f} s ({:.0f} samples/s)".format(
+        args.log, samples, breaths.size, elapsed, samples / elapsed if elapsed else 0))
+    print("Wrote {} and {}".format(breathfile, summaryfile))
+
+
+if __name__ == "__main__":
+    main()
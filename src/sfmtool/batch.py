@@ -0,0 +1,130 @@
+import time, json, glob, argparse
+from collections import namedtuple
+import multiprocessing as mp
+
+import numpy as np
+
+from analyze import *
+
+
+"""Batch analysis of many session logs on all cores
+
+Each log is one task; long binary logs are split into time ranges that are
+analyzed in parallel, with a warm-up overlap so breaths at the edges are
+neither lost nor counted twice. Every log gets its own breath table and
+summary, and an aggregate report covers the whole batch.
+"""
+
+AnalysisTask = namedtuple("AnalysisTask", ["filename", "t_start", "t_end", "sr", "taps", "hysteresis", "warmup"])
+
+
+def plan_tasks(filenames, chunk_seconds, sr=None, taps=23, hysteresis=25.0, warmup=30.0):
+    """Split logs into tasks. Only binary logs can be entered part way through, so only they are chunked."""
+    tasks = []
+    for filename in filenames:
+        duration = BinaryLog(filename).duration if is_binary_log(filename) else 0.0
+        if chunk_seconds and duration > chunk_seconds:
+            for start in np.arange(0.0, duration, chunk_seconds).tolist():
+                t_start = None if start == 0.0 else start
+                t_end = start + chunk_seconds
+                t_end = None if t_end >= duration else t_end
+                tasks.append(AnalysisTask(filename, t_start, t_end, sr, taps, hysteresis, warmup))
+        else:
+            tasks.append(AnalysisTask(filename, None, None, sr, taps, hysteresis, warmup))
+    return tasks
+
+
+def run_task(task):
+    t0 = time.time()
+    breaths, samples = analyze_file(task.filename, task.sr, task.taps, task.hysteresis,
+                                    task.t_start, task.t_end, task.warmup)
+    return task, breaths, samples, time.time() - t0
+
+
+def analyze_batch(filenames, processes=None, chunk_seconds=3600.0, outdir=None, **kwargs):
+    """Analyze logs in a process pool, write per-log outputs, and return the aggregate report"""
+    tasks = plan_tasks(filenames, chunk_seconds, **kwargs)
+    results = {}
+    t0 = time.time()
+    with mp.Pool(processes) as pool:
+        for task, breaths, samples, seconds in pool.imap_unordered(run_task, tasks):
+            parts = results.setdefault(task.filename, [])
+            parts.append((task.t_start or 0.0, breaths, samples, seconds))
+            print("  {} [{}-{}]: {} breaths, {} samples in {:.2f} s".format(
+                task.filename, task.t_start or 0, task.t_end or "end", breaths.size, samples, seconds))
+    wall = time.time() - t0
+
+    report = {"files": {}, "tasks": len(tasks), "processes": processes or mp.cpu_count(), "seconds": wall}
+    everything = []
+    total_samples = 0
+    for filename in filenames:
+        parts = sorted(results[filename], key=lambda p: p[0])
+        breaths = np.concatenate([p[1] for p in parts])
+        breaths = breaths[np.lexsort((breaths["t"], breaths["channel"]))]
+        samples = sum(p[2] for p in parts)
+        total_samples = total_samples + samples
+        breathfile, summaryfile = output_paths(filename, outdir)
+        write_breaths(breathfile, breaths)
+        summary = {"log": filename, "samples": samples, "seconds": sum(p[3] for p in parts), "channels": summarize(breaths)}
+        with open(summaryfile, "w") as f:
+            json.dump(summary, f, indent=2)
+        report["files"][filename] = summary
+        everything.append(breaths)
+
+    allbreaths = np.concatenate(everything) if everything else np.zeros(0, dtype=BREATH_DTYPE)
+    allbreaths["channel"] = 0
+    report["samples"] = total_samples
+    report["samples_per_second"] = total_samples / wall if wall else 0.0
+    report["breaths"] = int(allbreaths.size)
+    report["overall"] = summarize(allbreaths).get("0", {})
+    return report
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze many recorded splitvent sessions in parallel.')
+
+    parser.add_argument("logs", nargs="+", help="Session logs or glob patterns, e.g. 'splitvent-50hz-*.log'")
+
+    parser.add_argument("--processes", dest='processes', type=int, default=None,
+                        help='Worker processes (default: one per core)')
+
+    parser.add_argument("--chunk", dest='chunk_seconds', type=float, default=3600.0,
+                        help='Split binary logs longer than this many seconds into parallel chunks (0 disables)')
+
+    parser.add_argument("--warmup", dest='warmup', type=float, default=30.0,
+                        help='Seconds of overlap before each chunk to settle filter and breath state')
+
+    parser.add_argument("--samplerate", dest='sample_rate', type=float, default=None,
+                        help='Sampling rate, if not recorded in the logs or their filenames')
+
+    parser.add_argument("--taps", dest='taps', type=int, default=23,
+                        help='Number of low-pass FIR filter taps')
+
+    parser.add_argument("--hysteresis", dest='hysteresis', type=float, default=25.0,
+                        help='Breath detection hysteresis in ml')
+
+    parser.add_argument("--outdir", dest='outdir', default=None,
+                        help='Directory for per-log outputs (default: beside each log)')
+
+    parser.add_argument("--report", dest='report', default="batch-report.json",
+                        help='Aggregate report filename')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    filenames = sorted(set(f for pattern in args.logs for f in (glob.glob(pattern) or [pattern])))
+    print("Analyzing {} logs".format(len(filenames)))
+    report = analyze_batch(filenames, args.processes, args.chunk_seconds, args.outdir,
+                           sr=args.sample_rate, taps=args.taps, hysteresis=args.hysteresis, warmup=args.warmup)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print("{} logs, {} samples, {} breaths in {:.2f} s: {:.0f} samples/s on {} processes".format(
+        len(filenames), report["samples"], report["breaths"], report["seconds"],
+        report["samples_per_second"], report["processes"]))
+    print("Wrote " + args.report)
+
+
+if __name__ == "__main__":
+    main()
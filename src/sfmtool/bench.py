@@ -0,0 +1,357 @@
+import os, sys, time, json, argparse, platform, functools, tracemalloc, subprocess
+
+import numpy as np
+
+from calculations import *
+from VirtualSensor import *
+from shmring import SharedRing, INTEGRATED_DTYPE, receive_ring
+
+
+"""Benchmarks for the acquisition-to-display pipeline
+
+Every stage is driven from a VirtualClock and seeded synthetic waveforms, so
+runs are repeatable and never sleep. Results are written as JSON and can be
+compared against a previous run to catch regressions.
+"""
+
+BENCH_SR = 50.0
+BENCH_SEED = 1234
+
+
+def synthetic_waveform(sr, seconds, rr=15.0, vt=500.0, ie=0.5, peep=5.0, ppk=25.0, noise=0.5, seed=BENCH_SEED):
+    """Seeded volume-control breathing: square inspiratory flow, exponential expiration"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(sr * seconds)) / sr
+    period = 60.0 / rr
+    ti = period * ie / (1.0 + ie)
+    phase = t % period
+    tau = 0.4
+    slm = np.where(phase < ti, vt / ti, -(vt / tau) * np.exp(-(phase - ti) / tau)) * 60.0 / 1000.0
+    cmH2O = np.where(phase < ti, ppk, peep)
+    return t, slm + rng.normal(0.0, noise, t.size), cmH2O + rng.normal(0.0, noise * 0.1, t.size)
+
+
+def integrated_waveform(sr, seconds, **kwargs):
+    t, slm, cmH2O = synthetic_waveform(sr, seconds, **kwargs)
+    return BlockIntegrator(sr).process(np.arange(t.size), t, np.full(t.size, 1.0 / sr), slm, cmH2O)
+
+
+def measure(name, step, calls, samples_per_call=1, alloc_calls=None):
+    """Time `calls` invocations of step(), then repeat a few under tracemalloc to count allocations"""
+    times = np.zeros(calls, dtype=np.int64)
+    for i in range(calls):
+        t0 = time.perf_counter_ns()
+        step()
+        times[i] = time.perf_counter_ns() - t0
+    per_sample = times / float(samples_per_call)
+    total = times.sum() / 1e9
+    result = {
+        "name": name,
+        "samples": calls * samples_per_call,
+        "seconds": total,
+        "samples_per_sec": calls * samples_per_call / total if total else None,
+        "latency_us": {
+            "p50": float(np.percentile(per_sample, 50)) / 1e3,
+            "p90": float(np.percentile(per_sample, 90)) / 1e3,
+            "p99": float(np.percentile(per_sample, 99)) / 1e3,
+            "max": float(per_sample.max()) / 1e3,
+        },
+    }
+    alloc_calls = alloc_calls or max(1, calls // 10)
+    blocks0 = sys.getallocatedblocks()
+    tracemalloc.start()
+    for i in range(alloc_calls):
+        step()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result["alloc"] = {
+        "net_blocks_per_sample": (sys.getallocatedblocks() - blocks0) / float(alloc_calls * samples_per_call),
+        "peak_bytes_per_sample": peak / float(alloc_calls * samples_per_call),
+    }
+    return result
+
+
+def bench_integrate_readings(seconds):
+    vc = VirtualClock()
+    flow = functools.partial(FakeFlow, clock=vc.clock, noise=0.5, seed=BENCH_SEED)
+    pressure = functools.partial(FakePressure, clock=vc.clock, noise=0.05, seed=BENCH_SEED)
+    readings = integrate_readings(clocked(combined_readings(flow, pressure), BENCH_SR, vc.clock, vc.sleep), BENCH_SR)
+    return measure("integrate_readings", functools.partial(next, readings), int(BENCH_SR * seconds))
+
+
+def bench_block_integrator(seconds, blocksize=500):
+    t, slm, cmH2O = synthetic_waveform(BENCH_SR, seconds)
+    dT = np.full(t.size, 1.0 / BENCH_SR)
+    integrator = BlockIntegrator(BENCH_SR)
+    blocks = [(np.arange(i, i + blocksize), t[i:i+blocksize], dT[i:i+blocksize], slm[i:i+blocksize], cmH2O[i:i+blocksize])
+              for i in range(0, t.size - blocksize + 1, blocksize)]
+    it = iter(blocks * 2)
+    return measure("BlockIntegrator", lambda: integrator.process(*next(it)), len(blocks), blocksize, alloc_calls=len(blocks) // 10 or 1)
+
+
+def bench_tidalcalcs(seconds):
+    iv = integrated_waveform(BENCH_SR, seconds)
+    records = np.zeros(iv.t.size, dtype=INTEGRATED_DTYPE)
+    for field in INTEGRATED_DTYPE.names:
+        records[field] = getattr(iv, field)
+
+    def run():
+        # The loop of tidalcalcs, without its process setup, which would reset METRICS here
+        out = []
+        with SharedRing(records.size * 2) as ring:
+            ring.write(records)
+            ring.finish()
+            breaths = RingBreaths()
+            for view in receive_ring(ring.cursor(from_start=True)):
+                out.extend(breaths.process(view))
+        return out
+
+    result = measure("tidalcalcs", run, 5, records.size, alloc_calls=1)
+    result["breaths"] = len(run())
+    return result
+
+
+def bench_breath_detector(seconds):
+    iv = integrated_waveform(BENCH_SR, seconds)
+    samples = list(zip(iv.t.tolist(), iv.V.tolist(), iv.cmH2O.tolist())) * 2
+    detector = BreathDetector()
+    it = iter(samples)
+    return measure("BreathDetector.push", lambda: detector.push(*next(it)), iv.t.size)
+
+
+def bench_alarm_engine(seconds):
+    from alarms import AlarmEngine
+    iv = integrated_waveform(BENCH_SR, seconds)
+    samples = list(zip(iv.t.tolist(), iv.slm.tolist(), iv.cmH2O.tolist(), iv.V.tolist())) * 2
+    engine = AlarmEngine(sample_rate=BENCH_SR)
+    it = iter(samples)
+    return measure("AlarmEngine.push", lambda: engine.push(*next(it)), iv.t.size)
+
+
+def bench_format_integrated(seconds):
+    import cli
+    iv = integrated_waveform(BENCH_SR, seconds)
+    readings = [IntegratedVolume(*r) for r in zip(*[f.tolist() for f in iv])]
+    lines = cli.format_integrated(iter(readings * 2), BENCH_SR, 12.0, skip=1)
+    return measure("format_integrated", functools.partial(next, lines), len(readings))
+
+
+def bench_graph_render(frames, display_duration=15.0, width=1280, height=720, dirty=False, sr=BENCH_SR, name=None):
+    """sr/50 new samples per frame, as when the display keeps up at 50 fps"""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    pygame.init()
+    try:
+        import gui
+        screen = pygame.display.set_mode((width, height))
+        iv = integrated_waveform(sr, display_duration)
+        wstep = int(width / 12.)
+        hstep = int(height / 12.)
+        graph = gui.GraphRenderer((-100, 1000), pygame.Rect(0, hstep*8.5, wstep*10, hstep*3), gui.cyan, int(height / 200.))
+        static = pygame.Surface((width, height))
+        graph.render_bg(static)
+        values = iv.V.astype(np.float32)
+        idx = [0]
+        step = max(1, int(sr / 50.0))
+
+        def frame():
+            if dirty:
+                pygame.display.update(graph.render_dirty(screen, static, idx[0], values))
+            else:
+                screen.blit(static, (0, 0))
+                graph.render(screen, idx[0], values)
+                pygame.display.update()
+            idx[0] = (idx[0] + step) % values.size
+
+        name = name or ("GraphRenderer.render_dirty" if dirty else "GraphRenderer.render")
+        result = measure(name, frame, frames)
+        result["points_per_frame"] = int(values.size)
+        result["frames_per_sec"] = result.pop("samples_per_sec")
+        return result
+    finally:
+        pygame.quit()
+
+
+def bench_text_readouts(frames, cached=True, width=1280, height=720):
+    """Six numeric readouts and two range labels per frame, as the GUI draws with --fullredraw"""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    pygame.init()
+    try:
+        import gui
+        screen = pygame.display.set_mode((width, height))
+        hstep = int(height / 12.)
+        panels = [gui.TextRectRenderer(pygame.Rect(0, 0, int(width / 6.), int(hstep * 2.5)), "RR", "b/min")
+                  for i in range(6)]
+        rangefont = pygame.font.SysFont(gui.FONT, int(hstep * 0.3))
+        iv = integrated_waveform(BENCH_SR, 60.0)
+        # Readouts hold a value for a breath at a time, as TidalData arrives
+        values = ["{:5.1f}".format(v) for v in iv.V[::int(BENCH_SR * 4)]]
+        i = [0]
+
+        def frame():
+            value = values[(i[0] // 200) % len(values)]
+            for panel in panels:
+                if cached:
+                    panel.render(screen, value)
+                else:
+                    surf = panel.largefont.render(value, gui.ANTIALIAS, panel.fontcolor, panel.bgcolor)
+                    screen.blit(surf, surf.get_rect(center=panel.AC2))
+            for text in (" -100.00", " 1000.00"):
+                if cached:
+                    screen.blit(gui.TEXT_CACHE.render(rangefont, text, gui.ANTIALIAS, gui.border, gui.black), (0, 0))
+                else:
+                    screen.blit(rangefont.render(text, gui.ANTIALIAS, gui.border, gui.black), (0, 0))
+            i[0] = i[0] + 1
+
+        result = measure("text readouts" + ("" if cached else " uncached"), frame, frames)
+        result["frames_per_sec"] = result.pop("samples_per_sec")
+        if cached:
+            result["text_cache"] = gui.TEXT_CACHE.stats()
+            result["glyphs"] = panels[0].digits.stats()
+        return result
+    finally:
+        pygame.quit()
+
+
+def breath_agreement(seconds, window=30.0):
+    """Compare each breath from BreathDetector with tidal_from_signals over the window ending at it
+
+    Runs the synthetic waveform at 10-30 b/min and the FakeFlow sine, and
+    returns per waveform the worst absolute RR difference in b/min and the
+    worst and mean relative VTi and VTe differences (positive where
+    BreathDetector reads higher).
+    """
+    waveforms = [("vc rr={:g}".format(rr), integrated_waveform(BENCH_SR, seconds, rr=rr))
+                 for rr in (10.0, 15.0, 20.0, 25.0, 30.0)]
+    t = np.arange(int(BENCH_SR * seconds)) / BENCH_SR
+    fake = FakeFlow(clock=lambda: now)
+    slm = np.zeros(t.size)
+    for i, now in enumerate(t.tolist()):
+        slm[i] = fake.read_scaled()
+    waveforms.append(("FakeFlow", BlockIntegrator(BENCH_SR).process(np.arange(t.size), t, np.full(t.size, 1.0 / BENCH_SR),
+                                                                    slm, np.full(t.size, 10.0))))
+    n = int(window * BENCH_SR)
+    results = []
+    for name, iv in waveforms:
+        veaccum = CircularBuffer(3, np.float64)
+        diffs = []
+        for bt, tidal in BreathDetector().process(iv.t, iv.V, iv.cmH2O):
+            k = int(np.searchsorted(iv.t, bt)) + 1
+            if k < n:
+                continue
+            ref = tidal_from_signals(iv.V[k-n:k], iv.cmH2O[k-n:k], veaccum, BENCH_SR)
+            if ref is not None:
+                diffs.append((tidal.RR - ref.RR, tidal.VTi / ref.VTi - 1.0, tidal.VTe / ref.VTe - 1.0))
+        diffs = np.array(diffs).reshape(-1, 3)
+        worst = np.abs(diffs).max(axis=0) if diffs.size else np.full(3, np.nan)
+        results.append({"name": name, "breaths": len(diffs), "rr_max": float(worst[0]),
+                        "vti_max": float(worst[1]), "vte_max": float(worst[2]),
+                        "vti_mean": float(diffs[:, 1].mean()) if diffs.size else None,
+                        "vte_mean": float(diffs[:, 2].mean()) if diffs.size else None})
+    return results
+
+
+BENCHMARKS = {
+    "integrate_readings": lambda args: bench_integrate_readings(args.seconds),
+    "block_integrator": lambda args: bench_block_integrator(args.seconds),
+    "breath_detector": lambda args: bench_breath_detector(args.seconds),
+    "alarm_engine": lambda args: bench_alarm_engine(args.seconds),
+    "tidalcalcs": lambda args: bench_tidalcalcs(args.seconds),
+    "format_integrated": lambda args: bench_format_integrated(args.seconds),
+    "graph_render": lambda args: bench_graph_render(args.frames),
+    "graph_render_dirty": lambda args: bench_graph_render(args.frames, dirty=True),
+    "text_readouts": lambda args: bench_text_readouts(args.frames),
+    "text_readouts_uncached": lambda args: bench_text_readouts(args.frames, cached=False),
+    "graph_render_long": lambda args: bench_graph_render(args.frames, 30.0, sr=500.0, name="GraphRenderer 500Hz x 30s"),
+    "graph_render_long_dirty": lambda args: bench_graph_render(args.frames, 30.0, sr=500.0, dirty=True,
+                                                               name="GraphRenderer 500Hz x 30s dirty"),
+}
+
+
+def environment():
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        rev = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": rev,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print throughput relative to a previous run; return names that regressed by more than threshold"""
+    regressions = []
+    old = dict((r["name"], r) for r in baseline["results"])
+    for r in results:
+        if r["name"] not in old:
+            continue
+        key = "frames_per_sec" if "frames_per_sec" in r else "samples_per_sec"
+        ratio = r[key] / old[r["name"]][key]
+        flag = ""
+        if ratio < 1.0 - threshold:
+            flag = "  REGRESSION"
+            regressions.append(r["name"])
+        print("  {:<32} {:>8.2f}x{}".format(r["name"], ratio, flag))
+    return regressions
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the splitvent acquisition-to-display pipeline.')
+
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS),
+                        help="Benchmarks to run: " + ", ".join(BENCHMARKS))
+
+    parser.add_argument("--seconds", dest='seconds', type=float, default=300.0,
+                        help='Seconds of synthetic 50 Hz data for the per-sample benchmarks')
+
+    parser.add_argument("--frames", dest='frames', type=int, default=300,
+                        help='Frames to render for the graph benchmark')
+
+    parser.add_argument("--output", dest='output', default="bench.json",
+                        help='Write results to this JSON file')
+
+    parser.add_argument("--compare", dest='compare', default=None,
+                        help='Previous results JSON to compare against')
+
+    parser.add_argument("--agreement", dest='agreement', action="store_true",
+                        help='Compare BreathDetector with the biopeaks window analysis instead of timing')
+
+    parser.add_argument("--threshold", dest='threshold', type=float, default=0.10,
+                        help='Fractional slowdown reported as a regression')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    if args.agreement:
+        for r in breath_agreement(args.seconds):
+            print("{:<12} {:>4} breaths  RR {:>5.2f} b/min  VTi {:>5.1%} (mean {:+.1%})  VTe {:>5.1%} (mean {:+.1%})".format(
+                r["name"], r["breaths"], r["rr_max"], r["vti_max"], r["vti_mean"], r["vte_max"], r["vte_mean"]))
+        return
+    results = []
+    for name in args.benchmarks:
+        r = BENCHMARKS[name](args)
+        results.append(r)
+        rate = r.get("samples_per_sec") or r.get("frames_per_sec")
+        print("{:<32} {:>12.0f}/s  p50 {:>8.1f} us  p99 {:>8.1f} us  {:>6.2f} blocks/sample".format(
+            r["name"], rate, r["latency_us"]["p50"], r["latency_us"]["p99"], r["alloc"]["net_blocks_per_sample"]))
+    report = {"environment": environment(), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Wrote " + args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
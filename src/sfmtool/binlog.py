@@ -0,0 +1,357 @@
+import sys, json, struct, re, gzip, itertools
+
+import numpy as np
+
+
+"""Compact binary session logs
+
+A log is a fixed-size header holding JSON metadata (sample rate, start time,
+sensor serial number and calibration), followed by chunks. Each chunk is a
+CHUNK struct (the time of its first sample, the sample period, the sample
+count and the channel) and then that many fixed-width SAMPLE_DTYPE records of
+raw sensor counts, 4 bytes per sample. Timestamps and scaled values are not
+stored: t is derived from the chunk's start and the sample index, slm and
+cmH2O from the calibration in the header. An 8 hour patient at 50 Hz takes
+about 6 MB.
+
+The samples of a chunk lie on a regular grid, so a reading more than
+GRID_TOLERANCE of a period off it (after a dropped or late sample) starts a
+new chunk. Timestamps are therefore kept to within that tolerance, not
+exactly. Readings from sensors without a calibration (simulated sensors,
+converted JSON-lines logs) are quantized with NOMINAL_FLOW and
+NOMINAL_PRESSURE, which resolve 0.01 slm and 0.01 cmH2O.
+
+The reader scans the chunk headers once and maps the file with np.memmap,
+so any time range of a multi-hour log is decoded without reading the rest
+of the file. Finished segments of a rotated log may be compressed
+(LOG_EXTENSION + ".gz" or ".zst"); those are read into memory instead.
+"""
+
+MAGIC = b"SPLITVNT"
+VERSION = 2
+HEADER_LEN = 4096
+PREAMBLE = struct.Struct("<8sII")
+CHUNK = struct.Struct("<ddIB3x")   # t0 (seconds since meta["t0"]), dt, count, channel
+
+SAMPLE_DTYPE = np.dtype([
+    ("flow_raw", "<u2"),       # sensor counts
+    ("pressure_raw", "<u2"),
+])
+
+# Readings as BinaryLog.between() decodes them
+LOG_DTYPE = np.dtype([
+    ("t", "<f8"),              # seconds since meta["t0"]
+    ("slm", "<f4"),
+    ("cmH2O", "<f4"),
+    ("flow_raw", "<u2"),
+    ("pressure_raw", "<u2"),
+    ("channel", "u1"),
+])
+
+GRID_TOLERANCE = 0.25   # sample periods
+
+NOMINAL_FLOW = {"flow_offset": 32768.0, "flow_scale": 100.0}
+NOMINAL_PRESSURE = {"pressure_scale_factor": 0.01, "pressure_report_min": 32768, "pressure_min": 0.0,
+                    "pressure_conv_factor": 1.0}
+
+LOG_EXTENSION = ".svlog"
+
+COMPRESSED_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def compression_module(method):
+    """The module whose open() reads and writes `method` ("gzip" or "zstd") files"""
+    if method == "gzip":
+        return gzip
+    if method == "zstd":
+        try:
+            from compression import zstd
+            return zstd
+        except ImportError:
+            pass
+        try:
+            import zstandard
+            return zstandard
+        except ImportError:
+            raise ValueError("zstd compression needs Python 3.14 or the zstandard module")
+    raise ValueError("Unknown compression {!r}".format(method))
+
+
+def compression_of(filename):
+    """The compression method a log filename implies, or None"""
+    for method, extension in COMPRESSED_EXTENSIONS.items():
+        if filename.endswith(extension):
+            return method
+    return None
+
+
+def open_log(filename):
+    """Open a log for binary reading, decompressing .gz and .zst files"""
+    method = compression_of(filename)
+    return compression_module(method).open(filename, "rb") if method else open(filename, "rb")
+
+
+def is_binary_log(filename):
+    with open_log(filename) as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def raw_counts(slm, cmH2O, meta):
+    """Recover sensor counts from scaled values using the calibration in meta
+
+    The sensors scale counts with an affine transfer function, so rounding the
+    inverse reproduces the counts exactly. Returns (flow_raw, pressure_raw).
+    """
+    flow_raw = np.rint(np.asarray(slm, dtype=np.float64) * meta["flow_scale"] + meta["flow_offset"])
+    pressure_raw = np.rint((np.asarray(cmH2O, dtype=np.float64) / meta["pressure_conv_factor"] - meta["pressure_min"])
+                           / meta["pressure_scale_factor"] + meta["pressure_report_min"])
+    return np.clip(flow_raw, 0, 0xFFFF).astype(np.uint16), np.clip(pressure_raw, 0, 0xFFFF).astype(np.uint16)
+
+
+def scaled_values(flow_raw, pressure_raw, meta):
+    """The inverse of raw_counts: (slm, cmH2O) as float32, scaled as the sensor classes scale them"""
+    slm = (flow_raw - np.float64(meta["flow_offset"])) / meta["flow_scale"]
+    cmH2O = ((pressure_raw - np.float64(meta["pressure_report_min"])) * meta["pressure_scale_factor"]
+             + meta["pressure_min"]) * meta["pressure_conv_factor"]
+    return slm.astype(np.float32), cmH2O.astype(np.float32)
+
+
+class BinaryLogWriter(object):
+    """Write readings as chunks of raw counts, each at most `chunk_records` samples of one channel
+
+    :param meta: Log metadata, which must include "sample_rate". A missing flow or pressure
+        calibration is filled in from NOMINAL_FLOW or NOMINAL_PRESSURE and listed in meta["nominal"].
+    """
+
+    def __init__(self, filename, meta, chunk_records=4096):
+        if not meta.get("sample_rate"):
+            raise ValueError("A binary log needs the sample rate in its metadata")
+        self.filename = filename
+        self.meta = dict(meta, version=VERSION, chunk_records=chunk_records)
+        nominal = []
+        if not self.meta.get("flow_scale"):
+            self.meta.update(NOMINAL_FLOW)
+            nominal.append("flow")
+        if not self.meta.get("pressure_scale_factor"):
+            self.meta.update(NOMINAL_PRESSURE)
+            nominal.append("pressure")
+        if nominal:
+            self.meta["nominal"] = nominal
+        self.dt = 1.0 / float(meta["sample_rate"])
+        self.chunk_records = chunk_records
+        self.chunks = {}    # channel: [t0, samples, fill] of the chunk being filled
+        self.f = open(filename, "wb")
+        self.f.write(encode_header(self.meta))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def write_readings(self, t, slm, cmH2O, channel=0):
+        """Append arrays of timestamps (seconds since meta["t0"]) and scaled readings
+
+        :param channel: The channel of every reading, or an array of each reading's channel
+        """
+        t = np.asarray(t, dtype=np.float64)
+        samples = np.zeros(t.size, dtype=SAMPLE_DTYPE)
+        samples["flow_raw"], samples["pressure_raw"] = raw_counts(slm, cmH2O, self.meta)
+        if np.ndim(channel) == 0:
+            self._append(int(channel), t, samples)
+            return
+        channel = np.asarray(channel)
+        for c in np.unique(channel).tolist():
+            self._append(c, t[channel == c], samples[channel == c])
+
+    def _append(self, channel, t, samples):
+        while t.size:
+            if channel not in self.chunks:
+                self.chunks[channel] = [float(t[0]), np.zeros(self.chunk_records, dtype=SAMPLE_DTYPE), 0]
+            chunk = self.chunks[channel]
+            t0, buffer, fill = chunk
+            k = min(t.size, buffer.size - fill)
+            off_grid = np.abs(t[:k] - (t0 + np.arange(fill, fill + k) * self.dt)) > GRID_TOLERANCE * self.dt
+            if off_grid.any():
+                k = int(np.argmax(off_grid))
+            buffer[fill:fill + k] = samples[:k]
+            chunk[2] = fill + k
+            t = t[k:]
+            samples = samples[k:]
+            if t.size or chunk[2] == buffer.size:
+                self._write_chunk(channel)
+
+    def _write_chunk(self, channel):
+        t0, buffer, fill = self.chunks.pop(channel)
+        if fill:
+            self.f.write(CHUNK.pack(t0, self.dt, fill, channel) + buffer[:fill].tobytes())
+
+    def flush(self):
+        """Write out every partly filled chunk; later readings start new ones"""
+        for channel in list(self.chunks):
+            self._write_chunk(channel)
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+
+def encode_header(meta):
+    body = json.dumps(meta).encode("utf-8")
+    if PREAMBLE.size + len(body) > HEADER_LEN:
+        raise ValueError("Log metadata does not fit in {} byte header".format(HEADER_LEN))
+    return (PREAMBLE.pack(MAGIC, VERSION, len(body)) + body).ljust(HEADER_LEN, b"\0")
+
+
+class BinaryLog(object):
+    """Memory-mapped reader for a binary session log; compressed segments are decompressed into memory
+
+    Opening a log reads only the chunk headers, into the chunk_t0, chunk_dt,
+    chunk_count, chunk_channel and chunk_offset arrays.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open_log(filename) as f:
+            magic, version, length = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a splitvent binary log".format(filename))
+            if version != VERSION:
+                raise ValueError("{} is a version {} log; this reader reads version {}".format(filename, version, VERSION))
+            self.meta = json.loads(f.read(length).decode("utf-8"))
+            if compression_of(filename) is None:
+                f.seek(0, 2)
+                data = None
+                size = f.tell()
+            else:
+                f.read(HEADER_LEN - PREAMBLE.size - length)
+                data = f.read()
+                size = HEADER_LEN + len(data)
+        if size <= HEADER_LEN:
+            self.data = np.zeros(0, dtype=np.uint8)
+        elif data is not None:
+            self.data = np.frombuffer(data, dtype=np.uint8)
+        else:
+            self.data = np.memmap(filename, dtype=np.uint8, mode="r", offset=HEADER_LEN, shape=(size - HEADER_LEN,))
+        self._read_chunks()
+
+    def _read_chunks(self):
+        chunks = []
+        pos = 0
+        while pos + CHUNK.size <= self.data.size:
+            t0, dt, count, channel = CHUNK.unpack_from(self.data, pos)
+            # A crash can leave a torn trailing chunk; only its complete samples are read
+            count = min(count, (self.data.size - pos - CHUNK.size) // SAMPLE_DTYPE.itemsize)
+            chunks.append((t0, dt, count, channel, pos + CHUNK.size))
+            pos = pos + CHUNK.size + count * SAMPLE_DTYPE.itemsize
+        chunks = np.array(chunks, dtype=np.float64).reshape(-1, 5)
+        self.chunk_t0, self.chunk_dt = chunks[:, 0], chunks[:, 1]
+        self.chunk_count, self.chunk_channel, self.chunk_offset = chunks[:, 2:].astype(np.int64).T
+
+    def __len__(self):
+        return int(self.chunk_count.sum())
+
+    @property
+    def sample_rate(self):
+        return self.meta.get("sample_rate")
+
+    @property
+    def chunk_t_end(self):
+        """The time of each chunk's last sample"""
+        return self.chunk_t0 + (self.chunk_count - 1) * self.chunk_dt
+
+    @property
+    def duration(self):
+        return float(self.chunk_t_end.max()) if self.chunk_count.size else 0.0
+
+    @property
+    def records(self):
+        """Every reading in the log, decoded"""
+        return self.between()
+
+    def between(self, t_start=None, t_end=None, channel=None):
+        """LOG_DTYPE readings with t_start <= t < t_end in time order, decoding only the chunks that overlap"""
+        keep = self.chunk_count > 0
+        if channel is not None:
+            keep &= self.chunk_channel == channel
+        if t_start is not None:
+            keep &= self.chunk_t_end >= t_start
+        if t_end is not None:
+            keep &= self.chunk_t0 < t_end
+        chunks = np.nonzero(keep)[0]
+        if not chunks.size:
+            return np.zeros(0, dtype=LOG_DTYPE)
+        records = np.concatenate([self._decode(i, t_start, t_end) for i in chunks.tolist()])
+        if np.unique(self.chunk_channel[chunks]).size > 1:
+            records = records[np.argsort(records["t"], kind="stable")]
+        return records
+
+    def _decode(self, i, t_start, t_end):
+        offset, count = self.chunk_offset[i], self.chunk_count[i]
+        t = self.chunk_t0[i] + np.arange(count) * self.chunk_dt[i]
+        lo = 0 if t_start is None else np.searchsorted(t, t_start, side="left")
+        hi = count if t_end is None else np.searchsorted(t, t_end, side="left")
+        samples = self.data[offset:offset + count * SAMPLE_DTYPE.itemsize].view(SAMPLE_DTYPE)[lo:hi]
+        records = np.zeros(hi - lo, dtype=LOG_DTYPE)
+        records["t"] = t[lo:hi]
+        records["flow_raw"] = samples["flow_raw"]
+        records["pressure_raw"] = samples["pressure_raw"]
+        records["slm"], records["cmH2O"] = scaled_values(samples["flow_raw"], samples["pressure_raw"], self.meta)
+        records["channel"] = self.chunk_channel[i]
+        return records
+
+
+def read_jsonl(filename):
+    """Yield (t, slm, cmH2O) from a JSON-lines log written by earlier versions of the GUI"""
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                js = json.loads(line)
+                yield js["t"], js["slm"], js["cmH2O"]
+
+
+def convert_jsonl(src, dst=None, sample_rate=None, chunk_records=65536):
+    """Convert a JSON-lines log to the binary format. Returns the output filename.
+
+    Without a sample rate, given or in the filename, it is estimated from the timestamps.
+    """
+    if dst is None:
+        dst = re.sub(r"\.log$", "", src) + LOG_EXTENSION
+    if sample_rate is None:
+        m = re.search(r"-(\d+)hz-", src)
+        sample_rate = float(m.group(1)) if m else None
+    rows = read_jsonl(src)
+    chunk = list(itertools.islice(rows, chunk_records))
+    if sample_rate is None:
+        if len(chunk) < 2:
+            raise ValueError("{} has too few readings to estimate the sample rate".format(src))
+        sample_rate = 1.0 / float(np.median(np.diff([row[0] for row in chunk])))
+    meta = {"sample_rate": sample_rate, "t0": 0.0, "source": src}
+    with BinaryLogWriter(dst, meta, chunk_records) as writer:
+        while chunk:
+            t, slm, cmH2O = np.array(chunk).T
+            writer.write_readings(t, slm, cmH2O)
+            chunk = list(itertools.islice(rows, chunk_records))
+    return dst
+
+
+def main():
+    if len(sys.argv) >= 3 and sys.argv[1] == "convert":
+        for src in sys.argv[2:]:
+            print("{} -> {}".format(src, convert_jsonl(src)))
+    elif len(sys.argv) >= 3 and sys.argv[1] == "info":
+        for filename in sys.argv[2:]:
+            log = BinaryLog(filename)
+            print("{}: {} records in {} chunks, {:.1f} s".format(filename, len(log), log.chunk_count.size, log.duration))
+            print(json.dumps(log.meta, indent=2))
+    else:
+        print("usage: binlog.py convert <log.log>...  |  binlog.py info <log.svlog>...")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,127 +1,308 @@
 
-import time, math, json, queue, json
+import time, math, queue
 from collections import deque, namedtuple
 import numpy as np
-import biopeaks.resp
-import scipy.signal
+
+from shmring import receive_ring
+from metrics import METRICS, JITTER_BOUNDS_MS, DEPTH_BOUNDS, configure_process
+from scheduler import SampleScheduler, wallclock, OVERRUN_SKIP, OVERRUN_CATCH_UP, OVERRUN_POLICIES
+import startup
 
 
 class CircularBuffer(object):
+    """Fixed-size ring of the most recent n values
+
+    Storage is mirrored: every value is written at idx and idx+n of a 2n array,
+    so the time-ordered contents are always one contiguous slice and
+    ordered() / last() return views instead of copies. Views alias the
+    storage and change as values are added; copy them if they must be kept.
+    `arr` is the unrolled ring with the oldest value at `idx`, as before.
+    """
+
     def __init__(self, n, dtype=np.float32):
-        self.arr = np.zeros(n, dtype=dtype)
+        self.n = n
+        self.store = np.zeros(2 * n, dtype=dtype)
+        self.arr = self.store[:n]
         self.idx = 0
+        self.count = 0
         self.full = False
 
     def append(self, v):
-        self.arr[self.idx] = v
+        self.store[self.idx] = v
+        self.store[self.idx + self.n] = v
+        self.count = self.count + 1
         newidx = self.idx + 1
-        if not self.full and newidx == self.arr.size:
+        if not self.full and newidx == self.n:
             self.full = True
-        self.idx = newidx % self.arr.size
+        self.idx = newidx % self.n
+
+    def extend(self, values):
+        """Append an array of values with at most four slice assignments"""
+        values = np.asarray(values, dtype=self.store.dtype)
+        total = values.size
+        k = min(total, self.n)
+        start = (self.idx + total - k) % self.n
+        values = values[total - k:]
+        first = min(k, self.n - start)
+        rest = k - first
+        self.store[start:start + first] = values[:first]
+        self.store[start + self.n:start + self.n + first] = values[:first]
+        self.store[:rest] = values[first:]
+        self.store[self.n:self.n + rest] = values[first:]
+        self.count = self.count + total
+        self.full = self.full or self.idx + total >= self.n
+        self.idx = (start + k) % self.n
 
     def ordered(self):
-        return np.roll(self.arr, -self.idx)
+        """The buffer contents, oldest first, as a view"""
+        return self.store[self.idx:self.idx + self.n]
+
+    def last(self, m):
+        """The most recent m values, oldest first, as a view"""
+        m = min(m, self.n)
+        return self.store[self.idx + self.n - m:self.idx + self.n]
 
 
+WAVEFORM_DTYPE = np.dtype([("t", np.float64), ("slm", np.float32), ("cmH2O", np.float32), ("V", np.float32)])
 
 
 FlowPressureReading = namedtuple("FlowPressureReading", ["slm", "cmH2O"])
 
-def combined_readings(flowClass, pressureClass):
+def sensor_info(s, p):
+    """Describe an opened flow/pressure sensor pair: serial number and the calibration needed to recover raw counts"""
+    info = {"flow_sensor": type(s).__name__, "pressure_sensor": type(p).__name__}
+    if hasattr(s, "scale"):
+        info.update(flow_serial=s.serial_number, flow_offset=s.offset, flow_scale=s.scale)
+    if hasattr(p, "scale_factor"):
+        info.update(pressure_scale_factor=p.scale_factor, pressure_report_min=p.transferfunc.report_min,
+                    pressure_min=p.range.min, pressure_conv_factor=p.range.convFactor)
+    if hasattr(s, "sim_settings"):
+        info.update(sim_settings=s.sim_settings._asdict())
+    return info
+
+
+def combined_readings(flowClass, pressureClass, info=None):
+    """Yield FlowPressureReadings. If `info` is a dict, it is filled from sensor_info once the sensors are open."""
     with flowClass() as s:
         with pressureClass() as p:
+            if info is not None:
+                info.update(sensor_info(s, p))
             s.prepare()
             p.prepare()
+            read_flow = METRICS.histogram("read.flow_ms")
+            read_pressure = METRICS.histogram("read.pressure_ms")
             while True:
+                t0 = time.perf_counter()
                 slm = s.read_scaled()
+                t1 = time.perf_counter()
                 cmH2O = p.read_scaled()
+                t2 = time.perf_counter()
+                read_flow.observe((t1 - t0) * 1000.0)
+                read_pressure.observe((t2 - t1) * 1000.0)
                 yield FlowPressureReading(slm, cmH2O)
 
 
-def clocked_from_file(filename, sr=None, clock=time.time, sleep=time.sleep):
-    print("Readings from file {}".format(filename))
-    with open(filename, "r") as f:
-        t0 = clock()
-        t = t0
-        lastt = None
-        n = 0
-        for line in f:
-            js = json.loads(line)
-            tLine = js.t + t0
-            sleep(max(0, tLine - t))
-            if(lastt):
-                deltaT = t - lastt
-                yield TReading(n, t, deltaT, FlowPressureReading(js.slm, js.cmH2O))
-                n = n + 1
-            lastt = t
-            t = clock()
+def iter_blocks(records, blocksize=65536):
+    for i in range(0, records.size, blocksize):
+        yield records[i:i + blocksize]
 
 
 TReading = namedtuple("TReading", ["n", "t", "dT", "value"])
 
-def clocked(valueGenerator, sr, clock=time.time, sleep=time.sleep):
+def clocked(valueGenerator, sr, clock=None, sleep=time.sleep, spin=0.0, overrun=OVERRUN_SKIP, timer=False):
     """ Generate values at a fixed rate
 
+    Reads are scheduled on absolute deadlines of a monotonic clock (see
+    scheduler.SampleScheduler), so the rate does not drift, and each reading
+    is stamped with the middle of the read that produced it.
+
     :param valueGenerator: The underlying generator to obtain values from
     :param sr: The sampling rate in samples per second
-    :param clock: A function that returns the current time in seconds
+    :param clock: A function that returns the current time in seconds; by default samples are
+        scheduled on time.monotonic and stamped with scheduler.wallclock
     :param sleep: A function that sleeps (blocks) for a given time in seconds
+    :param spin: Seconds before each deadline to stop sleeping and busy-wait
+    :param overrun: OVERRUN_SKIP or OVERRUN_CATCH_UP, for reads that run past the next deadline
+    :param timer: Wait on a Linux timerfd rather than sleeping
     :return: A generator returning TReading tuples of (n, t, dT, value)
     """
     print("Clocked, sr={}".format(sr))
-    t0 = clock()
-    last_t = t0 - (1.0/sr)
+    jitter = METRICS.histogram("clock.jitter_ms", JITTER_BOUNDS_MS)
+    lateness = METRICS.histogram("clock.late_ms")
+    missed = METRICS.counter("clock.missed_deadlines")
+    skipped = METRICS.counter("clock.skipped")
+    rate = METRICS.gauge("clock.rate")
+    stamp = clock or wallclock
+    scheduler = SampleScheduler(sr, clock, sleep, spin, overrun, timer)
+    values = iter(valueGenerator)
+    last_t = None
+    overruns, skips = 0, 0
     n = 0
-    for v in valueGenerator:
-        t = clock()
-        deltaT = t - last_t
-        yield TReading(n, t, deltaT, v)
-        n = n + 1
-        last_t = t
-        t_sleep = max(0, ((n/sr) + t0) - t)
-        sleep(t_sleep)
-
-
+    try:
+        while True:
+            due = scheduler.wait()
+            t_start = scheduler.clock()
+            t_read = stamp()
+            try:
+                v = next(values)
+            except StopIteration:
+                return
+            t_end = scheduler.clock()
+            t = t_read + (t_end - t_start) / 2
+            deltaT = (t - last_t) if last_t is not None else 1.0/sr
+            lateness.observe((t_start - due) * 1000.0)
+            jitter.observe((deltaT - 1.0/sr) * 1000.0)
+            missed.inc(scheduler.overruns - overruns)
+            skipped.inc(scheduler.skipped - skips)
+            overruns, skips = scheduler.overruns, scheduler.skipped
+            if n % 256 == 0:
+                rate.set(scheduler.rate())
+            yield TReading(n, t, deltaT, v)
+            n = n + 1
+            last_t = t
+    finally:
+        scheduler.close()
 
 
 def makefilter(sr, taps=23):
-    """Return an array of filter coefficients for a low-pass FIR filter at 3Hz"""
+    """Return an array of filter coefficients for a low-pass FIR filter at 3Hz, cached on disk (see startup.py)"""
+    return startup.cached_filter("lowpass3hz", _design_lowpass, float(sr), int(taps))
+
+def _design_lowpass(sr, taps):
+    import scipy.signal
     return scipy.signal.firwin2(taps, [0, 3, 6, sr/2], [1, 1, 0.0001, 0.0001], window="hamming", fs=sr)
 
 IntegratedVolume = namedtuple("IntegratedVolume", ["n", "t", "dT", "slm", "cmH2O", "dV", "V"])
 
+class VolumeIntegrator(object):
+    """Low-pass filter flow and integrate it into volume, one reading at a time
+
+    Push-style counterpart of integrate_readings, for callers that interleave
+    several independent streams (e.g. one integrator per patient channel).
+    """
+
+    def __init__(self, sr):
+        self.V = 0.0
+        self.last_filtered_slm = 0.0
+        self.taps = makefilter(sr)
+        self.buffer = deque(maxlen=self.taps.size)
+        self.fbuf = CircularBuffer(self.taps.size)
+        self.coincident_idx = self.taps.size // 2
+
+    def push(self, tup):
+        """Add a TReading. Returns the IntegratedVolume for the sample at the
+        center of the filter window, or None while the filter is filling."""
+        self.buffer.append(tup)
+        self.fbuf.append(tup.value.slm)
+        if not self.fbuf.full:
+            return None
+        filtered_slm = (self.taps * self.fbuf.ordered()).sum()
+        if self.last_filtered_slm < 0 <= filtered_slm:
+            self.V = 0.0
+        self.last_filtered_slm = filtered_slm
+        (n, t, dT, (slm, cmH2O)) = self.buffer[self.coincident_idx]
+        dV = (dT * slm * 1000.0) / 60.0
+        self.V = self.V + dV
+        return IntegratedVolume(n, t, dT, slm, cmH2O, dV, self.V)
+
+
 def integrate_readings(timedReadings, sr):
-    V = 0.0
-    last_filtered_slm = 0.0
-    taps = makefilter(sr)
-    buffer = deque(maxlen=taps.size)
-    fbuf = CircularBuffer(taps.size)
-    coincident_idx = taps.size // 2
+    integrator = VolumeIntegrator(sr)
     for tup in timedReadings:
-        buffer.append(tup)
-        fbuf.append(tup.value.slm)
-        if fbuf.full:
-            filtered_slm = (taps * fbuf.ordered()).sum()
-            if last_filtered_slm < 0 <= filtered_slm:
-                V = 0.0
-            last_filtered_slm = filtered_slm
-            (n, t, dT, (slm, cmH2O)) = buffer[coincident_idx]
-            dV = (dT * slm * 1000.0) / 60.0
-            V = V + dV
-            yield IntegratedVolume(n, t, dT, slm, cmH2O, dV, V)
-
-VolumePressureReading = namedtuple("VolumePressureReading", ["V", "cmH2O"])
-
-def stream_readings(flowClass, pressureClass, samplerate, displayQueue, tidalCalcQueue, finishq):
-    combinedvals = combined_readings(flowClass, pressureClass)
-    clockedvals = clocked(combinedvals, samplerate)
-    integratedvals = integrate_readings(clockedvals, samplerate)
-    for r in integratedvals:
-        displayQueue.put(r)
-        tidalCalcQueue.put(VolumePressureReading(r.V, r.cmH2O))
-        if not finishq.empty():
-            print("Exiting streaming process")
-            return
+        r = integrator.push(tup)
+        if r is not None:
+            yield r
+
+
+class BlockIntegrator(object):
+    """Filter and integrate arrays of readings, carrying filter and volume state between blocks
+
+    Produces exactly the same values as integrate_readings: the FIR is applied
+    to the same float32 window with the same summation, the last taps-1 inputs
+    are kept as filter state, and V is accumulated sequentially between the
+    flow zero crossings.
+    """
+
+    def __init__(self, sr, taps=23):
+        self.V = 0.0
+        self.last_filtered_slm = 0.0
+        self.taps = makefilter(sr, taps)
+        self.coincident_idx = self.taps.size // 2
+        self.state = None
+
+    def process(self, n, t, dT, slm, cmH2O):
+        """Integrate a block of readings given as equal-length arrays
+
+        :return: An IntegratedVolume of arrays, one element per sample whose
+                 filter window is complete. Output lags input by half the filter length.
+        """
+        cols = [np.asarray(n)] + [np.asarray(c, dtype=np.float64) for c in (t, dT, slm, cmH2O)]
+        if self.state is not None:
+            cols = [np.concatenate((s, c)) for s, c in zip(self.state, cols)]
+        ntaps = self.taps.size
+        self.state = [c[max(0, c.size - (ntaps - 1)):] for c in cols]
+        nout = cols[0].size - (ntaps - 1)
+        if nout <= 0:
+            return IntegratedVolume(*[np.zeros(0)] * 7)
+
+        fslm = cols[3].astype(np.float32)
+        windows = np.lib.stride_tricks.as_strided(fslm, shape=(nout, ntaps), strides=(fslm.strides[0], fslm.strides[0]))
+        filtered_slm = (self.taps * windows).sum(axis=1)
+        previous = np.concatenate(([self.last_filtered_slm], filtered_slm[:-1]))
+        resets = np.flatnonzero((previous < 0) & (0 <= filtered_slm))
+        self.last_filtered_slm = filtered_slm[-1]
+
+        n, t, dT, slm, cmH2O = [c[self.coincident_idx:self.coincident_idx + nout] for c in cols]
+        dV = (dT * slm * 1000.0) / 60.0
+        V = np.empty_like(dV)
+        start = 0
+        V0 = self.V
+        for end in list(resets) + [nout]:
+            V[start:end] = np.cumsum(np.concatenate(([V0], dV[start:end])))[1:]
+            V0 = 0.0
+            start = end
+        self.V = V[-1]
+        return IntegratedVolume(n, t, dT, slm, cmH2O, dV, V)
+
+
+def integrate_blocks(blocks, sr):
+    """Generate IntegratedVolume arrays from an iterable of (n, t, dT, slm, cmH2O) array blocks"""
+    integrator = BlockIntegrator(sr)
+    for block in blocks:
+        yield integrator.process(*block)
+
+VolumePressureReading = namedtuple("VolumePressureReading", ["t", "V", "cmH2O"])
+
+def stream_readings(flowClass, pressureClass, samplerate, ring, finishq, combiner=combined_readings, schedule=None):
+    """Acquisition process: publish each IntegratedVolume to a SharedRing for the GUI and tidal consumers
+
+    Sensor details are published as ring metadata before the first sample.
+    `schedule` holds extra keyword arguments for clocked (spin, overrun, timer).
+    """
+    configure_process("acquisition")
+    startup.mark("acquisition started")
+    info = {"sample_rate": samplerate}
+    clockedvals = clocked(combiner(flowClass, pressureClass, info), samplerate, **(schedule or {}))
+    integrator = VolumeIntegrator(samplerate)
+    integrate_ms = METRICS.histogram("integrate_ms")
+    try:
+        for tup in clockedvals:
+            t0 = time.perf_counter()
+            r = integrator.push(tup)
+            integrate_ms.observe((time.perf_counter() - t0) * 1000.0)
+            METRICS.maybe_dump()
+            if r is None:
+                continue
+            if ring.write_count == 0:
+                startup.mark("first sample")
+                ring.set_meta(info)
+            ring.write_one(r)
+            if not finishq.empty():
+                print("Exiting streaming process")
+                return
+    finally:
+        ring.finish()
+        METRICS.dump()
 
 
 def receive_readings(q):
@@ -138,33 +319,192 @@ def receive_readings(q):
 
 TidalData = namedtuple("TidalData", ["VTi", "VTe", "RR", "MVe", "PPk", "PEEP"])
 
-def tidalcalcs(statslen, sample_rate, inputq, finishq, outputq):
-    volume_signal = CircularBuffer(statslen)
-    pressure_signal = CircularBuffer(statslen)
-    veaccum = CircularBuffer(3)
-    for inputs in receive_readings(inputq):
-        for i in inputs:
-            volume_signal.append(i.V)
-            pressure_signal.append(i.cmH2O)
-        try:
-            vsig = volume_signal.ordered()
-            resp_extrema = biopeaks.resp.resp_extrema(vsig, sample_rate)
-            sigs = vsig[resp_extrema]
-            if len(resp_extrema) > 4:
-                if sigs[-1] < sigs[-2]:
-                    VTi = sigs[-2] - sigs[-3]
-                    VTe = sigs[-2] - sigs[-1]
-                else:
-                    VTe = sigs[-3] - sigs[-2]
-                    VTi = sigs[-1] - sigs[-2]
-                veaccum.append(VTe)
-                period, rate, tidalAmp = biopeaks.resp.resp_stats(resp_extrema, vsig, sample_rate)
-                avgVTe = veaccum.arr.sum() / veaccum.arr.size
-                mve = (rate[-1] * avgVTe)/1000.0
-                tidal = TidalData(VTi, VTe, rate[-1], mve, pressure_signal.arr.max(), pressure_signal.arr.min())
-                outputq.put(tidal)
-        except:
-            print("Warning: tidal failed")
-        if not finishq.empty():
-            return
-        time.sleep(0.5)
+def tidal_from_signals(vsig, psig, veaccum, sample_rate):
+    """Compute TidalData from a window of volume and pressure samples
+
+    :param vsig: Time-ordered volume signal in ml
+    :param psig: Pressure samples in cmH2O covering the same window
+    :param veaccum: CircularBuffer of recent VTe values, updated in place
+    :param sample_rate: The sampling rate in samples per second
+    :return: A TidalData tuple, or None if too few breaths are in the window
+    """
+    import biopeaks.resp
+    resp_extrema = biopeaks.resp.resp_extrema(vsig, sample_rate)
+    sigs = vsig[resp_extrema]
+    if len(resp_extrema) <= 4:
+        return None
+    if sigs[-1] < sigs[-2]:
+        VTi = sigs[-2] - sigs[-3]
+        VTe = sigs[-2] - sigs[-1]
+    else:
+        VTe = sigs[-3] - sigs[-2]
+        VTi = sigs[-1] - sigs[-2]
+    veaccum.append(VTe)
+    period, rate, tidalAmp = biopeaks.resp.resp_stats(resp_extrema, vsig, sample_rate)
+    avgVTe = veaccum.arr.sum() / veaccum.arr.size
+    mve = (rate[-1] * avgVTe)/1000.0
+    return TidalData(VTi, VTe, rate[-1], mve, psig.max(), psig.min())
+
+
+class BreathDetector(object):
+    """Streaming breath segmentation on the integrated volume signal
+
+    Each sample is examined once. Volume peaks (end of inspiration) and troughs
+    (end of expiration) are found with a hysteresis of `hysteresis` ml, and a
+    TidalData is produced as soon as the trough closing a breath is confirmed:
+
+        VTi  = peak - previous trough        VTe = peak - trough
+        RR   = 60 / breath duration          MVe = RR * mean(last 3 VTe) / 1000
+        PPk  = max pressure over the breath  PEEP = min pressure over the breath
+
+    Swings smaller than the hysteresis and breaths shorter than `min_period`
+    seconds are treated as noise. Acquisition may start part way through a
+    breath, so nothing is reported until the first trough; the breath starting
+    there is measured from the volume restart at its onset and is reported.
+    On synthetic ventilator waveforms at 10-30 b/min and the FakeFlow sine, RR
+    agrees with the biopeaks window analysis (tidal_from_signals) to within
+    0.5 b/min and VTi/VTe to within 10%, typically 3-4% (bench.py --agreement);
+    the difference in volume is biopeaks reading low, as it smooths the signal
+    before locating extrema.
+    """
+
+    def __init__(self, hysteresis=25.0, min_period=1.0, ve_breaths=3):
+        self.hysteresis = hysteresis
+        self.min_period = min_period
+        self.veaccum = deque(maxlen=ve_breaths)
+        self.rising = True
+        self.extreme = -math.inf
+        self.extreme_t = None
+        self.peak = None
+        self.trough = None
+        self.trough_t = None
+        self.pmax = -math.inf
+        self.pmin = math.inf
+        self.breaths = 0
+        self.rearmed = False
+        self.tidal = None
+
+    def push(self, t, V, cmH2O):
+        """Add one sample. Returns TidalData when it completes a breath, else None"""
+        self.pmax = max(self.pmax, cmH2O)
+        self.pmin = min(self.pmin, cmH2O)
+        if self.rising:
+            if V > self.extreme:
+                self.extreme = V
+                self.extreme_t = t
+            elif V < self.extreme - self.hysteresis:
+                self.peak = self.extreme
+                self.rising = False
+                self.extreme = V
+                self.extreme_t = t
+            return None
+        if V < self.extreme:
+            self.extreme = V
+            self.extreme_t = t
+            return None
+        if V <= self.extreme + self.hysteresis:
+            return None
+        if self.trough is None and not self.rearmed:
+            # The first trough ends a breath joined part way, whose volume was not integrated from its
+            # inspiration onset. The integrators restart volume at zero at each onset, so the breath now
+            # starting is measured from there instead.
+            self.rearmed = True
+            self.extreme = min(V, 0.0)
+            self.extreme_t = t
+            return None
+        # The steep start of inspiration times breaths more precisely than the flat trough
+        trough = self.extreme
+        self.rising = True
+        self.extreme = V
+        self.extreme_t = t
+        if self.trough_t is not None and t - self.trough_t < self.min_period:
+            # Too short to be a breath: merge it into the one in progress
+            self.trough = min(self.trough, trough)
+            return None
+        tidal = None
+        if self.trough is not None:
+            self.breaths = self.breaths + 1
+        if self.breaths >= 1:
+            VTi = self.peak - self.trough
+            VTe = self.peak - trough
+            RR = 60.0 / (t - self.trough_t)
+            self.veaccum.append(VTe)
+            mve = (RR * sum(self.veaccum) / len(self.veaccum)) / 1000.0
+            tidal = TidalData(VTi, VTe, RR, mve, self.pmax, self.pmin)
+            self.tidal = tidal
+        self.trough = trough
+        self.trough_t = t
+        self.pmax = cmH2O
+        self.pmin = cmH2O
+        return tidal
+
+    def process(self, t, V, cmH2O):
+        """Add arrays of samples. Returns a list of (t, TidalData) for each breath completed"""
+        breaths = []
+        for ti, Vi, pi in zip(np.asarray(t).tolist(), np.asarray(V).tolist(), np.asarray(cmH2O).tolist()):
+            tidal = self.push(ti, Vi, pi)
+            if tidal is not None:
+                breaths.append((ti, tidal))
+        return breaths
+
+
+SEEK_GAP = 2.0
+
+def continuous_spans(t, last_t=None, max_gap=SEEK_GAP):
+    """Split a block of timestamps where time goes backwards or skips more than max_gap seconds, as after a seek
+
+    :return: A list of (start, stop, restart) with restart True where a span does not continue from the one before
+    """
+    t = np.asarray(t)
+    if not t.size:
+        return []
+    breaks = (np.flatnonzero((np.diff(t) < 0) | (np.diff(t) > max_gap)) + 1).tolist()
+    restart = last_t is not None and not (0 <= t[0] - last_t <= max_gap)
+    bounds = [0] + breaks + [t.size]
+    return [(start, stop, restart or i > 0) for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+class RingBreaths(object):
+    """Breath detection over successive blocks of ring records
+
+    Detection starts afresh wherever the time stamps jump (see continuous_spans).
+    """
+
+    def __init__(self):
+        self.detector = BreathDetector()
+        self.last_t = None
+
+    def process(self, view):
+        """Returns a list of (t, TidalData) for each breath completed in the block"""
+        breaths = []
+        for start, stop, restart in continuous_spans(view["t"], self.last_t):
+            if restart:
+                self.detector = BreathDetector()
+            breaths.extend(self.detector.process(view["t"][start:stop], view["V"][start:stop], view["cmH2O"][start:stop]))
+        if view.size:
+            self.last_t = float(view["t"][-1])
+        return breaths
+
+
+def tidalcalcs(sample_rate, ring, finishq, outputq):
+    """Tidal process: emit (t, TidalData) on outputq as each breath completes, found by RingBreaths"""
+    configure_process("tidal")
+    startup.mark("tidal started")
+    breaths = RingBreaths()
+    compute_ms = METRICS.histogram("tidal.compute_ms")
+    backlog = METRICS.histogram("tidal.backlog", DEPTH_BOUNDS)
+    # Start from the oldest record held: acquisition may already have written some before this process came up
+    cursor = ring.cursor(from_start=True)
+    try:
+        for view in receive_ring(cursor):
+            backlog.observe(view.size)
+            t0 = time.perf_counter()
+            for breath in breaths.process(view):
+                outputq.put(breath)
+            compute_ms.observe((time.perf_counter() - t0) * 1000.0)
+            METRICS.gauge("tidal.overruns").set(cursor.overruns)
+            METRICS.maybe_dump()
+            if not finishq.empty():
+                return
+    finally:
+        METRICS.dump()
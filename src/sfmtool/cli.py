@@ -1,7 +1,7 @@
 
 
 
-import time, math, argparse, json, queue
+import sys, time, math, argparse, json, queue
 import multiprocessing as mp
 
 import numpy as np
@@ -70,33 +70,17 @@ def format_integrated(integratedReadings, sr=100.0, display_duration=12.0, skip=
     print("Formatter, sr={}, dur={}, skip={}".format(sr, display_duration, skip))
     accum = collections.deque(maxlen=skip)
     statsaccum = collections.deque(maxlen=int(sr*display_duration*2))
-    veaccum = collections.deque(maxlen=3)
+    detector = BreathDetector()
+    tidal_str = "VTi:     ml, VTe:     ml, RR:     b/min, MVe:      l/m"
     for r in integratedReadings:
         accum.append(r)
         statsaccum.append(r.V)
+        tidal = detector.push(r.t, r.V, r.cmH2O)
+        if tidal is not None:
+            tidal_str = "VTi:{:>4.0f} ml, VTe:{:>4.0f} ml, RR:{:4.1f} b/min, MVe:{:5.1f} l/m".format(tidal.VTi, tidal.VTe, tidal.RR, tidal.MVe)
         if len(accum) == skip:
             if  r.n % skip == 0:
                 v_error = v_error - (0.1 * (v_error-min(statsaccum)))
-                tidal_str = "VTi:     ml, VTe:     ml, RR:     b/min, MVe:      l/m"
-                try:
-                    if len(statsaccum) > 18:
-                        signal = np.array(statsaccum)
-                        resp_extrema = biopeaks.resp.resp_extrema(signal, sr)
-                        sigs = signal[resp_extrema]
-                        if len(resp_extrema) > 4:
-                            if sigs[-1] < sigs[-2]:
-                                VTi = sigs[-2] - sigs[-3]
-                                VTe = sigs[-2] - sigs[-1]
-                            else:
-                                VTe = sigs[-3] - sigs[-2]
-                                VTi = sigs[-1] - sigs[-2]
-                            veaccum.append(VTe)
-                            period, rate, tidalAmp = biopeaks.resp.resp_stats(resp_extrema, signal, sr)
-                            avgVTe = sum(veaccum)/len(veaccum)
-                            mve = (rate[-1] * avgVTe)/1000.0
-                            tidal_str = "VTi:{:>4.0f} ml, VTe:{:>4.0f} ml, RR:{:4.1f} b/min, MVe:{:5.1f} l/m".format(VTi, VTe, rate[-1], mve)
-                except:
-                    pass
                 print_t = int(r.t)
                 if(print_t != last_print_t):
                     t_str = "{}  n={:<8d}".format(time.strftime("%H:%M:%S", time.localtime(r.t)), r.n-last_n)
@@ -105,10 +89,10 @@ def format_integrated(integratedReadings, sr=100.0, display_duration=12.0, skip=
                 else:
                     t_str = ""
                 volume = sum(r.dV for r in accum)
-                timet = sum(r.dt for r in accum)
+                timet = sum(r.dT for r in accum)
                 flow = 0 if timet == 0 else (volume / (timet / 60.0)) / 1000
                 templatewidth = 48 + len(tidal_str) +1
-                colwidth = int((screenwidth - templatewidth) / 2)
+                colwidth = max(1, int((screenwidth - templatewidth) / 2))
                 yield u"{:>20}   {:>4.0f} slm   {}   {}   {:>5.0f} ml {:11}".format(
                     t_str,
                     flow,
@@ -139,6 +123,10 @@ def parseArgs():
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "analyze":
+        import analyze
+        return analyze.main(sys.argv[2:])
+
     args = parseArgs()
 
     with args.sensor_class() as s:
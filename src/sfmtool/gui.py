@@ -8,18 +8,39 @@ from sfm3x00 import *
 from HoneywellSSC import *
 from calculations import *
 from VirtualSensor import *
-
-print("splitvent monitoring system by Joe Koberg, March 2020.  https://github.com/jkoberg/splitvent")
-print("This work is provided under a Creative Commons Share Alike 4.0 license.")
-
-import pygame
-from pygame.locals import *
+from lungsim import sim_sensors, parse_settings
+from i2crdwr import rdwr_combined_readings
+from aiosensors import concurrent_combined_readings
+from multirate import stream_multirate
+from shmring import SharedRing, receive_ring
+from binlog import LOG_EXTENSION
+from logwriter import BackgroundLogWriter
+from playback import stream_playback, PlaybackCommand, MIN_SPEED, MAX_SPEED
+from netstream import serve_rings, DEFAULT_PORT
+from trend import TrendStore
+from alarms import AlarmEngine, parse_rules, format_event, event_dict, PRIORITY_HIGH
+import metrics
+from metrics import METRICS, DEPTH_BOUNDS
+import startup
+
+# Worker processes re-import this script as __mp_main__ under forkserver or spawn, but only the display process draws
+DISPLAY_PROCESS = __name__ != "__mp_main__"
+
+if DISPLAY_PROCESS:
+    print("splitvent monitoring system by Joe Koberg, March 2020.  https://github.com/jkoberg/splitvent")
+    print("This work is provided under a Creative Commons Share Alike 4.0 license.")
+
+    import pygame
+    from pygame.locals import *
+    from textcache import SurfaceCache, GlyphAtlas
 
 
 yellow = (224, 224, 95)
 cyan = (127,255,223)
 yellow = (255, 255, 127)
 green = (64,255,64)
+red = (224,32,32)
+orange = (255,160,0)
 background = (0,0,0)
 border = (63,63,63)
 black = (0,0,0)
@@ -27,6 +48,44 @@ black = (0,0,0)
 FONT = "liberationsans"
 ANTIALIAS = True
 
+# Rendered labels shared by every widget; numeric readouts use per-widget GlyphAtlases
+TEXT_CACHE = SurfaceCache(256) if DISPLAY_PROCESS else None
+
+class ColumnDecimator(object):
+    """Min and max of the samples falling in each pixel column of a graph, updated incrementally
+
+    Every sample lands in exactly one column, so a peak lasting a single
+    sample still sets its column's extreme and stays visible. Each column
+    contributes two points, ordered min then max where the column rises and
+    max then min where it falls, so the trace keeps its shape.
+    """
+
+    def __init__(self, n, columns):
+        self.n = n
+        self.columns = columns
+        self.bounds = (np.arange(columns + 1) * n) // columns
+        self.column_of = np.repeat(np.arange(columns), np.diff(self.bounds))
+        self.lo = np.zeros(columns, dtype=np.float32)
+        self.hi = np.zeros(columns, dtype=np.float32)
+        self.values = np.zeros(2 * columns, dtype=np.float32)
+
+    def update(self, values, start=0, stop=None):
+        """Recompute the columns holding samples start..stop-1"""
+        stop = self.n if stop is None else stop
+        if stop <= start:
+            return
+        c0 = self.column_of[start]
+        c1 = self.column_of[stop - 1] + 1
+        b = self.bounds[c0:c1 + 1]
+        seg = values[b[0]:b[-1]]
+        starts = b[:-1] - b[0]
+        lo = self.lo[c0:c1] = np.minimum.reduceat(seg, starts)
+        hi = self.hi[c0:c1] = np.maximum.reduceat(seg, starts)
+        rising = values[b[1:] - 1] >= values[b[:-1]]
+        self.values[2*c0:2*c1:2] = np.where(rising, lo, hi)
+        self.values[2*c0+1:2*c1:2] = np.where(rising, hi, lo)
+
+
 class GraphRenderer(object):
     def __init__(self, minyrange, rect, color, width=3, reflines=[0.0], bordercolor=border, borderwidth=3):
         self.x0, self.y0, self.width, self.height = rect
@@ -39,6 +98,11 @@ class GraphRenderer(object):
         self.rangefont = pygame.font.SysFont(FONT, int(self.height * 0.1))
         self.yrange = minyrange
         self.minyrange = minyrange
+        self.labelrects = []
+        self.last_idx = None
+        self.last_yrange = None
+        self.decimator = None
+        self._pts = None
 
     def render_bg(self, surf):
         surf.fill(black, self.rect)
@@ -57,35 +121,155 @@ class GraphRenderer(object):
         return yoffset - (((v - ymin ) / yscale) * self.height)
 
     def scale_values(self, values, yrange):
-        xstep = self.width / values.size
-        xints = np.arange(0, self.width, xstep, dtype=np.float)[:values.size]
-        xs = xints + self.x0
-        ys = self.scale_y(values, yrange)
-        return np.column_stack((xs, ys))
-
-    def render(self, surf, idx, values, yrange=None):
-        if yrange is None:
-            vmin = min(self.minyrange[0], values.min())
-            vmax = max(self.minyrange[1], values.max())
-            yrange = (vmin, vmax)
-        pts = self.scale_values(values, yrange)
-        prefix = pts[:idx]
-        suffix = pts[idx:]
-
-        ymintxt = self.rangefont.render(" {:.2f}".format(yrange[0]), ANTIALIAS, self.bordercolor, black)
-        surf.blit(ymintxt, ymintxt.get_rect(topleft=self.rect.bottomleft))
-
-        ymaxtxt = self.rangefont.render(" {:.2f}".format(yrange[1]), ANTIALIAS, self.bordercolor, black)
-        surf.blit(ymaxtxt, ymaxtxt.get_rect(bottomleft=self.rect.topleft))
-
+        """Screen points for values, reusing the x coordinates from the previous frame"""
+        if self._pts is None or len(self._pts) != values.size:
+            self._pts = np.zeros((values.size, 2))
+            if self.decimator is None:
+                xstep = self.width / values.size
+                self._pts[:, 0] = np.arange(0, self.width, xstep, dtype=float)[:values.size] + self.x0
+            else:
+                self._pts[:, 0] = np.repeat(np.arange(self.decimator.columns) * (self.width / self.decimator.columns), 2) + self.x0
+        self._pts[:, 1] = self.scale_y(values, yrange)
+        return self._pts
+
+    def decimate(self, values, spans=None):
+        """Bring the per-column min/max up to date when there are more than two samples per pixel column
+
+        `spans` lists the (start, stop) sample ranges written since the last
+        call; None recomputes every column.
+        :return: the values to draw, either the samples or two per column
+        """
+        if values.size <= 2 * self.width:
+            if self.decimator is not None:
+                self.decimator = None
+                self._pts = None
+            return values
+        if self.decimator is None or self.decimator.n != values.size:
+            self.decimator = ColumnDecimator(values.size, self.width)
+            self._pts = None
+            spans = None
+        for start, stop in spans or [(0, values.size)]:
+            self.decimator.update(values, start, stop)
+        return self.decimator.values
+
+    def first_point(self, i):
+        return i if self.decimator is None else 2 * self.decimator.column_of[i]
+
+    def last_point(self, i):
+        return i if self.decimator is None else 2 * self.decimator.column_of[i] + 1
+
+    def gap(self, idx):
+        """Points (start, stop) left undrawn at the write position; a whole column when decimating"""
+        return (idx, idx) if self.decimator is None else (self.first_point(idx), self.last_point(idx) + 1)
+
+    def autorange(self, values):
+        if self.decimator is not None:
+            vmin, vmax = self.decimator.lo.min(), self.decimator.hi.max()
+        else:
+            vmin, vmax = values.min(), values.max()
+        return (float(min(self.minyrange[0], vmin)), float(max(self.minyrange[1], vmax)))
+
+    def range_labels(self, yrange):
+        """Rendered min/max labels, from the shared text cache"""
+        ymintxt = TEXT_CACHE.render(self.rangefont, " {:.2f}".format(yrange[0]), ANTIALIAS, self.bordercolor, black)
+        ymaxtxt = TEXT_CACHE.render(self.rangefont, " {:.2f}".format(yrange[1]), ANTIALIAS, self.bordercolor, black)
+        return [(ymintxt, ymintxt.get_rect(topleft=self.rect.bottomleft)),
+                (ymaxtxt, ymaxtxt.get_rect(bottomleft=self.rect.topleft))]
+
+    def render_reflines(self, surf, area=None):
+        clip = surf.get_clip()
+        surf.set_clip(area or self.rect)
         for refline in self.reflines:
-            y = self.scale_y(refline, yrange)
+            y = self.scale_y(refline, self.last_yrange)
             pygame.draw.line(surf, self.bordercolor, (0, y), (self.width, y), self.borderwidth)
-
+        surf.set_clip(clip)
+
+    def render_trace(self, surf, pts, gap, lo=0, hi=None):
+        """Draw points lo..hi of the trace, broken at the write position gap, clipped to the graph
+
+        The trace is always clipped to the graph rect and never to anything
+        smaller: pygame clips line end points before thickening them, so a
+        segment drawn under a different clip rasterizes differently.
+        """
+        hi = len(pts) if hi is None else hi
+        prefix = pts[lo:min(gap[0], hi)]
+        suffix = pts[max(gap[1], lo):hi]
+        clip = surf.get_clip()
+        surf.set_clip(self.rect)
         if prefix.size > 2:
             pygame.draw.lines(surf, self.color, False, prefix, self.linewidth)
         if suffix.size > 2:
             pygame.draw.lines(surf, self.color, False, suffix, self.linewidth)
+        surf.set_clip(clip)
+
+    def render(self, surf, idx, values, yrange=None):
+        """Draw the whole graph, labels and trace; the caller clears the area first"""
+        drawn = self.decimate(values)
+        yrange = yrange or self.autorange(values)
+        pts = self.scale_values(drawn, yrange)
+        for label, rect in self.range_labels(yrange):
+            surf.blit(label, rect)
+        self.last_yrange = yrange
+        self.render_reflines(surf)
+        self.render_trace(surf, pts, self.gap(idx))
+        self.last_idx = idx
+
+    def render_dirty(self, surf, static, idx, values, yrange=None):
+        """Redraw only what changed since the last call, restoring from the `static` layer
+
+        Samples are written into the ring at idx, so while the y range is
+        unchanged only the strip between the previous and current write
+        positions differs. A new y range redraws the whole graph and labels.
+        :return: list of rects that were redrawn, for pygame.display.update
+        """
+        n = values.size
+        full = self.last_idx is None or (idx - self.last_idx) % n > n // 2 or \
+            (self.decimator is not None and self.decimator.n != n)
+        if full:
+            written = None
+        elif idx >= self.last_idx:
+            written = [(self.last_idx, idx)]
+        else:
+            written = [(self.last_idx, n), (0, idx)]
+        drawn = self.decimate(values, written)
+        yrange = yrange or self.autorange(values)
+        pts = self.scale_values(drawn, yrange)
+        if full or yrange != self.last_yrange:
+            dirty = [self.rect] + self.labelrects
+            surf.blit(static, self.rect, self.rect)
+            for rect in self.labelrects:
+                surf.blit(static, rect, rect)
+            labels = self.range_labels(yrange)
+            for label, rect in labels:
+                surf.blit(label, rect)
+            self.labelrects = [rect for label, rect in labels]
+            self.last_yrange = yrange
+            self.render_reflines(surf)
+            self.render_trace(surf, pts, self.gap(idx))
+            self.last_idx = idx
+            return dirty + self.labelrects
+
+        if idx == self.last_idx:
+            return []
+        # Changed samples run from the previous write position to the current one, possibly wrapping
+        spans = [(self.last_idx - 1, idx)] if idx > self.last_idx else [(self.last_idx - 1, n - 1), (0, idx)]
+        npts = len(pts)
+        pad = self.linewidth + 1
+        # Neighbouring segments reaching into the padding are redrawn too; outside the strip they repaint identical pixels
+        margin = int(2 * pad * npts / self.width) + 2
+        dirty = []
+        for a, b in spans:
+            a = self.first_point(max(a, 0))
+            b = self.last_point(min(b, n - 1))
+            left = int(pts[a][0]) - pad
+            right = int(pts[b][0]) + pad + 1
+            strip = pygame.Rect(left, self.rect.top, right - left, self.rect.height).clip(self.rect)
+            surf.blit(static, strip, strip)
+            self.render_reflines(surf, strip)
+            self.render_trace(surf, pts, self.gap(idx), max(a - margin, 0), min(b + margin + 1, npts))
+            dirty.append(strip)
+        self.last_idx = idx
+        return dirty
 
 
 class TextRectRenderer(object):
@@ -106,6 +290,7 @@ class TextRectRenderer(object):
         self.hB = self.height * 0.25
         self.smallfont = pygame.font.SysFont(FONT, int(self.height * 0.15))
         self.largefont = pygame.font.SysFont(FONT, int(self.height * 0.30))
+        self.digits = GlyphAtlas(self.largefont, fontcolor, bgcolor, ANTIALIAS, fallback=TEXT_CACHE)
         self.headertxt = self.smallfont.render(header, ANTIALIAS,  fontcolor, bgcolor)
         self.unittxt = self.smallfont.render(unit, ANTIALIAS, fontcolor, bgcolor)
         self.C1 = (int(self.width / 2.0), int(self.height/8.0))
@@ -114,6 +299,7 @@ class TextRectRenderer(object):
         self.C3 = (int(self.width / 2.0), int(6.0*self.height/8.0))
         self.headerrect = self.headertxt.get_rect(midleft=self.L1)
         self.unitrect = self.unittxt.get_rect(center=self.C3)
+        self.last_value = None
 
     def render_bg(self, bgsurf):
         self.surf.fill(self.bgcolor)
@@ -125,20 +311,178 @@ class TextRectRenderer(object):
         bgsurf.blit(self.surf, self.rect.topleft)
 
     def render(self, surf, value):
-        value = self.largefont.render(str(value), ANTIALIAS, self.fontcolor, self.bgcolor)
-        surf.blit(value, value.get_rect(center=self.AC2))
+        self.digits.blit(surf, str(value), center=self.AC2)
 
+    def render_dirty(self, surf, value):
+        """Redraw the panel only when its value text has changed; returns the rects redrawn"""
+        value = str(value)
+        if value == self.last_value:
+            return []
+        self.last_value = value
+        surf.blit(self.surf, self.rect.topleft)
+        self.render(surf, value)
+        return [self.rect]
+
+
+
+class AlarmBanner(object):
+    """Strip across the top of the graphs naming the active alarms, colored by the highest priority"""
+
+    def __init__(self, rect):
+        self.rect = rect
+        self.font = pygame.font.SysFont(FONT, int(rect.height * 0.7))
+        self.last_names = None
+
+    def render(self, surf, rules):
+        if not rules:
+            return
+        color = red if rules[0].priority == PRIORITY_HIGH else orange
+        surf.fill(color, self.rect)
+        text = TEXT_CACHE.render(self.font, "  ".join(rule.name.upper() for rule in rules), ANTIALIAS, black, color)
+        surf.blit(text, text.get_rect(midleft=(self.rect.left + self.rect.height // 2, self.rect.centery)))
+
+    def render_dirty(self, surf, static, rules):
+        """Redraw the strip only when the set of active alarms has changed; returns the rects redrawn"""
+        names = [rule.name for rule in rules]
+        if names == self.last_names:
+            return []
+        self.last_names = names
+        surf.blit(static, self.rect, self.rect)
+        self.render(surf, rules)
+        return [self.rect]
+
+
+class PlaybackBar(object):
+    """Progress of log playback along the bottom of the graphs; click or drag on it to seek"""
+
+    def __init__(self, rect):
+        self.rect = rect
+        self.font = pygame.font.SysFont(FONT, int(rect.height * 0.6))
+        self.last = None
+
+    @staticmethod
+    def clock_text(seconds):
+        seconds = int(max(0, seconds))
+        return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+    def fraction_at(self, x):
+        return min(max((x - self.rect.left) / float(self.rect.width), 0.0), 1.0)
+
+    def render(self, surf, position, duration, speed, paused):
+        fraction = min(max(position / duration, 0.0), 1.0) if duration > 0 else 0.0
+        track = pygame.Rect(self.rect.left, self.rect.bottom - 4, self.rect.width, 3)
+        surf.fill(border, track)
+        surf.fill(cyan, pygame.Rect(track.left, track.top, int(track.width * fraction), track.height))
+        text = "{}  {:g}x  {} / {}".format("PAUSED" if paused else "PLAY", speed,
+                                          self.clock_text(position), self.clock_text(duration))
+        surf.blit(self.font.render(text, ANTIALIAS, border, black),
+                  (self.rect.left + self.rect.height // 2, self.rect.top))
+
+    def render_dirty(self, surf, static, position, duration, speed, paused):
+        """Redraw only when the text or the filled part of the track would change; returns the rects redrawn"""
+        key = (int(position), duration, speed, paused, int(self.rect.width * position / duration) if duration > 0 else 0)
+        if key == self.last:
+            return []
+        self.last = key
+        surf.blit(static, self.rect, self.rect)
+        self.render(surf, position, duration, speed, paused)
+        return [self.rect]
+
+
+class TrendGraph(object):
+    """Trends of breath values over hours, drawn in place of a waveform graph
+
+    Each stored bucket is a vertical min-max bar with the means joined by a
+    line, at the finest resolution that gives at most one bucket per two
+    pixel columns.
+    """
+
+    def __init__(self, rect, label, fields, colors, minyrange, width=3):
+        self.rect = rect
+        self.label = label
+        self.fields = fields
+        self.colors = colors
+        self.minyrange = minyrange
+        self.linewidth = width
+        self.font = pygame.font.SysFont(FONT, int(rect.height * 0.1))
+
+    def render(self, surf, static, store, t1, span):
+        """Redraw the whole graph for the `span` seconds up to t1; returns the rects redrawn"""
+        surf.blit(static, self.rect, self.rect)
+        resolution, records = store.query(t1 - span, t1, max_points=self.rect.width // 2)
+        text = "{}  last {}  ({})".format(self.label, format_span(span),
+                                          "per breath" if resolution == 0 else format_span(resolution))
+        surf.blit(TEXT_CACHE.render(self.font, text, ANTIALIAS, border, black), self.rect.topleft)
+        if not records.size:
+            return [self.rect]
+        ymin = min([self.minyrange[0]] + [float(records[f + "_min"].min()) for f in self.fields])
+        ymax = max([self.minyrange[1]] + [float(records[f + "_max"].max()) for f in self.fields])
+        scale = self.rect.height / (ymax - ymin)
+        x = self.rect.left + (records["t"] + resolution / 2.0 - (t1 - span)) * (self.rect.width / span)
+        clip = surf.get_clip()
+        surf.set_clip(self.rect)
+        for field, color in zip(self.fields, self.colors):
+            lo = self.rect.bottom - (records[field + "_min"] - ymin) * scale
+            hi = self.rect.bottom - (records[field + "_max"] - ymin) * scale
+            for xi, a, b in zip(x.tolist(), lo.tolist(), hi.tolist()):
+                pygame.draw.line(surf, border, (xi, a), (xi, b), self.linewidth)
+            if records.size > 1:
+                mean = self.rect.bottom - (records[field + "_mean"] - ymin) * scale
+                pygame.draw.lines(surf, color, False, np.column_stack((x, mean)), self.linewidth)
+        surf.set_clip(clip)
+        return [self.rect]
+
+
+def format_span(seconds):
+    for unit, size in [("d", 86400), ("h", 3600), ("min", 60)]:
+        if seconds >= size and seconds % size == 0:
+            return "{} {}".format(seconds // size, unit)
+    return "{} s".format(seconds)
+
+
+# Spans of history the trend view cycles through; None shows the waveforms
+TREND_SPANS = [None, 3600, 8 * 3600, 24 * 3600, 7 * 24 * 3600]
 
 
 def parseArgs():
-    parser = argparse.ArgumentParser(description='Read data from Sensirion SFM3x00 sensor over I2C.')
+    parser = argparse.ArgumentParser(description='Read data from Sensirion SFM3x00 sensor over I2C.',
+                                     epilog='Press T to cycle the graphs through trends of the last hour, '
+                                            '8 hours, day and week, and back to the waveforms.')
 
     parser.add_argument("--fake", dest='sensor_classes',
                         action='store_const', const=(FakeFlow, FakePressure), default=(SFM3x00, HoneywellSSC),
                         help='Use synthetic sensor data for demo')
 
+    parser.add_argument("--sim", dest='sim', nargs='?', const="", default=None, metavar="SETTINGS",
+                        help='Use a simulated ventilated lung, e.g. --sim "vc,rr=20,vt=450,c=40,leak=2"')
+
+    parser.add_argument("--rdwr", dest='combiner',
+                        action='store_const', const=rdwr_combined_readings, default=combined_readings,
+                        help='Read flow and pressure with one combined I2C_RDWR transaction per sample')
+
+    parser.add_argument("--concurrent", dest='combiner',
+                        action='store_const', const=concurrent_combined_readings,
+                        help='Read flow and pressure concurrently when they are on different I2C buses')
+
     parser.add_argument("--samplerate", dest='sample_rate', type=float, default=50.0,
-                        help='Flow measurement sampling rate')
+                        help='Flow measurement sampling rate, or with --flowrate the display and breath analysis rate')
+
+    parser.add_argument("--flowrate", dest='flow_rate', type=float, default=None,
+                        help='Sample and integrate flow at this rate (e.g. 1000), a whole multiple of --samplerate, '
+                             'then decimate to --samplerate')
+
+    parser.add_argument("--pressurerate", dest='pressure_rate', type=float, default=None,
+                        help='With --flowrate, sample pressure at this rate; FLOWRATE must be a whole multiple of it')
+
+    parser.add_argument("--spin", dest='spin', type=float, default=0.0,
+                        help='Busy-wait for the last SPIN seconds before each sample instead of sleeping, '
+                             'for steadier timing at high sampling rates (e.g. 0.0002)')
+
+    parser.add_argument("--overrun", dest='overrun', choices=OVERRUN_POLICIES, default=OVERRUN_SKIP,
+                        help='After a read overruns the next sample time, skip the missed samples or catch up on them')
+
+    parser.add_argument("--timerfd", dest='timer', action='store_const', const=True, default=False,
+                        help='Wait for each sample on a Linux timerfd instead of sleeping')
 
     parser.add_argument("--duration", dest='display_duration', type=float, default=15.0,
                         help='number of seconds of readings to display')
@@ -146,26 +490,78 @@ def parseArgs():
     parser.add_argument("--log", dest='log_data', action='store_const', const=True, default=False,
                         help='Write data to logfile')
 
+    parser.add_argument("--log-rotate-mb", dest='log_rotate_mb', type=float, default=None, metavar="MB",
+                        help='Start a new log segment once one reaches MB megabytes')
+
+    parser.add_argument("--log-rotate-minutes", dest='log_rotate_minutes', type=float, default=60.0, metavar="MIN",
+                        help='Start a new log segment every MIN minutes of samples (0 never)')
+
+    parser.add_argument("--log-compress", dest='log_compress', choices=["gzip", "zstd"], default=None,
+                        help='Compress each log segment once it is finished')
+
+    parser.add_argument("--log-fsync", dest='log_fsync', type=float, default=1.0, metavar="SECONDS",
+                        help='Flush the log to storage at most every SECONDS (0 after every batch)')
+
     parser.add_argument("--quiet", dest='quiet', action='store_const', const=True, default=False,
                         help="Don't update display")
 
+    parser.add_argument("--fullredraw", dest='full_redraw', action='store_const', const=True, default=False,
+                        help="Redraw and update the whole screen every frame instead of only what changed")
+
+    parser.add_argument("--fps", dest='show_fps', action='store_const', const=True, default=False,
+                        help="Show and print the frame rate and frame times")
+
+    parser.add_argument("--stats", dest='stats', default=None, metavar="FILE",
+                        help="Append timing, jitter and backlog statistics of every process to FILE as JSON lines "
+                             "(summarize with metrics.py)")
+
+    parser.add_argument("--stats-interval", dest='stats_interval', type=float, default=10.0,
+                        help="Seconds between --stats snapshots")
+
+    parser.add_argument("--start-method", dest='start_method', choices=["forkserver", "fork", "spawn"],
+                        default="forkserver",
+                        help="How to start the worker processes; forkserver starts them from preloaded modules")
+
+    parser.add_argument("--startup-profile", dest='startup_profile', nargs='?', const="startup_profile.jsonl",
+                        default=None, metavar="FILE",
+                        help="Record when each process reaches each startup milestone in FILE, and print the "
+                             "timeline once the first waveform is drawn")
+
     parser.add_argument("--width", dest='req_w', default=1280, type=int, help="Requested display width")
 
     parser.add_argument("--height", dest='req_h', default=720, type=int, help="Requested display height")
 
-    parser.add_argument("--readlog", dest='read_log', default=None, help="Read sensor data from log file")
+    parser.add_argument("--serve", dest='serve_port', nargs='?', type=int, const=DEFAULT_PORT, default=None, metavar="PORT",
+                        help="Also stream waveforms and breaths to network subscribers (see netstream.py)")
+
+    parser.add_argument("--alarm", dest='alarms', action='append', default=None, metavar="RULE",
+                        help='Add or replace an alarm rule, e.g. "high_pressure: cmH2O > 35 latch" (see alarms.py); '
+                             '"name: off" removes one. Press A to acknowledge latched alarms')
+
+    parser.add_argument("--readlog", dest='read_log', default=None,
+                        help="Play back a recorded log (or the segments of a rotated one). Space pauses, "
+                             "left/right seek 10 s (with shift 5 min), up/down change speed, home/end jump, "
+                             "and clicking the bar at the bottom seeks")
 
     #parser.add_argument("--sscrange", dest='ssc_range_code', default='015PG', type=str, help="Honeywell SSC sensor range code")
 
     #parser.add_argument("--sscxfer", dest='ssc_xfer_func', default='A', type=str, help="Honeywell SSC sensor transfer function code")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.combiner is rdwr_combined_readings and (args.sim is not None or args.sensor_classes != (SFM3x00, HoneywellSSC)):
+        # Synthetic sensors have no I2C address to read in a combined transaction
+        parser.error("--rdwr reads real sensors over I2C and cannot be used with --fake or --sim")
+    if args.flow_rate is not None and args.combiner is not combined_readings:
+        # Multi-rate acquisition reads pressure less often than flow, so it has its own reader
+        parser.error("--rdwr and --concurrent read flow and pressure together and cannot be used with --flowrate")
+    return args
 
 
 
-def guiMain(args):
+def guiMain(args, ctx=mp):
     pygame.display.set_caption("splitvent")
     screen = pygame.display.set_mode((args.req_w, args.req_h))
+    startup.mark("display ready")
     size = screen.get_rect().size
     width, height = size
 
@@ -174,11 +570,10 @@ def guiMain(args):
 
     datalen = int(args.sample_rate * args.display_duration)
 
-    fpstimes = CircularBuffer(10)
-    srtimes = CircularBuffer(int(args.sample_rate))
-    flowPoints = CircularBuffer(datalen)
-    volPoints = CircularBuffer(datalen)
-    pressPoints = CircularBuffer(datalen)
+    fpstimes = CircularBuffer(60, np.float64)
+    frametimes = CircularBuffer(60)
+    srtimes = CircularBuffer(int(args.sample_rate), np.float64)
+    waveforms = CircularBuffer(datalen, WAVEFORM_DTYPE)
 
     linewidth = int(height / 200.)
     wstep = int(width / 12.)
@@ -196,6 +591,16 @@ def guiMain(args):
     vteText =    TextRectRenderer(pygame.Rect(graphWidth, hstep*6.5,  textWidth, hstep*2.5), "VTe",  "ml",     fontcolor=cyan,   borderwidth=linewidth)
     vtitext =    TextRectRenderer(pygame.Rect(graphWidth, hstep*9,    textWidth, hstep*1.5), "VTi",  "ml",     fontcolor=cyan,   borderwidth=linewidth)
     mvetext =    TextRectRenderer(pygame.Rect(graphWidth, hstep*10.5, textWidth, hstep*1.5), "MVe",  "l/min",  fontcolor=cyan,   borderwidth=linewidth)
+    alarmBanner = AlarmBanner(pygame.Rect(0, 0, graphWidth, int(hstep*0.5)))
+    alarmRules = parse_rules(args.alarms)
+    alarms = AlarmEngine(alarmRules, args.sample_rate)
+    trends = TrendStore()
+    trendGraphs = [
+        TrendGraph(pressGraph.rect, "Ppk / PEEP", ["PPk", "PEEP"], [yellow, orange], (0, 35), linewidth),
+        TrendGraph(flowGraph.rect, "RR", ["RR"], [green], (0, 30), linewidth),
+        TrendGraph(volGraph.rect, "VTe", ["VTe"], [cyan], (0, 600), linewidth),
+    ]
+    playbackBar = PlaybackBar(pygame.Rect(0, hstep*11.5, graphWidth, int(hstep*0.5))) if args.read_log else None
 
     widgets = [
         pressGraph,
@@ -214,106 +619,258 @@ def guiMain(args):
 
     #pygame.draw.line(bg, border, (0, hstep*6), (graphWidth, hstep*6), linewidth)
 
+    # Borders, headers and units never change, so they are composited once
+    static = pygame.Surface(size)
+    static.fill(black)
     for widget in widgets:
-        widget.render_bg(screen)
-
-    #currentbg = bg
-    #screen.blit(currentbg, (0,0))
+        widget.render_bg(static)
 
+    screen.blit(static, (0, 0))
     pygame.display.update()
-    
-    resultq = mp.Queue()
-    tidalInputQueue = mp.Queue()
-    tidalOutputQueue = mp.Queue()
-    finishq = mp.Queue()
 
-    flowClass, pressureClass = args.sensor_classes
+    fpsfont = pygame.font.SysFont(FONT, int(hstep * 0.3))
+    fpsrect = None
+    t_fps = time.time()
 
-    sensorChildProcess = mp.Process(
-        target = stream_readings,
-        args = (flowClass, pressureClass, args.sample_rate, resultq, tidalInputQueue, finishq)
-        )
+    if args.stats:
+        metrics.enable(args.stats, args.stats_interval)
+    backlog = METRICS.histogram("gui.backlog", DEPTH_BOUNDS)
+    frame_ms = METRICS.histogram("gui.frame_ms")
+    sensor_to_pixel_ms = METRICS.histogram("gui.sensor_to_pixel_ms")
+
+    ring = SharedRing(datalen * 2)
+    cursor = ring.cursor()
+    tidalOutputQueue = ctx.Queue()
+    finishq = ctx.Queue()
+
+    flowClass, pressureClass = args.sensor_classes
+    if args.sim is not None:
+        flowClass, pressureClass = sim_sensors(parse_settings(args.sim))
+
+    schedule = dict(spin=args.spin, overrun=args.overrun, timer=args.timer)
+    controlq = ctx.Queue()
+    if args.read_log is not None:
+        sensorChildProcess = ctx.Process(
+            target = stream_playback,
+            args = (args.read_log, args.sample_rate, ring, finishq, controlq)
+            )
+    elif args.flow_rate is not None:
+        sensorChildProcess = ctx.Process(
+            target = stream_multirate,
+            args = (flowClass, pressureClass, args.flow_rate, args.pressure_rate or args.flow_rate, args.sample_rate,
+                    ring, finishq, schedule)
+            )
+    else:
+        sensorChildProcess = ctx.Process(
+            target = stream_readings,
+            args = (flowClass, pressureClass, args.sample_rate, ring, finishq, args.combiner, schedule)
+            )
     sensorChildProcess.start()
 
-    tidalCalcsChildProcess = mp.Process(
+    tidalCalcsChildProcess = ctx.Process(
         target = tidalcalcs,
-        args = (datalen*2, args.sample_rate, tidalInputQueue, finishq, tidalOutputQueue)
+        args = (args.sample_rate, ring, finishq, tidalOutputQueue)
         )
     tidalCalcsChildProcess.start()
 
+    serverChildProcess = None
+    if args.serve_port is not None:
+        serverChildProcess = ctx.Process(target = serve_rings, args = ([ring], "0.0.0.0", args.serve_port, 256, None, args.alarms))
+        serverChildProcess.start()
+    startup.mark("workers started")
+
+    logfile = None
+    alarmlog = None
     try:
         print("Formatter, sr={}, datalen={}".format(args.sample_rate, datalen))
-        if args.log_data:
-            datestr = time.strftime("%Y%m%d_%H%M%S", time.localtime(time.time()))
-            filename = "splitvent-{}hz-{}.log".format(int(args.sample_rate), datestr)
-            logfile = open(filename, "w")
-            print("logging to " + filename)
-        else:
-            logfile = None
 
-        integrated_groups = receive_readings(resultq)
+        # Playback may be paused, so keep drawing and reading the controls while no samples arrive
+        integrated_groups = receive_ring(cursor, idle=0.05 if args.read_log else None)
+        speed = 1.0
+        paused = False
+        position = 0.0
 
         keepRunning = True
         n = 0
         frames = 0
         t0 = None
         tidal = None
+        trendSpan = None
+        trendChanged = False
+        t_last = None
+        overruns = 0
         for group in integrated_groups:
-            for r in group:
-                srtimes.append(r.t)
-                if t0 is None:
-                    t0 = r.t
-                if logfile is not None:
-                    logfile.write('{{"t":{:.6f}, "slm":{:.2f}, "cmH2O": {:.2f}}}\n'.format(r.t-t0, r.slm, r.cmH2O))
-                flowPoints.append(r.slm)
-                volPoints.append(r.V)
-                pressPoints.append(r.cmH2O)
-                n = n + 1
+            srtimes.extend(group["t"])
+            backlog.observe(group.size)
+            if t0 is None and group.size:
+                t0 = float(group["t"][0])
+                if args.log_data:
+                    datestr = time.strftime("%Y%m%d_%H%M%S", time.localtime(t0))
+                    filename = "splitvent-{}hz-{}{}".format(int(args.sample_rate), datestr, LOG_EXTENSION)
+                    logfile = BackgroundLogWriter(
+                        filename, dict({"sample_rate": args.sample_rate}, **dict(ring.meta(), t0=t0)),
+                        max_bytes=int(args.log_rotate_mb * 1e6) if args.log_rotate_mb else None,
+                        max_seconds=args.log_rotate_minutes * 60.0 if args.log_rotate_minutes else None,
+                        compress=args.log_compress, fsync_seconds=args.log_fsync)
+                    alarmlog = open(filename[:-len(LOG_EXTENSION)] + ".alarms.jsonl", "a")
+                    print("logging to " + filename)
+            if logfile is not None:
+                logfile.write_readings(group["t"] - t0, group["slm"], group["cmH2O"])
+            events = []
+            # A playback seek jumps the time stamps; the alarm timers start afresh there
+            for start, stop, restart in continuous_spans(group["t"], t_last):
+                if restart:
+                    alarms = AlarmEngine(alarmRules, args.sample_rate)
+                span = group[start:stop]
+                events.extend(alarms.process(span["t"], span["slm"], span["cmH2O"], span["V"]))
+            if group.size:
+                t_last = float(group["t"][-1])
+            if playbackBar is not None and group.size:
+                position = t_last - ring.meta().get("t0", 0.0)
+            n = n + group.size
+            waveforms.extend(group[list(WAVEFORM_DTYPE.names)])
+            if cursor.overruns != overruns:
+                print("Warning: display fell behind, {} samples dropped".format(cursor.overruns - overruns))
+                overruns = cursor.overruns
 
             while not tidalOutputQueue.empty():
-                tidal = tidalOutputQueue.get()
-
-            #screen.blit(currentbg, (0,0))
-            for widget in widgets:
-                widget.render_bg(screen)
+                t_tidal, tidal = tidalOutputQueue.get()
+                trends.add(t_tidal, tidal)
+                trendChanged = True
 
+            frame_t0 = time.perf_counter()
             fpstimes.append(time.time())
-
-            flowGraph.render(screen, flowPoints.idx, flowPoints.arr)
-            volGraph.render(screen, volPoints.idx, volPoints.arr)
-            pressGraph.render(screen, pressPoints.idx, pressPoints.arr)
-
+            values = []
             if tidal is not None:
-                #currentbg = bg.copy()
-                #fps = (len(fpstimes) - 1) / (fpstimes[-1] - fpstimes[0])
-                #srcomputed = (len(srtimes) - 1) / (srtimes[-1] - srtimes[0])
-                #fpsmsg = "{:4.0f} fps n={:10d} g={} sr={:.2f}".format(fps, n, len(group), srcomputed)
-                #textsurf = font.render(
-                #    fpsmsg,
-                #    ANTIALIAS,
-                #    (255,255,255),
-                #    (0,0,0)
-                #)
-                #print(fpsmsg)
-                #screen.blit(textsurf, (0,0))
-                #flowGraph.render_bg(currentbg)
-                #volGraph.render_bg(currentbg)
-                pressTest.render(screen, "{:5.1f}".format(tidal.PPk))
-                peepText.render(screen, "{:5.1f}".format(tidal.PEEP))
-                rrText.render(screen, "{:5.1f}".format(tidal.RR))
-                vteText.render(screen,"{:5.0f}".format(tidal.VTe))
-                vtitext.render(screen, "{:5.0f}".format(tidal.VTi))
-                mvetext.render(screen, "{:5.1f}".format(tidal.MVe))
+                values = [
+                    (pressTest, "{:5.1f}".format(tidal.PPk)),
+                    (peepText, "{:5.1f}".format(tidal.PEEP)),
+                    (rrText, "{:5.1f}".format(tidal.RR)),
+                    (vteText, "{:5.0f}".format(tidal.VTe)),
+                    (vtitext, "{:5.0f}".format(tidal.VTi)),
+                    (mvetext, "{:5.1f}".format(tidal.MVe)),
+                ]
+
+            if args.full_redraw:
+                screen.blit(static, (0, 0))
+                if trendSpan is None:
+                    flowGraph.render(screen, waveforms.idx, waveforms.arr["slm"])
+                    volGraph.render(screen, waveforms.idx, waveforms.arr["V"])
+                    pressGraph.render(screen, waveforms.idx, waveforms.arr["cmH2O"])
+                elif t_last is not None:
+                    for trendGraph in trendGraphs:
+                        trendGraph.render(screen, static, trends, t_last, trendSpan)
+                for widget, value in values:
+                    widget.render(screen, value)
+                alarmBanner.render(screen, alarms.active())
+                dirty = None
+            else:
+                if trendSpan is None:
+                    dirty = flowGraph.render_dirty(screen, static, waveforms.idx, waveforms.arr["slm"])
+                    dirty += volGraph.render_dirty(screen, static, waveforms.idx, waveforms.arr["V"])
+                    dirty += pressGraph.render_dirty(screen, static, waveforms.idx, waveforms.arr["cmH2O"])
+                else:
+                    # Trends change only with each breath; the waveform graphs redraw in full when shown again
+                    dirty = []
+                    if trendChanged and t_last is not None:
+                        for graph, trendGraph in zip([pressGraph, flowGraph, volGraph], trendGraphs):
+                            for rect in graph.labelrects:
+                                screen.blit(static, rect, rect)
+                            dirty += graph.labelrects + trendGraph.render(screen, static, trends, t_last, trendSpan)
+                            graph.labelrects = []
+                            graph.last_idx = None
+                        trendChanged = False
+                for widget, value in values:
+                    dirty += widget.render_dirty(screen, value)
+                dirty += alarmBanner.render_dirty(screen, static, alarms.active())
+            if playbackBar is not None and ring.write_count:
+                meta = ring.meta()
+                elapsed = position - meta["playback_start"]
+                duration = meta["playback_end"] - meta["playback_start"]
+                if dirty is None:
+                    playbackBar.render(screen, elapsed, duration, speed, paused)
+                else:
+                    dirty += playbackBar.render_dirty(screen, static, elapsed, duration, speed, paused)
+
+            tick = fpstimes.last(1)[0] - t_fps >= 1.0
+            if tick:
+                t_fps = fpstimes.last(1)[0]
+                stamps = fpstimes.last(fpstimes.count)
+                fps = (stamps.size - 1) / (stamps[-1] - stamps[0]) if stamps.size > 1 else 0.0
+                stamps = srtimes.last(srtimes.count)
+                sr = (stamps.size - 1) / (stamps[-1] - stamps[0]) if stamps.size > 1 else 0.0
+                METRICS.gauge("gui.fps").set(fps)
+                METRICS.gauge("gui.sample_rate").set(sr)
+                METRICS.gauge("gui.overruns").set(cursor.overruns)
+
+            if args.show_fps and tick:
+                ms = frametimes.last(frametimes.count) * 1000.0
+                fpsmsg = "{:4.0f} fps  {:5.2f} ms/frame  max {:5.2f} ms  {:5.1f} Hz".format(
+                    fps, float(ms.mean()), float(ms.max()), sr)
+                glyphs = [w.digits.stats() for w in widgets if hasattr(w, "digits")]
+                print("{}  text cache {hits} hits {misses} misses {size}/{maxsize}, glyphs {} hits {} misses".format(
+                    fpsmsg, sum(s["hits"] for s in glyphs), sum(s["misses"] for s in glyphs), **TEXT_CACHE.stats()))
+                fpssurf = fpsfont.render(fpsmsg, ANTIALIAS, border, black)
+                if fpsrect is not None:
+                    screen.blit(static, fpsrect, fpsrect)
+                    if dirty is not None:
+                        dirty.append(fpsrect)
+                fpsrect = fpssurf.get_rect(bottomright=(graphWidth, height))
+                screen.blit(fpssurf, fpsrect)
+                if dirty is not None:
+                    dirty.append(fpsrect)
+            elif args.full_redraw and fpsrect is not None:
+                screen.blit(fpssurf, fpsrect)
 
             if not args.quiet:
-                pygame.display.update()
-                screen.fill(black)
+                if dirty is None:
+                    pygame.display.update()
+                elif dirty:
+                    pygame.display.update(dirty)
+            if frames == 0 and args.startup_profile:
+                startup.mark("first waveform")
+                startup.report()
+            frametimes.append(time.perf_counter() - frame_t0)
+            frame_ms.observe(frametimes.last(1)[0] * 1000.0)
+            if group.size and args.read_log is None:
+                # Recorded time stamps are not comparable with the wall clock
+                sensor_to_pixel_ms.observe((time.time() - float(group["t"][-1])) * 1000.0)
+            METRICS.maybe_dump()
 
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     keepRunning = False
                 elif event.type == pygame.KEYDOWN and event.key in [pygame.K_ESCAPE, pygame.K_q]:
                     keepRunning = False
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_a:
+                    events.extend(alarms.acknowledge())
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_t:
+                    trendSpan = TREND_SPANS[(TREND_SPANS.index(trendSpan) + 1) % len(TREND_SPANS)]
+                    trendChanged = True
+                elif playbackBar is not None:
+                    command = None
+                    if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
+                        paused = not paused
+                        command = PlaybackCommand("pause" if paused else "resume", None)
+                    elif event.type == pygame.KEYDOWN and event.key in [pygame.K_LEFT, pygame.K_RIGHT]:
+                        step = 300.0 if event.mod & pygame.KMOD_SHIFT else 10.0
+                        command = PlaybackCommand("scrub", step if event.key == pygame.K_RIGHT else -step)
+                    elif event.type == pygame.KEYDOWN and event.key in [pygame.K_UP, pygame.K_DOWN]:
+                        speed = min(max(speed * (2.0 if event.key == pygame.K_UP else 0.5), MIN_SPEED), MAX_SPEED)
+                        command = PlaybackCommand("speed", speed)
+                    elif event.type == pygame.KEYDOWN and event.key in [pygame.K_HOME, pygame.K_END]:
+                        command = PlaybackCommand("fraction", 0.0 if event.key == pygame.K_HOME else 1.0)
+                    elif ((event.type == pygame.MOUSEBUTTONDOWN and event.button == 1) or
+                          (event.type == pygame.MOUSEMOTION and event.buttons[0])) and playbackBar.rect.collidepoint(event.pos):
+                        command = PlaybackCommand("fraction", playbackBar.fraction_at(event.pos[0]))
+                    if command is not None:
+                        controlq.put(command)
+
+            for event in events:
+                print(format_event(event))
+                if alarmlog is not None:
+                    alarmlog.write(json.dumps(event_dict(event)) + "\n")
+                    alarmlog.flush()
 
             if not keepRunning:
                 break
@@ -324,11 +881,25 @@ def guiMain(args):
         finishq.put("Finish")
         sensorChildProcess.join()
         tidalCalcsChildProcess.join()
+        if serverChildProcess is not None:
+            serverChildProcess.join()
+        ring.close()
+        METRICS.dump()
+        if logfile is not None:
+            logfile.close()
+        if alarmlog is not None:
+            alarmlog.close()
 
 
 if __name__=="__main__":
+    args = parseArgs()
+    if args.startup_profile:
+        startup.begin(args.startup_profile)
+        startup.mark("imports done")
+    # Started now, the forkserver preloads the worker modules while the display initializes
+    ctx = startup.worker_context(args.start_method)
     try:
         pygame.init()
-        guiMain(parseArgs())
+        guiMain(args, ctx)
     finally:
         pygame.quit()
@@ -0,0 +1,157 @@
+import os, sys, time, ctypes, fcntl, struct
+
+from sfm3x00 import *
+from HoneywellSSC import *
+from calculations import FlowPressureReading, sensor_info
+from metrics import METRICS
+
+
+"""Combined I2C transactions: read every sensor on a bus with one I2C_RDWR ioctl
+
+The plain driver path costs an ioctl(I2C_SLAVE) plus a read() syscall per
+device per sample. Here the read messages for all devices are prebuilt once and
+handed to the kernel in one I2C_RDWR call, with the SFM3x00 CRC checked inline.
+"""
+
+I2C_RDWR = 0x0707  #  Linux Kernel Constant for combined transactions on /dev/i2c-*
+I2C_M_RD = 0x0001
+
+
+class i2c_msg(ctypes.Structure):
+    """struct i2c_msg from linux/i2c.h"""
+    _fields_ = [
+        ("addr", ctypes.c_uint16),
+        ("flags", ctypes.c_uint16),
+        ("len", ctypes.c_uint16),
+        ("buf", ctypes.POINTER(ctypes.c_uint8)),
+    ]
+
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+    """struct i2c_rdwr_ioctl_data from linux/i2c-dev.h"""
+    _fields_ = [
+        ("msgs", ctypes.POINTER(i2c_msg)),
+        ("nmsgs", ctypes.c_uint32),
+    ]
+
+
+class I2CBatchReader(object):
+    """Read raw counts from several already-prepared sensors on one bus in a single syscall
+
+    Each device needs an `address`, a `RAW_READ_LEN`, a `decode_raw(bytes)` and a
+    `scale_value(raw)`, as SFM3x00 and HoneywellSSC provide. The `ioctl`
+    argument allows a mocked ioctl layer to stand in for the kernel.
+    """
+
+    def __init__(self, devices, bus=RASPI_DEFAULT_I2C_BUS, ioctl=fcntl.ioctl, device=None):
+        self.devices = list(devices)
+        self.ioctl = ioctl
+        self._device = device if device is not None else open('/dev/i2c-{0}'.format(bus), 'r+b', buffering=0)
+        self.buffers = [(ctypes.c_uint8 * d.RAW_READ_LEN)() for d in self.devices]
+        self.msgs = (i2c_msg * len(self.devices))()
+        for msg, d, buf in zip(self.msgs, self.devices, self.buffers):
+            msg.addr = d.address & 0x7F
+            msg.flags = I2C_M_RD
+            msg.len = d.RAW_READ_LEN
+            msg.buf = ctypes.cast(buf, ctypes.POINTER(ctypes.c_uint8))
+        self.request = i2c_rdwr_ioctl_data(ctypes.cast(self.msgs, ctypes.POINTER(i2c_msg)), len(self.devices))
+
+    def close(self):
+        if self._device is not None:
+            self._device.close()
+            self._device = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def transfer(self):
+        """Issue the combined transaction and return the response bytes for each device"""
+        assert self._device is not None, 'Bus must be opened before operations are made against it!'
+        self.ioctl(self._device.fileno(), I2C_RDWR, self.request)
+        return [bytes(buf) for buf in self.buffers]
+
+    def read_raw_batch(self):
+        """Return raw counts for all devices, in the order they were given"""
+        return [d.decode_raw(b) for d, b in zip(self.devices, self.transfer())]
+
+    def read_scaled_batch(self):
+        return [d.scale_value(raw) for d, raw in zip(self.devices, self.read_raw_batch())]
+
+
+def rdwr_combined_readings(flowClass, pressureClass, info=None, bus=RASPI_DEFAULT_I2C_BUS):
+    """Like combined_readings, but flow and pressure are fetched with one I2C_RDWR syscall per sample"""
+    with flowClass() as s:
+        with pressureClass() as p:
+            if info is not None:
+                info.update(sensor_info(s, p))
+            s.prepare()
+            p.prepare()
+            with I2CBatchReader([s, p], bus) as batch:
+                # Both devices are read in one transaction, so their latency is measured together
+                read_batch = METRICS.histogram("read.batch_ms")
+                while True:
+                    t0 = time.perf_counter()
+                    slm, cmH2O = batch.read_scaled_batch()
+                    read_batch.observe((time.perf_counter() - t0) * 1000.0)
+                    yield FlowPressureReading(slm, cmH2O)
+
+
+def check():
+    """Decode a batch from a mocked ioctl, then check that a corrupted SFM3x00 CRC is counted and the last value held
+
+    Runs without I2C hardware: the devices are never opened, and the mocked
+    ioctl fills each message buffer with the response of the device at its address.
+    :return: A list of failures, empty if all is well
+    """
+    flow = SFM3x00(bus=None)
+    flow.offset, flow.scale = 32768.0, 120.0
+    pressure = HoneywellSSC(bus=None)
+    flow_raw, pressure_raw = 32768 + 120 * 25, 0x2000
+    word = struct.pack(">H", flow_raw)
+    responses = {flow.address: word + bytes([sensirion_crc8(word)]), pressure.address: struct.pack(">H", pressure_raw)}
+    calls = []
+
+    def ioctl(fd, request, data):
+        calls.append(request)
+        for i in range(data.nmsgs):
+            msg = data.msgs[i]
+            response = responses[msg.addr]
+            assert msg.flags == I2C_M_RD and msg.len == len(response)
+            ctypes.memmove(msg.buf, response, msg.len)
+
+    failures = []
+    with I2CBatchReader([flow, pressure], ioctl=ioctl, device=open(os.devnull, "r+b", buffering=0)) as batch:
+        raw = batch.read_raw_batch()
+        if raw != [flow_raw, pressure_raw]:
+            failures.append("raw batch {} != {}".format(raw, [flow_raw, pressure_raw]))
+        scaled = batch.read_scaled_batch()
+        expected = [flow.scale_value(flow_raw), pressure.scale_value(pressure_raw)]
+        if scaled != expected:
+            failures.append("scaled batch {} != {}".format(scaled, expected))
+        if calls != [I2C_RDWR, I2C_RDWR]:
+            failures.append("expected one I2C_RDWR per batch, got {}".format(calls))
+        errors = flow.crc_errors.value
+        bad = struct.pack(">H", flow_raw + 1)
+        responses[flow.address] = bad + bytes([sensirion_crc8(bad) ^ 0x01])
+        raw = batch.read_raw_batch()
+        if raw != [flow_raw, pressure_raw]:
+            failures.append("corrupted response gave {}, not the last good {}".format(raw, [flow_raw, pressure_raw]))
+        if flow.crc_errors.value != errors + 1:
+            failures.append("a corrupted CRC was not counted")
+    return failures
+
+
+def main():
+    failures = check()
+    for failure in failures:
+        print("FAIL: " + failure)
+    print("I2C_RDWR batch check {}".format("failed" if failures else "passed"))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
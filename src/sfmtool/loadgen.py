@@ -0,0 +1,162 @@
+import time, argparse, asyncio
+import multiprocessing as mp
+
+import numpy as np
+
+from calculations import BlockIntegrator, BreathDetector
+from shmring import INTEGRATED_DTYPE
+from lungsim import LungSimulator, parse_settings
+from netstream import StreamServer
+from alarms import AlarmEngine, parse_rules
+from aggregator import Aggregator, BreathStore
+
+
+"""Load generator impersonating many splitvent units on loopback
+
+Each simulated unit is a netstream StreamServer on its own port, streaming
+one simulated patient in real time exactly as a unit would: samples are
+timestamped with the wall clock, integrated, and run through breath detection
+and the default alarm rules before they are published. All the patients of
+one process are stepped together by a single LungSimulator; --procs spreads
+the units over several processes. With --aggregate an Aggregator follows every unit from this
+process and prints its ingest throughput and latency.
+"""
+
+
+async def generate(settings, sr, host, first_port, maxframes=256, batch=0.1, seed=None, duration=None, ready=None):
+    """Serve len(settings) simulated units on consecutive ports until `duration` has passed"""
+    nodes = len(settings)
+    servers = [StreamServer([{"channel": 0, "name": "sim{}".format(first_port + i), "sample_rate": sr,
+                              "sensors": {"sample_rate": sr, "flow_sensor": "SimFlow", "pressure_sensor": "SimPressure",
+                                          "sim_settings": settings[i]._asdict()}}], maxframes)
+               for i in range(nodes)]
+    listeners = [await asyncio.start_server(server.handle, host, first_port + i) for i, server in enumerate(servers)]
+    if ready is not None:
+        ready.put(nodes)
+    sim = LungSimulator(settings, sr, seed, t0=time.time())
+    integrators = [BlockIntegrator(sr) for i in range(nodes)]
+    detectors = [BreathDetector() for i in range(nodes)]
+    rules = parse_rules()
+    alarms = [AlarmEngine(rules, sr) for i in range(nodes)]
+    t_end = None if duration is None else sim.t0 + duration
+    t_report = time.time()
+    try:
+        while t_end is None or time.time() < t_end:
+            await asyncio.sleep(batch)
+            due = int((time.time() - sim.t0) * sr) - sim.n
+            if due <= 0:
+                continue
+            t, slm, cmH2O = sim.block(due)
+            n = np.arange(sim.n - t.size, sim.n)
+            dT = np.full(t.size, sim.dt)
+            for i, server in enumerate(servers):
+                iv = integrators[i].process(n, t, dT, slm[i], cmH2O[i])
+                records = np.empty(iv.n.size, dtype=INTEGRATED_DTYPE)
+                for name in INTEGRATED_DTYPE.names:
+                    records[name] = getattr(iv, name)
+                server.publish_waveform(0, records)
+                for bt, tidal in detectors[i].process(iv.t, iv.V, iv.cmH2O):
+                    server.publish_tidal(0, bt, tidal)
+                for event in alarms[i].process(iv.t, iv.slm, iv.cmH2O, iv.V):
+                    server.publish_alarm(0, event)
+            if time.time() - t_report >= 1.0:
+                t_report = time.time()
+                for server in servers:
+                    server.report()
+    finally:
+        for listener in listeners:
+            listener.close()
+
+
+def run_generator(settings, sr, host, first_port, maxframes, batch, seed, duration, ready=None):
+    """Process entry point for generate()"""
+    try:
+        asyncio.run(generate(settings, sr, host, first_port, maxframes, batch, seed, duration, ready))
+    except KeyboardInterrupt:
+        pass
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Impersonate many splitvent units streaming simulated patients.')
+
+    parser.add_argument("--nodes", dest='nodes', type=int, default=100,
+                        help='Number of simulated units')
+
+    parser.add_argument("--procs", dest='procs', type=int, default=1,
+                        help='Processes to spread the units over')
+
+    parser.add_argument("--sim", dest='specs', action='append', default=None,
+                        help='Ventilator settings, e.g. "vc,rr=20"; repeat for a mix of patients')
+
+    parser.add_argument("--samplerate", dest='sample_rate', type=float, default=100.0,
+                        help='Sampling rate of each unit')
+
+    parser.add_argument("--batch", dest='batch', type=float, default=0.1,
+                        help='Seconds of samples per published frame')
+
+    parser.add_argument("--host", dest='host', default="127.0.0.1", help='Address to listen on')
+
+    parser.add_argument("--port", dest='port', type=int, default=6000,
+                        help='Port of the first unit; the others follow consecutively')
+
+    parser.add_argument("--maxframes", dest='maxframes', type=int, default=256,
+                        help='Frames queued per client before the oldest are dropped')
+
+    parser.add_argument("--seed", dest='seed', type=int, default=None,
+                        help='Random seed, for repeatable runs')
+
+    parser.add_argument("--duration", dest='duration', type=float, default=None,
+                        help='Stop after this many seconds')
+
+    parser.add_argument("--aggregate", dest='aggregate', action='store_const', const=True, default=False,
+                        help='Also run an aggregator on every unit and report its throughput and latency')
+
+    parser.add_argument("--store", dest='store', default=None, metavar="DIR",
+                        help='Breath store directory for --aggregate')
+
+    parser.add_argument("--report", dest='report', type=float, default=5.0,
+                        help='Seconds between aggregator reports')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    specs = [parse_settings(spec) for spec in (args.specs or [""])]
+    settings = [specs[i % len(specs)] for i in range(args.nodes)]
+    procs = max(1, min(args.procs, args.nodes))
+    bounds = np.linspace(0, args.nodes, procs + 1).astype(int)
+    ready = mp.Queue()
+    processes = [mp.Process(target=run_generator,
+                            args=(settings[lo:hi], args.sample_rate, args.host, args.port + lo, args.maxframes,
+                                  args.batch, None if args.seed is None else args.seed + p, args.duration, ready))
+                 for p, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:]))]
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            ready.get(timeout=30.0)
+        print("{} units at {:g} Hz on {}:{}-{} in {} processes".format(
+            args.nodes, args.sample_rate, args.host, args.port, args.port + args.nodes - 1, procs))
+        if args.aggregate:
+            store = BreathStore(args.store) if args.store else None
+            aggregator = Aggregator(store)
+            try:
+                total = asyncio.run(aggregator.run([(args.host, args.port + i) for i in range(args.nodes)],
+                                                   args.duration, args.report))
+            finally:
+                if store is not None:
+                    store.close()
+            print("Total: " + aggregator.format_stats(total))
+            print("Expected {:.0f} samples/s".format(args.nodes * args.sample_rate))
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in processes:
+            p.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import os, time, queue, shutil, threading
+
+import numpy as np
+
+from binlog import *
+from metrics import METRICS
+
+
+"""Session logging off the render loop: a background writer with rotation and compression
+
+write_readings() only copies the arrays and puts them on a bounded queue, so
+a slow SD card can never stall the caller. When the queue is full the batch
+is dropped and counted rather than waited for. A writer thread hands batches
+to a BinaryLogWriter, which writes large sequential chunks of raw counts,
+flushing and fsyncing every `fsync_seconds` so a crash
+loses at most that much data (the reader ignores a torn trailing chunk).
+
+A log is a series of segments, each a complete binary log with the same t0:
+the first is `filename`, the rest insert ".1", ".2", ... before the
+extension. A segment is closed once it holds `max_bytes` or spans
+`max_seconds` of samples. With `compress` ("gzip", or "zstd" where
+available), a second thread compresses each closed segment to a temporary
+file, renames it into place and only then removes the original, so every
+sample stays readable at every moment.
+
+Counters, also published as log.* metrics: bytes_written, dropped_batches,
+and the queue depth as of the last write_readings().
+"""
+
+_FINISH = None
+
+
+def segment_name(filename, index):
+    if index == 0:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return "{}.{}{}".format(root, index, ext)
+
+
+def compress_file(filename, method):
+    """Compress filename to filename + its extension, crash-safely, then remove the original"""
+    target = filename + COMPRESSED_EXTENSIONS[method]
+    tmp = target + ".tmp"
+    with open(filename, "rb") as src, compression_module(method).open(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp, target)
+    os.remove(filename)
+    return target
+
+
+class BackgroundLogWriter(object):
+    """Append readings to a rotating binary log from a background thread
+
+    :param meta: Log metadata, which must include "t0"
+    :param max_bytes: Start a new segment once one reaches this size
+    :param max_seconds: Start a new segment once one spans this many seconds of samples
+    :param compress: None, "gzip" or "zstd", for finished segments
+    :param fsync_seconds: Flush and fsync at most this often; 0 after every batch, None only on rotation and close
+    :param max_batches: Batches that may wait for the writer before new ones are dropped
+    """
+
+    def __init__(self, filename, meta, max_bytes=None, max_seconds=None, compress=None, fsync_seconds=1.0,
+                 max_batches=256, chunk_records=65536):
+        if compress is not None:
+            compression_module(compress)
+        self.filename = filename
+        self.meta = meta
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.fsync_seconds = fsync_seconds
+        self.chunk_records = chunk_records
+        self.queue = queue.Queue(max_batches)
+        self.bytes_written = METRICS.counter("log.bytes_written")
+        self.dropped_batches = METRICS.counter("log.dropped_batches")
+        self.queue_depth = METRICS.gauge("log.queue_depth")
+        self.write_ms = METRICS.histogram("log.write_ms")
+        self.segments = []
+        self.error = None
+        self.compressq = queue.Queue()
+        self.compressor = None
+        if compress is not None:
+            self.compressor = threading.Thread(target=self._compress_segments, name="log-compress", daemon=True)
+            self.compressor.start()
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def write_readings(self, t, slm, cmH2O, channel=0):
+        """Queue arrays of timestamps (seconds since meta["t0"]) and scaled readings; never blocks"""
+        batch = (np.array(t, dtype=np.float64), np.array(slm, dtype=np.float32),
+                 np.array(cmH2O, dtype=np.float32), channel)
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.dropped_batches.inc()
+        self.queue_depth.set(self.queue.qsize())
+
+    def close(self):
+        """Write everything queued, close the last segment and wait for compression to finish"""
+        if self.thread is None:
+            return
+        # The writer drains the queue until it sees _FINISH, unless it died; then stop waiting for room
+        while True:
+            try:
+                self.queue.put(_FINISH, timeout=0.5)
+                break
+            except queue.Full:
+                if not self.thread.is_alive():
+                    break
+        self.thread.join()
+        self.thread = None
+        if self.compressor is not None:
+            self.compressq.put(_FINISH)
+            self.compressor.join()
+            self.compressor = None
+        if self.error is not None:
+            print("Warning: session log failed: {}".format(self.error))
+
+    def _open_segment(self):
+        name = segment_name(self.filename, len(self.segments))
+        self.segments.append(name)
+        self.bytes_written.inc(HEADER_LEN)
+        return BinaryLogWriter(name, dict(self.meta, segment=len(self.segments) - 1), self.chunk_records)
+
+    def _sync(self, writer):
+        writer.flush()
+        os.fsync(writer.f.fileno())
+
+    def _close_segment(self, writer):
+        self._sync(writer)
+        writer.close()
+        if self.compress is not None:
+            self.compressq.put(writer.filename)
+
+    def _run(self):
+        writer = None
+        segment_t0 = None
+        segment_bytes = 0
+        last_sync = time.monotonic()
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is _FINISH:
+                    break
+                t, slm, cmH2O, channel = batch
+                if t.size == 0:
+                    continue
+                t0 = time.perf_counter()
+                if writer is not None and ((self.max_bytes and segment_bytes >= self.max_bytes) or
+                                           (self.max_seconds and t[0] - segment_t0 >= self.max_seconds)):
+                    self._close_segment(writer)
+                    writer = None
+                if writer is None:
+                    writer = self._open_segment()
+                    segment_t0 = t[0]
+                    segment_bytes = HEADER_LEN
+                writer.write_readings(t, slm, cmH2O, channel)
+                nbytes = t.size * SAMPLE_DTYPE.itemsize
+                segment_bytes = segment_bytes + nbytes
+                self.bytes_written.inc(nbytes)
+                if self.fsync_seconds is not None and time.monotonic() - last_sync >= self.fsync_seconds:
+                    self._sync(writer)
+                    last_sync = time.monotonic()
+                self.write_ms.observe((time.perf_counter() - t0) * 1000.0)
+        except Exception as ex:
+            # Keep draining so the caller never blocks; the failure is reported on close
+            self.error = ex
+            while self.queue.get() is not _FINISH:
+                self.dropped_batches.inc()
+        finally:
+            if writer is not None and writer.f is not None:
+                try:
+                    self._close_segment(writer)
+                except Exception as ex:
+                    self.error = self.error or ex
+
+    def _compress_segments(self):
+        while True:
+            filename = self.compressq.get()
+            if filename is _FINISH:
+                return
+            try:
+                compress_file(filename, self.compress)
+            except OSError as ex:
+                print("Warning: could not compress {}: {}".format(filename, ex))
@@ -0,0 +1,349 @@
+import time, argparse
+from collections import namedtuple
+
+import numpy as np
+
+
+"""Resistance/compliance lung simulator
+
+A single-compartment lung (compliance C in ml/cmH2O, airway resistance R in
+cmH2O/(l/s)) ventilated in pressure or volume control. Every patient is stepped
+together as numpy arrays, a block of samples at a time, so many simulated
+patients can be generated much faster than real time. SimFlow and SimPressure
+wrap a simulator as sensor classes, so it can stand in wherever --fake does.
+"""
+
+PRESSURE_CONTROL = "pc"
+VOLUME_CONTROL = "vc"
+
+VentSettings = namedtuple("VentSettings", [
+    "mode",             # PRESSURE_CONTROL or VOLUME_CONTROL
+    "rr",               # breaths/min
+    "ie",               # inspiratory:expiratory time ratio, e.g. 0.5 for 1:2
+    "peep",             # cmH2O
+    "pinsp",            # cmH2O above PEEP, pressure control
+    "vt",               # ml, volume control
+    "resistance",       # cmH2O/(l/s)
+    "compliance",       # ml/cmH2O
+    "leak",             # l/min lost between sensor and patient at 10 cmH2O
+    "flow_noise",       # slm standard deviation
+    "pressure_noise",   # cmH2O standard deviation
+    "disconnects",      # mean disconnections per hour
+    "disconnect_time",  # seconds each disconnection lasts
+], defaults=[PRESSURE_CONTROL, 15.0, 0.5, 5.0, 15.0, 500.0, 10.0, 50.0, 0.0, 0.2, 0.05, 0.0, 10.0])
+
+SETTING_ALIASES = {"r": "resistance", "c": "compliance"}
+
+
+def parse_settings(spec, base=None):
+    """Parse "vc,rr=20,vt=450,c=40" into VentSettings; a bare "pc" or "vc" selects the mode"""
+    settings = base or VentSettings()
+    updates = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        if "=" not in item:
+            updates["mode"] = item.lower()
+            continue
+        key, value = item.split("=", 1)
+        key = SETTING_ALIASES.get(key.strip().lower(), key.strip().lower())
+        if key not in VentSettings._fields or key == "mode":
+            raise ValueError("Unknown ventilator setting '{}'".format(key))
+        updates[key] = float(value)
+    settings = settings._replace(**updates)
+    if settings.mode not in (PRESSURE_CONTROL, VOLUME_CONTROL):
+        raise ValueError("Ventilation mode must be '{}' or '{}'".format(PRESSURE_CONTROL, VOLUME_CONTROL))
+    return settings
+
+
+def affine_scan(a, b):
+    """Solve v[i] = a[i] * v[i-1] + b[i] along the last axis, for every row at once
+
+    Uses log2(n) doubling passes over the whole array rather than a pass per sample.
+
+    :return: (A, B) such that v[i] = A[i] * v[-1] + B[i], v[-1] being the value before the first sample
+    """
+    a = np.array(a, dtype=np.float64)
+    b = np.array(b, dtype=np.float64)
+    s = 1
+    while s < a.shape[-1]:
+        b[..., s:] = a[..., s:] * b[..., :-s] + b[..., s:]
+        a[..., s:] = a[..., s:] * a[..., :-s]
+        s *= 2
+    return a, b
+
+
+class LungSimulator(object):
+    """Step the lungs of several ventilated patients together
+
+    Lung volume is tracked above FRC, with alveolar pressure PEEP + V/C. Each
+    sample is advanced with the exact exponential solution over the sample
+    interval, so the result does not depend on the sample rate. While a patient
+    is disconnected (upstream of the sensor) flow and pressure read zero and
+    the lung empties to FRC.
+    """
+
+    def __init__(self, settings, sr, seed=None, t0=0.0):
+        self.settings = [settings] if isinstance(settings, VentSettings) else list(settings)
+        self.sr = float(sr)
+        self.dt = 1.0 / self.sr
+        self.rng = np.random.default_rng(seed)
+        self.n = 0
+        self.t0 = t0
+        self.npatients = len(self.settings)
+
+        def column(field):
+            return np.array([getattr(s, field) for s in self.settings], dtype=np.float64)[:, None]
+
+        self.vc = np.array([s.mode == VOLUME_CONTROL for s in self.settings])[:, None]
+        self.period = 60.0 / column("rr")
+        self.ti = self.period * column("ie") / (1.0 + column("ie"))
+        self.peep = column("peep")
+        self.pinsp = column("pinsp")
+        self.vt = column("vt")
+        self.R = column("resistance")
+        self.C = column("compliance")
+        self.leak = column("leak") / 10.0
+        self.flow_noise = column("flow_noise")
+        self.pressure_noise = column("pressure_noise")
+        self.disconnect_p = column("disconnects") / 3600.0 * self.dt
+        self.disconnect_samples = np.round(column("disconnect_time") * self.sr).astype(np.int64)[:, 0]
+        self.decay = np.exp(-self.dt / (self.R * self.C / 1000.0))[:, 0]
+        # Patients start at random points in the breath, so they are not in lockstep
+        self.offset = self.rng.uniform(0.0, 1.0, (self.npatients, 1)) * self.period
+        self.V = np.zeros(self.npatients)
+        self.disconnected = np.zeros(self.npatients, dtype=np.int64)
+
+    def _disconnections(self, starts):
+        """Which samples each patient is ventilated for, given where disconnections may start
+
+        A disconnection starting while one is still running is ignored. Only the
+        start events are visited, and those are rare.
+
+        :return: (ventilated of shape (patients, nsamples), samples of disconnection left over)
+        """
+        nsamples = starts.shape[1]
+        ventilated = np.ones(starts.shape, dtype=bool)
+        until = self.disconnected.copy()
+        for p in range(self.npatients):
+            ventilated[p, :until[p]] = False
+        for p, i in zip(*np.nonzero(starts)):
+            if i >= until[p] and self.disconnect_samples[p] > 0:
+                until[p] = i + self.disconnect_samples[p]
+                ventilated[p, i:until[p]] = False
+        return ventilated, np.maximum(until - nsamples, 0)
+
+    @property
+    def t(self):
+        return self.t0 + self.n * self.dt
+
+    def block(self, nsamples):
+        """Advance every patient by nsamples
+
+        :return: (t, slm, cmH2O), t of shape (nsamples,) and the others (patients, nsamples)
+        """
+        k = np.arange(self.n, self.n + nsamples)
+        t = self.t0 + k * self.dt
+        self.n = self.n + nsamples
+        inspiring = ((t + self.offset) % self.period) < self.ti
+
+        # Everything that depends only on the time is laid out for the whole block up front
+        target = np.where(inspiring & ~self.vc, self.C * self.pinsp, 0.0)
+        vc_flow = np.where(inspiring & self.vc, self.vt / self.ti, 0.0)   # ml/s
+        starts = self.rng.random((self.npatients, nsamples)) < self.disconnect_p
+        ventilated, remaining = self._disconnections(starts)
+
+        # Each sample is v = a * v_prev + b: a volume-control step adds the flow, anything
+        # else relaxes towards the target, so the whole block is one affine recurrence
+        step = ventilated & (vc_flow > 0.0)
+        decay = self.decay[:, None]
+        a = np.where(step, 1.0, decay)
+        b = np.where(step, vc_flow * self.dt, (1.0 - decay) * np.where(ventilated, target, 0.0))
+        a, b = affine_scan(a, b)
+        V = a * self.V[:, None] + b
+        V_before = np.concatenate([self.V[:, None], V[:, :-1]], axis=1)
+        self.V = V[:, -1].copy() if nsamples else self.V
+        self.disconnected = remaining
+
+        lung_flow = (V - V_before) / self.dt    # ml/s, mean over each interval
+        palv = self.peep + 0.5 * (V + V_before) / self.C
+        paw = np.where(self.vc & inspiring, palv + self.R * lung_flow / 1000.0,
+                       np.where(inspiring, self.peep + self.pinsp, self.peep))
+        slm = lung_flow * 60.0 / 1000.0 + self.leak * paw
+        slm = slm + self.rng.normal(0.0, 1.0, slm.shape) * self.flow_noise
+        cmH2O = paw + self.rng.normal(0.0, 1.0, paw.shape) * self.pressure_noise
+        slm[~ventilated] = 0.0
+        cmH2O[~ventilated] = 0.0
+        return t, slm, cmH2O
+
+
+class SimulatedPatients(object):
+    """Sample a LungSimulator at the time given by a clock, generating ahead a block at a time
+
+    The simulator runs on its own grid at `sr`; a read returns the most recent
+    sample at or before the clock time, so the acquisition rate is independent.
+    """
+
+    def __init__(self, settings, sr=200.0, clock=time.time, seed=None, blocksize=256):
+        self.clock = clock
+        self.blocksize = blocksize
+        self.sim = LungSimulator(settings, sr, seed, t0=clock())
+        self.t = None
+        self._extend()
+
+    def _extend(self):
+        self.t, self.slm, self.cmH2O = self.sim.block(self.blocksize)
+
+    def read(self, patient, t=None):
+        t = self.clock() if t is None else t
+        while t >= self.sim.t:
+            self._extend()
+        i = max(0, min(self.blocksize - 1, int((t - self.t[0]) * self.sim.sr)))
+        return float(self.slm[patient, i]), float(self.cmH2O[patient, i])
+
+
+class SimFlow(object):
+    """Flow sensor reading one patient of a SimulatedPatients"""
+
+    def __init__(self, patients, patient=0):
+        self.patients = patients
+        self.patient = patient
+        self.sim_settings = patients.sim.settings[patient]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def prepare(self):
+        pass
+
+    def read_scaled(self):
+        return self.patients.read(self.patient)[0]
+
+
+class SimPressure(SimFlow):
+    """Pressure sensor reading one patient of a SimulatedPatients"""
+
+    def read_scaled(self):
+        return self.patients.read(self.patient)[1]
+
+
+class SimSource(object):
+    """Settings for a SimulatedPatients, created lazily in whichever process first opens a sensor on it
+
+    Sensor classes sharing a source share one simulator, so a flow/pressure
+    pair (or every channel of a multichannel monitor) sees the same patients.
+    """
+
+    def __init__(self, settings, **kwargs):
+        self.settings = settings
+        self.kwargs = kwargs
+        self._patients = None
+
+    def __getstate__(self):
+        return {"settings": self.settings, "kwargs": self.kwargs, "_patients": None}
+
+    def patients(self):
+        if self._patients is None:
+            self._patients = SimulatedPatients(self.settings, **self.kwargs)
+        return self._patients
+
+
+class SimSensorClass(object):
+    """A picklable stand-in for a sensor class: calling it opens the sensor on the shared simulator"""
+
+    def __init__(self, cls, source, patient=0):
+        self.cls = cls
+        self.source = source
+        self.patient = patient
+
+    def __call__(self):
+        return self.cls(self.source.patients(), self.patient)
+
+
+def sim_sensors(settings, patient=0, source=None, **kwargs):
+    """Return a (flowClass, pressureClass) pair for one simulated patient, as --fake provides"""
+    source = source or SimSource(settings, **kwargs)
+    return SimSensorClass(SimFlow, source, patient), SimSensorClass(SimPressure, source, patient)
+
+
+def soak(settings, sr, seconds, blocksize=None, logname=None, seed=None):
+    """Run simulated patients through integration and breath detection as fast as possible
+
+    :return: per-patient lists of (t, TidalData), and the samples generated per second of wall time
+    """
+    from calculations import BlockIntegrator, BreathDetector
+    from binlog import BinaryLogWriter
+
+    blocksize = blocksize or int(sr * 10)
+    sim = LungSimulator(settings, sr, seed)
+    integrators = [BlockIntegrator(sr) for s in sim.settings]
+    detectors = [BreathDetector() for s in sim.settings]
+    breaths = [[] for s in sim.settings]
+    log = None
+    if logname:
+        log = BinaryLogWriter(logname, {"sample_rate": sr, "t0": 0.0, "flow_sensor": "SimFlow",
+                                        "pressure_sensor": "SimPressure",
+                                        "sim_settings": [s._asdict() for s in sim.settings]})
+    t0 = time.time()
+    try:
+        while sim.n < seconds * sr:
+            t, slm, cmH2O = sim.block(min(blocksize, int(seconds * sr) - sim.n))
+            n = np.arange(sim.n - t.size, sim.n)
+            dT = np.full(t.size, sim.dt)
+            for p in range(sim.npatients):
+                iv = integrators[p].process(n, t, dT, slm[p], cmH2O[p])
+                breaths[p].extend(detectors[p].process(iv.t, iv.V, iv.cmH2O))
+            if log is not None:
+                log.write_readings(np.repeat(t, sim.npatients), slm.T.ravel(), cmH2O.T.ravel(),
+                                   np.tile(np.arange(sim.npatients), t.size))
+    finally:
+        if log is not None:
+            log.close()
+    elapsed = time.time() - t0
+    return breaths, sim.n * sim.npatients / elapsed if elapsed else 0.0
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Soak-test the pipeline with simulated ventilated patients, faster than real time.')
+
+    parser.add_argument("--sim", dest='specs', action='append', default=None,
+                        help='Ventilator settings, e.g. "vc,rr=20,vt=450,c=40,leak=2"; repeat for a mix of patients')
+
+    parser.add_argument("--patients", dest='patients', type=int, default=1,
+                        help='Number of simulated patients, cycling through the --sim settings')
+
+    parser.add_argument("--samplerate", dest='sample_rate', type=float, default=50.0,
+                        help='Sampling rate')
+
+    parser.add_argument("--duration", dest='duration', type=float, default=3600.0,
+                        help='Simulated seconds')
+
+    parser.add_argument("--seed", dest='seed', type=int, default=None,
+                        help='Random seed, for repeatable runs')
+
+    parser.add_argument("--log", dest='log', default=None,
+                        help='Also write every patient to this binary log, one channel each')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    specs = [parse_settings(spec) for spec in (args.specs or [""])]
+    settings = [specs[i % len(specs)] for i in range(args.patients)]
+    breaths, rate = soak(settings, args.sample_rate, args.duration, logname=args.log, seed=args.seed)
+    print("{} patients x {:.0f} s at {} Hz: {:.0f} samples/s, {:.0f}x real time".format(
+        len(settings), args.duration, args.sample_rate, rate, rate / (args.sample_rate * len(settings))))
+    for p, (s, b) in enumerate(zip(settings, breaths)):
+        line = "  {:>3} {} rr={:g} peep={:g}: {:>5} breaths".format(p, s.mode, s.rr, s.peep, len(b))
+        if b:
+            tidal = np.array([tuple(tidal) for bt, tidal in b])
+            line += "  VTi:{:>4.0f} VTe:{:>4.0f} RR:{:4.1f} MVe:{:5.1f} PPk:{:5.1f} PEEP:{:5.1f}".format(*np.median(tidal, axis=0))
+        print(line)
+    if args.log:
+        print("Wrote " + args.log)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import os, time, json, bisect, argparse
+import multiprocessing as mp
+
+import numpy as np
+
+
+"""Pipeline instrumentation: counters, gauges and fixed-bucket histograms
+
+Each process has one registry, METRICS. Recording a value is a bisect into
+a short list of bucket bounds and a few additions, cheap enough to leave on
+for every sample. When enabled (the SPLITVENT_STATS environment variable
+names a file, so child processes inherit it however they are started),
+each process appends a JSON line holding a snapshot of its metrics to that
+file every SPLITVENT_STATS_INTERVAL seconds, and once more as it exits.
+Snapshots are cumulative; rates come from differences between lines.
+`python metrics.py FILE` summarizes the latest snapshot of each process.
+"""
+
+STATS_ENV = "SPLITVENT_STATS"
+STATS_INTERVAL_ENV = "SPLITVENT_STATS_INTERVAL"
+
+# Durations in milliseconds, about four buckets per decade from 10 us to 10 s
+DURATION_BOUNDS_MS = [round(float(b), 4) for b in np.logspace(-2, 4, 25)]
+# Signed deviations in milliseconds, for sampling jitter
+JITTER_BOUNDS_MS = [-50.0, -20.0, -10.0] + [float(b) for b in np.arange(-5.0, 5.01, 0.5)] + [10.0, 20.0, 50.0]
+# Counts of records, for backlogs
+DEPTH_BOUNDS = [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384]
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value = self.value + n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        # numpy scalars are not JSON serializable
+        return self.value.item() if hasattr(self.value, "item") else self.value
+
+
+class Histogram(object):
+    """Counts of values falling in fixed buckets, plus count, sum, min and max
+
+    Bucket i counts values v with bounds[i-1] < v <= bounds[i]; the last
+    bucket holds everything above the last bound.
+    """
+
+    def __init__(self, bounds=DURATION_BOUNDS_MS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        value = float(value)
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def observe_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if not values.size:
+            return
+        counts = np.bincount(np.searchsorted(self.bounds, values, side="left"), minlength=len(self.counts))
+        self.counts = [a + int(b) for a, b in zip(self.counts, counts)]
+        self.count = self.count + values.size
+        self.total = self.total + float(values.sum())
+        lo, hi = float(values.min()), float(values.max())
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+
+    def quantile(self, q):
+        """The upper bound of the bucket holding the q quantile, clamped to the observed range"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen = seen + c
+            if seen >= rank and c:
+                bound = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.total, "min": self.min, "max": self.max,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "bounds": self.bounds, "counts": self.counts}
+
+
+class Metrics(object):
+    """A process's named metrics, and the periodic dump of them"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.path = None
+        self.interval = 10.0
+        self.next_dump = None
+        self.started = time.time()
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name):
+        return self._get(name, Gauge)
+
+    def histogram(self, name, bounds=DURATION_BOUNDS_MS):
+        m = self.metrics.get(name)
+        if m is None:
+            m = self.metrics[name] = Histogram(bounds)
+        return m
+
+    def _get(self, name, cls):
+        m = self.metrics.get(name)
+        if m is None:
+            m = self.metrics[name] = cls()
+        return m
+
+    def snapshot(self):
+        return dict((name, m.snapshot()) for name, m in sorted(self.metrics.items()))
+
+    def configure(self, path=None, interval=None):
+        """Dump to `path` every `interval` seconds; by default as set in the environment by enable()"""
+        self.path = path if path is not None else os.environ.get(STATS_ENV)
+        self.interval = float(interval if interval is not None else os.environ.get(STATS_INTERVAL_ENV, self.interval))
+        self.next_dump = time.monotonic() + self.interval if self.path else None
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def maybe_dump(self):
+        """Append a snapshot if the interval has passed; call it often, it is one clock read otherwise"""
+        if self.next_dump is not None and time.monotonic() >= self.next_dump:
+            self.dump()
+
+    def dump(self):
+        if not self.path:
+            return
+        self.next_dump = time.monotonic() + self.interval
+        line = json.dumps({"t": time.time(), "pid": os.getpid(), "process": mp.current_process().name,
+                           "uptime": time.time() - self.started, "metrics": self.snapshot()})
+        # One write per line on an O_APPEND file, so lines from several processes do not interleave
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+METRICS = Metrics()
+
+
+def enable(path, interval=10.0):
+    """Turn on dumping in this process and in every process it starts from now on"""
+    os.environ[STATS_ENV] = path
+    os.environ[STATS_INTERVAL_ENV] = str(interval)
+    METRICS.configure(path, interval)
+
+
+def configure_process(name=None):
+    """Call at the start of a child process: pick up the dump settings and name the process in its lines"""
+    if name is not None:
+        mp.current_process().name = name
+    METRICS.metrics = {}
+    METRICS.started = time.time()
+    METRICS.configure()
+
+
+def queue_depth(q):
+    """Items waiting in a multiprocessing Queue, or None where the platform cannot tell (macOS)"""
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+
+def latest(path):
+    """The last snapshot from each process in a stats file, keyed by (process, pid)"""
+    snapshots = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                s = json.loads(line)
+            except ValueError:
+                continue
+            snapshots[(s["process"], s["pid"])] = s
+    return snapshots
+
+
+def format_snapshot(snapshot):
+    lines = ["{} (pid {}, up {:.0f} s)".format(snapshot["process"], snapshot["pid"], snapshot["uptime"])]
+    for name, value in snapshot["metrics"].items():
+        if isinstance(value, dict):
+            if not value["count"]:
+                continue
+            lines.append("  {:<32} n={:<9} mean {:>9.3f}  p50 {:>9.3f}  p99 {:>9.3f}  min {:>9.3f}  max {:>9.3f}".format(
+                name, value["count"], value["mean"], value["p50"], value["p99"], value["min"], value["max"]))
+        else:
+            lines.append("  {:<32} {}".format(name, value))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize a pipeline stats file written with --stats.')
+    parser.add_argument("path", help="Stats file (JSON lines)")
+    args = parser.parse_args(argv)
+    for key, snapshot in sorted(latest(args.path).items()):
+        print(format_snapshot(snapshot))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+import time, argparse, contextlib, functools, struct
+import multiprocessing as mp
+from collections import namedtuple
+from fcntl import ioctl
+
+from sfm3x00 import *
+from HoneywellSSC import *
+from calculations import *
+from VirtualSensor import *
+from lungsim import SimSource, sim_sensors, parse_settings
+from aiosensors import async_multi_readings, iterate_async
+import metrics
+from metrics import METRICS, DEPTH_BOUNDS, configure_process, queue_depth
+
+
+"""Acquire, integrate and analyze many flow/pressure sensor pairs from one process.
+
+One scheduler polls every channel on each tick, so N patients cost one sensor
+process and one tidal process instead of N copies of the whole GUI stack.
+"""
+
+TCA9548A_DEFAULT_I2C_ADDR = 0x70
+
+
+class I2CMux(object):
+    """TCA9548A-style I2C multiplexer: one control byte selects the downstream port"""
+
+    def __init__(self, bus=RASPI_DEFAULT_I2C_BUS, address=TCA9548A_DEFAULT_I2C_ADDR):
+        self.bus = bus
+        self.address = address
+        self.port = None
+        self._device = open('/dev/i2c-{0}'.format(bus), 'r+b', buffering=0)
+        ioctl(self._device.fileno(), I2C_SLAVE, address & 0x7F)
+
+    def close(self):
+        if self._device is not None:
+            self._device.close()
+            self._device = None
+
+    def select(self, port):
+        if port != self.port:
+            self._device.write(struct.pack("B", 1 << port))
+            self.port = port
+
+
+class MuxedSensor(object):
+    """Wrap a sensor so the multiplexer is switched to its port before each transaction"""
+
+    def __init__(self, mux, port, sensorClass, **kwargs):
+        self.mux = mux
+        self.port = port
+        self.mux.select(port)
+        self.sensor = sensorClass(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.sensor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.sensor.close()
+        return False
+
+    def prepare(self):
+        self.mux.select(self.port)
+        self.sensor.prepare()
+
+    def read_value(self):
+        self.mux.select(self.port)
+        return self.sensor.read_value()
+
+    def read_scaled(self):
+        self.mux.select(self.port)
+        return self.sensor.read_scaled()
+
+
+ChannelSpec = namedtuple("ChannelSpec", ["name", "flow", "pressure"])
+
+def fake_channels(n):
+    """Synthetic channels, each with its waveform shifted in phase so they are distinguishable"""
+    return [ChannelSpec("fake{}".format(i),
+                        functools.partial(FakeFlow, phase=i * 3.0 / n),
+                        functools.partial(FakePressure, phase=i * 3.0 / n))
+            for i in range(n)]
+
+
+def sim_channels(specs, n):
+    """Simulated patients cycling through the given VentSettings, all stepped by one shared simulator"""
+    settings = [specs[i % len(specs)] for i in range(n)]
+    source = SimSource(settings)
+    return [ChannelSpec("sim{}".format(i), *sim_sensors(settings[i], i, source)) for i in range(n)]
+
+
+def hardware_channels(buses, mux_ports=0, mux_address=TCA9548A_DEFAULT_I2C_ADDR):
+    """One channel per bus, or one per multiplexer port on each bus when mux_ports > 0"""
+    channels = []
+    for bus in buses:
+        if mux_ports:
+            for port in range(mux_ports):
+                channels.append(ChannelSpec("i2c{}.{}".format(bus, port),
+                                            functools.partial(_muxed, bus, mux_address, port, SFM3x00),
+                                            functools.partial(_muxed, bus, mux_address, port, HoneywellSSC)))
+        else:
+            channels.append(ChannelSpec("i2c{}".format(bus),
+                                        functools.partial(SFM3x00, bus=bus),
+                                        functools.partial(HoneywellSSC, bus=bus)))
+    return channels
+
+
+_muxes = {}
+
+def _muxed(bus, mux_address, port, sensorClass):
+    # Multiplexers are shared by every channel behind them, and must be opened in the acquisition process
+    key = (bus, mux_address)
+    if key not in _muxes:
+        _muxes[key] = I2CMux(bus, mux_address)
+    return MuxedSensor(_muxes[key], port, sensorClass, bus=bus)
+
+
+def close_muxes():
+    """Close the multiplexers opened for muxed channels, once every channel behind them is closed"""
+    while _muxes:
+        _muxes.popitem()[1].close()
+
+
+
+ChannelSample = namedtuple("ChannelSample", ["t", "value"])
+
+def multi_combined_readings(channels, clock=wallclock):
+    """Open every channel and yield a list with one timestamped FlowPressureReading per channel"""
+    with contextlib.ExitStack() as stack:
+        # Registered first, so the multiplexers are closed after the sensors behind them
+        stack.callback(close_muxes)
+        pairs = []
+        for ch in channels:
+            pairs.append((stack.enter_context(ch.flow()), stack.enter_context(ch.pressure())))
+        for s, p in pairs:
+            s.prepare()
+            p.prepare()
+        reads = [(METRICS.histogram("read.ch{}.flow_ms".format(c)), METRICS.histogram("read.ch{}.pressure_ms".format(c)))
+                 for c in range(len(pairs))]
+        while True:
+            samples = []
+            for (s, p), (read_flow, read_pressure) in zip(pairs, reads):
+                t = clock()
+                t0 = time.perf_counter()
+                slm = s.read_scaled()
+                t1 = time.perf_counter()
+                cmH2O = p.read_scaled()
+                t2 = time.perf_counter()
+                read_flow.observe((t1 - t0) * 1000.0)
+                read_pressure.observe((t2 - t1) * 1000.0)
+                samples.append(ChannelSample(t, FlowPressureReading(slm, cmH2O)))
+            yield samples
+
+
+def concurrent_multi_readings(channels):
+    """Like multi_combined_readings, but channels on different I2C buses are read at the same time
+
+    Each channel is stamped with the time of its flow reading, which is what is integrated.
+    """
+    try:
+        for readings in iterate_async(async_multi_readings(channels)):
+            yield [ChannelSample(r.flow.t, FlowPressureReading(r.flow.value, r.pressure.value)) for r in readings]
+    finally:
+        close_muxes()
+
+
+class ChannelIntegrator(object):
+    """Per-channel sample numbering, dT from the channel's own timestamps, and volume integration"""
+
+    def __init__(self, sr):
+        self.sr = sr
+        self.integrator = VolumeIntegrator(sr)
+        self.n = 0
+        self.last_t = None
+
+    def push(self, sample):
+        dT = (1.0 / self.sr) if self.last_t is None else sample.t - self.last_t
+        self.last_t = sample.t
+        r = self.integrator.push(TReading(self.n, sample.t, dT, sample.value))
+        self.n = self.n + 1
+        return r
+
+
+ChannelReading = namedtuple("ChannelReading", ["channel", "reading"])
+
+def stream_multichannel(channels, samplerate, displayQueue, tidalCalcQueue, finishq, schedule=None,
+                        reader=multi_combined_readings):
+    """Acquisition process: one batch per tick is put on each queue, rather than one item per sample"""
+    configure_process("acquisition")
+    integrators = [ChannelIntegrator(samplerate) for ch in channels]
+    clockedvals = clocked(reader(channels), samplerate, **(schedule or {}))
+    integrate_ms = METRICS.histogram("integrate_ms")
+    try:
+        for tick in clockedvals:
+            t0 = time.perf_counter()
+            display = []
+            tidal = []
+            for c, sample in enumerate(tick.value):
+                r = integrators[c].push(sample)
+                if r is not None:
+                    display.append(ChannelReading(c, r))
+                    tidal.append(ChannelReading(c, VolumePressureReading(r.t, r.V, r.cmH2O)))
+            integrate_ms.observe((time.perf_counter() - t0) * 1000.0)
+            if display:
+                displayQueue.put(display)
+                tidalCalcQueue.put(tidal)
+            METRICS.maybe_dump()
+            if not finishq.empty():
+                print("Exiting streaming process")
+                return
+    finally:
+        METRICS.dump()
+
+
+def stream_multichannel_rings(channels, samplerate, rings, finishq, schedule=None, reader=multi_combined_readings):
+    """Acquisition process: every channel read on one schedule, each published to its own SharedRing
+
+    For consumers that read rings, such as netstream, rather than the batched queues of stream_multichannel.
+    """
+    configure_process("acquisition")
+    integrators = [ChannelIntegrator(samplerate) for ch in channels]
+    clockedvals = clocked(reader(channels), samplerate, **(schedule or {}))
+    integrate_ms = METRICS.histogram("integrate_ms")
+    try:
+        for tick in clockedvals:
+            t0 = time.perf_counter()
+            for c, sample in enumerate(tick.value):
+                r = integrators[c].push(sample)
+                if r is None:
+                    continue
+                if rings[c].write_count == 0:
+                    rings[c].set_meta({"sample_rate": samplerate, "name": channels[c].name})
+                rings[c].write_one(r)
+            integrate_ms.observe((time.perf_counter() - t0) * 1000.0)
+            METRICS.maybe_dump()
+            if not finishq.empty():
+                print("Exiting streaming process")
+                return
+    finally:
+        for ring in rings:
+            ring.finish()
+        METRICS.dump()
+
+
+def multi_tidalcalcs(nchannels, sample_rate, inputq, finishq, outputq):
+    """Tidal process: a BreathDetector per channel, each TidalData emitted as its breath completes"""
+    configure_process("tidal")
+    detectors = [BreathDetector() for c in range(nchannels)]
+    compute_ms = METRICS.histogram("tidal.compute_ms")
+    backlog = METRICS.histogram("tidal.backlog", DEPTH_BOUNDS)
+    try:
+        for batches in receive_readings(inputq):
+            backlog.observe(len(batches))
+            t0 = time.perf_counter()
+            for batch in batches:
+                for c, i in batch:
+                    tidal = detectors[c].push(i.t, i.V, i.cmH2O)
+                    if tidal is not None:
+                        outputq.put(ChannelReading(c, tidal))
+            compute_ms.observe((time.perf_counter() - t0) * 1000.0)
+            METRICS.maybe_dump()
+            if not finishq.empty():
+                return
+    finally:
+        METRICS.dump()
+
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Monitor several flow/pressure sensor pairs from one process.')
+
+    parser.add_argument("--fake", dest='fake', action='store_const', const=True, default=False,
+                        help='Use synthetic sensor data for demo and load testing')
+
+    parser.add_argument("--sim", dest='sim', action='append', default=None, metavar="SETTINGS",
+                        help='Simulated ventilated patients, e.g. --sim "vc,rr=20,vt=450"; repeat for a mix')
+
+    parser.add_argument("--channels", dest='channels', type=int, default=4,
+                        help='Number of synthetic channels with --fake or --sim')
+
+    parser.add_argument("--bus", dest='buses', type=int, action='append', default=None,
+                        help='I2C bus number holding sensors; repeat for several buses')
+
+    parser.add_argument("--muxports", dest='mux_ports', type=int, default=0,
+                        help='Number of TCA9548A multiplexer ports in use on each bus')
+
+    parser.add_argument("--concurrent", dest='reader',
+                        action='store_const', const=concurrent_multi_readings, default=multi_combined_readings,
+                        help='Read sensors on different I2C buses concurrently instead of one after another')
+
+    parser.add_argument("--samplerate", dest='sample_rate', type=float, default=50.0,
+                        help='Per-channel flow measurement sampling rate')
+
+    parser.add_argument("--spin", dest='spin', type=float, default=0.0,
+                        help='Busy-wait for the last SPIN seconds before each sample instead of sleeping, '
+                             'for steadier timing at high sampling rates (e.g. 0.0002)')
+
+    parser.add_argument("--overrun", dest='overrun', choices=OVERRUN_POLICIES, default=OVERRUN_SKIP,
+                        help='After a read overruns the next sample time, skip the missed samples or catch up on them')
+
+    parser.add_argument("--timerfd", dest='timer', action='store_const', const=True, default=False,
+                        help='Wait for each sample on a Linux timerfd instead of sleeping')
+
+    parser.add_argument("--stats", dest='stats', default=None, metavar="FILE",
+                        help='Append timing, jitter and queue statistics of every process to FILE as JSON lines')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    if args.sim:
+        channels = sim_channels([parse_settings(spec) for spec in args.sim], args.channels)
+    elif args.fake:
+        channels = fake_channels(args.channels)
+    else:
+        channels = hardware_channels(args.buses or [RASPI_DEFAULT_I2C_BUS], args.mux_ports)
+    nchannels = len(channels)
+    if args.stats:
+        metrics.enable(args.stats)
+
+    resultq = mp.Queue()
+    tidalInputQueue = mp.Queue()
+    tidalOutputQueue = mp.Queue()
+    finishq = mp.Queue()
+
+    sensorChildProcess = mp.Process(
+        target = stream_multichannel,
+        args = (channels, args.sample_rate, resultq, tidalInputQueue, finishq,
+                dict(spin=args.spin, overrun=args.overrun, timer=args.timer), args.reader)
+        )
+    sensorChildProcess.start()
+
+    tidalCalcsChildProcess = mp.Process(
+        target = multi_tidalcalcs,
+        args = (nchannels, args.sample_rate, tidalInputQueue, finishq, tidalOutputQueue)
+        )
+    tidalCalcsChildProcess.start()
+
+    try:
+        latest = [None] * nchannels
+        tidals = [None] * nchannels
+        n = 0
+        t_report = time.time()
+        backlog = METRICS.histogram("display.backlog", DEPTH_BOUNDS)
+        for batches in receive_readings(resultq):
+            backlog.observe(len(batches))
+            METRICS.gauge("queue.tidal_input").set(queue_depth(tidalInputQueue))
+            METRICS.gauge("queue.tidal_output").set(queue_depth(tidalOutputQueue))
+            METRICS.maybe_dump()
+            for batch in batches:
+                for c, r in batch:
+                    latest[c] = r
+                    n = n + 1
+            while not tidalOutputQueue.empty():
+                c, tidal = tidalOutputQueue.get()
+                tidals[c] = tidal
+            now = time.time()
+            if now - t_report >= 1.0:
+                print("{}  {} channels, {:.1f} samples/s per channel".format(
+                    time.strftime("%H:%M:%S"), nchannels, n / (now - t_report) / nchannels))
+                for c, ch in enumerate(channels):
+                    r = latest[c]
+                    tidal = tidals[c]
+                    line = "  {:>10}".format(ch.name)
+                    if r is not None:
+                        line += "  {:>6.1f} slm {:>5.1f} cmH2O {:>6.0f} ml".format(r.slm, r.cmH2O, r.V)
+                    if tidal is not None:
+                        line += "   VTi:{:>4.0f} VTe:{:>4.0f} RR:{:4.1f} MVe:{:5.1f} PPk:{:5.1f} PEEP:{:5.1f}".format(
+                            tidal.VTi, tidal.VTe, tidal.RR, tidal.MVe, tidal.PPk, tidal.PEEP)
+                    print(line)
+                n = 0
+                t_report = now
+    except KeyboardInterrupt:
+        print("Exiting normally.")
+    finally:
+        finishq.put("Finish")
+        sensorChildProcess.join()
+        tidalCalcsChildProcess.join()
+        METRICS.dump()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,820 @@
+import sys, math, time, json, struct, base64, hashlib, argparse, asyncio
+import multiprocessing as mp
+from collections import deque
+
+import numpy as np
+
+from sfm3x00 import *
+from HoneywellSSC import *
+from calculations import *
+from VirtualSensor import *
+from lungsim import parse_settings
+from multichannel import fake_channels, sim_channels, hardware_channels, stream_multichannel_rings
+from alarms import AlarmEngine, AlarmEvent, parse_rules, event_dict, format_event
+from shmring import SharedRing, INTEGRATED_DTYPE
+from trend import TrendStore, TREND_DTYPE
+import metrics
+from metrics import METRICS, DEPTH_BOUNDS, configure_process
+
+
+"""Stream waveforms and breaths to any number of network subscribers
+
+The server runs in its own process and reads the acquisition SharedRings
+through its own cursors, so subscribers add no load to acquisition. Every
+message is a frame: a 4-byte big-endian length, a 1-byte frame type, then
+the payload. Clients speak first, either with a SUBSCRIBE frame or with a
+WebSocket upgrade request on the same port; WebSocket clients get one
+binary message per frame, holding the type byte and payload.
+
+Each subscriber has a bounded queue of frames. When a slow client lets it
+fill, the oldest frames are dropped and counted, and the count is reported
+in STATUS frames, so one client can never stall the others. Alarm events
+from an AlarmEngine on each channel go to every subscriber to the channel.
+The server also keeps a TrendStore of the breaths on each channel, and
+answers a TREND_QUERY frame with one TREND frame of the requested range.
+An invalid SUBSCRIBE or TREND_QUERY is answered with a STATUS frame holding
+an "error", and the connection stays open. Answers are queued
+apart from the streamed frames and are never dropped; a client with
+MAX_REPLIES answers unsent is not read from until they go out.
+"""
+
+DEFAULT_PORT = 5005
+
+FRAME_HEADER = struct.Struct(">IB")
+
+FRAME_HELLO = 1         # server: JSON description of the channels and wire formats
+FRAME_WAVEFORM = 2      # server: WAVEFORM_HEADER then `count` WIRE_DTYPE records
+FRAME_TIDAL = 3         # server: TIDAL_FRAME
+FRAME_STATUS = 4        # server: JSON, e.g. {"dropped": 12}, or {"error": "..."} answering a bad request
+FRAME_ALARM = 5         # server: JSON AlarmEvent, with its channel
+FRAME_TREND = 6         # server: TREND_HEADER then `count` TREND_DTYPE records
+FRAME_SUBSCRIBE = 16    # client: JSON, e.g. {"channels": [0, 2], "decimate": 5, "tidal": true}
+FRAME_TREND_QUERY = 17  # client: JSON, e.g. {"channel": 0, "t0": 1700000000.0, "t1": null, "max_points": 500}
+
+WIRE_DTYPE = WAVEFORM_DTYPE.newbyteorder("<")
+WAVEFORM_HEADER = struct.Struct("<HHI")    # channel, decimation, count
+TIDAL_FRAME = struct.Struct("<Hd6d")       # channel, t, then TidalData fields
+TREND_HEADER = struct.Struct("<HdI")       # channel, resolution in seconds (0 per breath), count
+
+MAX_REPLIES = 4
+
+WS_MAX_MESSAGE = 1 << 16   # longest client WebSocket message, once reassembled
+WS_PROTOCOL_ERROR = 1002
+WS_TOO_BIG = 1009
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def encode_frame(ftype, payload=b""):
+    return FRAME_HEADER.pack(len(payload) + 1, ftype) + payload
+
+
+def encode_json(ftype, obj):
+    return encode_frame(ftype, json.dumps(obj).encode("utf-8"))
+
+
+def encode_waveform(channel, decimation, records):
+    wire = np.empty(records.size, dtype=WIRE_DTYPE)
+    for name in WIRE_DTYPE.names:
+        wire[name] = records[name]
+    return encode_frame(FRAME_WAVEFORM, WAVEFORM_HEADER.pack(channel, decimation, wire.size) + wire.tobytes())
+
+
+def encode_tidal(channel, t, tidal):
+    return encode_frame(FRAME_TIDAL, TIDAL_FRAME.pack(channel, t, *tidal))
+
+
+def encode_trend(channel, resolution, records):
+    return encode_frame(FRAME_TREND, TREND_HEADER.pack(channel, resolution, records.size) + records.tobytes())
+
+
+def decode_payload(ftype, payload):
+    """Decode a frame's payload into (channel, decimation, records), (channel, t, TidalData),
+    (channel, resolution, records) or a dict"""
+    if ftype == FRAME_WAVEFORM:
+        channel, decimation, count = WAVEFORM_HEADER.unpack_from(payload)
+        records = np.frombuffer(payload, dtype=WIRE_DTYPE, count=count, offset=WAVEFORM_HEADER.size)
+        return channel, decimation, records
+    if ftype == FRAME_TIDAL:
+        fields = TIDAL_FRAME.unpack(payload)
+        return fields[0], fields[1], TidalData(*fields[2:])
+    if ftype == FRAME_TREND:
+        channel, resolution, count = TREND_HEADER.unpack_from(payload)
+        return channel, resolution, np.frombuffer(payload, dtype=TREND_DTYPE, count=count, offset=TREND_HEADER.size)
+    return json.loads(payload.decode("utf-8"))
+
+
+class Subscriber(object):
+    """One client's subscription, bounded drop-oldest queue of encoded frames, and answers to its requests"""
+
+    def __init__(self, maxframes):
+        self.maxframes = maxframes
+        self.frames = deque()
+        self.replies = deque()
+        self.ready = asyncio.Event()
+        self.sent = asyncio.Event()
+        self.dropped = 0
+        self.reported = 0
+        self.channels = None
+        self.decimate = 1
+        self.tidal = True
+        self.subscribed = False
+
+    def subscribe(self, request):
+        channels = request.get("channels")
+        self.channels = None if channels is None else set(int(c) for c in channels)
+        self.decimate = max(1, int(request.get("decimate", 1)))
+        self.tidal = bool(request.get("tidal", True))
+        self.subscribed = True
+
+    def wants(self, channel):
+        return self.subscribed and (self.channels is None or channel in self.channels)
+
+    def offer(self, frame):
+        if len(self.frames) >= self.maxframes:
+            self.frames.popleft()
+            self.dropped = self.dropped + 1
+        self.frames.append(frame)
+        self.ready.set()
+
+    def reply(self, frame):
+        """Queue the answer to a request, ahead of the streamed frames and never dropped"""
+        self.replies.append(frame)
+        self.ready.set()
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def subscribe_error(request):
+    """Why a SUBSCRIBE request is invalid, or None"""
+    if not isinstance(request, dict):
+        return "expected a JSON object"
+    channels = request.get("channels")
+    if channels is not None and (not isinstance(channels, list) or not all(_is_int(c) for c in channels)):
+        return "channels must be null or a list of channel numbers"
+    decimate = request.get("decimate", 1)
+    if not _is_int(decimate) or decimate < 1:
+        return "decimate must be a positive integer"
+    if not isinstance(request.get("tidal", True), bool):
+        return "tidal must be true or false"
+    return None
+
+
+def trend_query_error(request, trends):
+    """Why a TREND_QUERY request cannot be answered from `trends`, a dict of TrendStores by channel, or None"""
+    if not isinstance(request, dict):
+        return "expected a JSON object"
+    channel = request.get("channel", 0)
+    if not _is_int(channel) or channel not in trends:
+        return "unknown channel {!r}".format(channel)
+    resolution = request.get("resolution")
+    if resolution is not None and (not _is_number(resolution) or resolution not in trends[channel].resolutions):
+        return "resolution must be null or one of {}".format(trends[channel].resolutions)
+    max_points = request.get("max_points")
+    if max_points is not None and (not _is_int(max_points) or max_points < 1):
+        return "max_points must be null or a positive integer"
+    for key in ("t0", "t1"):
+        if request.get(key) is not None and not _is_number(request[key]):
+            return "{} must be null or a number of seconds".format(key)
+    return None
+
+
+class StreamServer(object):
+    """Fan waveform batches and breaths out to subscribers over TCP and WebSocket"""
+
+    def __init__(self, channels, maxframes=256):
+        self.channels = channels
+        self.maxframes = maxframes
+        self.subscribers = set()
+        self.trends = dict((c["channel"], TrendStore()) for c in channels)
+        self.hello = encode_json(FRAME_HELLO, {
+            "channels": channels,
+            "waveform_dtype": [(name, WIRE_DTYPE[name].str) for name in WIRE_DTYPE.names],
+            "tidal_fields": list(TidalData._fields),
+            "trend_dtype": [(name, TREND_DTYPE[name].str) for name in TREND_DTYPE.names],
+        })
+
+    def publish_waveform(self, channel, records):
+        """Queue a batch of ring records for every subscriber to the channel, decimated as each asked"""
+        encoded = {}
+        for sub in self.subscribers:
+            if not sub.wants(channel):
+                continue
+            k = sub.decimate
+            if k not in encoded:
+                # Keep samples by their sample number, so every subscriber at one rate sees the same ones
+                picked = records if k == 1 else records[records["n"] % k == 0]
+                encoded[k] = encode_waveform(channel, k, picked) if picked.size else None
+            if encoded[k] is not None:
+                sub.offer(encoded[k])
+
+    def publish_tidal(self, channel, t, tidal):
+        self.trends[channel].add(t, tidal)
+        frame = None
+        for sub in self.subscribers:
+            if sub.tidal and sub.wants(channel):
+                frame = frame or encode_tidal(channel, t, tidal)
+                sub.offer(frame)
+
+    def publish_alarm(self, channel, event):
+        frame = None
+        for sub in self.subscribers:
+            if sub.wants(channel):
+                frame = frame or encode_json(FRAME_ALARM, event_dict(event, channel))
+                sub.offer(frame)
+
+    def trend(self, request):
+        """A TREND frame answering a TREND_QUERY request, or a STATUS frame saying what is wrong with it"""
+        error = trend_query_error(request, self.trends)
+        if error is not None:
+            return encode_json(FRAME_STATUS, {"error": "TREND_QUERY: " + error})
+        channel = request.get("channel", 0)
+        max_points = request.get("max_points")
+        resolution, records = self.trends[channel].query(request.get("t0"), request.get("t1"), request.get("resolution"),
+                                                         1000 if max_points is None else max_points)
+        return encode_trend(channel, resolution, records)
+
+    def report(self):
+        for sub in self.subscribers:
+            if sub.dropped != sub.reported:
+                METRICS.counter("net.dropped_frames").inc(sub.dropped - sub.reported)
+                sub.reported = sub.dropped
+                sub.offer(encode_json(FRAME_STATUS, {"dropped": sub.dropped}))
+
+    async def handle(self, reader, writer):
+        sub = Subscriber(self.maxframes)
+        try:
+            first = await reader.readexactly(4)
+            if first == b"GET ":
+                transport = await WebSocketTransport.accept(reader, writer)
+            else:
+                transport = FrameTransport(reader, writer, first)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            writer.close()
+            return
+        self.subscribers.add(sub)
+        sub.offer(self.hello)
+        receiving = asyncio.ensure_future(self.receive(transport, sub))
+        try:
+            while not receiving.done():
+                await sub.ready.wait()
+                sub.ready.clear()
+                while sub.replies or sub.frames:
+                    transport.send((sub.replies or sub.frames).popleft())
+                await writer.drain()
+                sub.sent.set()
+        except (ConnectionError, asyncio.CancelledError):
+            # Cancelled when the server shuts down; the connection just closes
+            pass
+        finally:
+            self.subscribers.discard(sub)
+            receiving.cancel()
+            writer.close()
+
+    async def receive(self, transport, sub):
+        try:
+            while True:
+                ftype, payload = await transport.receive()
+                if ftype not in (FRAME_SUBSCRIBE, FRAME_TREND_QUERY):
+                    continue
+                name = "SUBSCRIBE" if ftype == FRAME_SUBSCRIBE else "TREND_QUERY"
+                try:
+                    request = json.loads(payload.decode("utf-8"))
+                except ValueError:
+                    sub.reply(encode_json(FRAME_STATUS, {"error": name + ": not JSON"}))
+                else:
+                    if ftype == FRAME_TREND_QUERY:
+                        sub.reply(self.trend(request))
+                    else:
+                        error = subscribe_error(request)
+                        if error is None:
+                            sub.subscribe(request)
+                        else:
+                            sub.reply(encode_json(FRAME_STATUS, {"error": "SUBSCRIBE: " + error}))
+                while len(sub.replies) >= MAX_REPLIES:
+                    sub.sent.clear()
+                    await sub.sent.wait()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            sub.ready.set()
+
+
+class FrameTransport(object):
+    """Length-prefixed frames directly on the TCP stream"""
+
+    def __init__(self, reader, writer, first=b""):
+        self.reader = reader
+        self.writer = writer
+        self.pending = first
+
+    def send(self, frame):
+        self.writer.write(frame)
+
+    async def receive(self):
+        header = self.pending + await self.reader.readexactly(FRAME_HEADER.size - len(self.pending))
+        self.pending = b""
+        length, ftype = FRAME_HEADER.unpack(header)
+        return ftype, await self.reader.readexactly(length - 1)
+
+
+class WebSocketTransport(object):
+    """Frames as binary WebSocket messages (RFC 6455), without the length prefix"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.fragments = None   # (opcode, [payloads]) of a message still arriving in fragments
+
+    @classmethod
+    async def accept(cls, reader, writer):
+        request = b"GET " + await reader.readuntil(b"\r\n\r\n")
+        headers = {}
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        key = headers.get("sec-websocket-key")
+        if key is None:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+            raise ValueError("Not a WebSocket upgrade request")
+        accept = base64.b64encode(hashlib.sha1(key.encode("latin-1") + WS_GUID).digest()).decode("ascii")
+        writer.write("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     "Sec-WebSocket-Accept: {}\r\n\r\n".format(accept).encode("latin-1"))
+        return cls(reader, writer)
+
+    def send_message(self, opcode, payload):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack(">BB", 0x80 | opcode, n)
+        elif n < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, n)
+        self.writer.write(header + payload)
+
+    def send(self, frame):
+        self.send_message(0x2, frame[FRAME_HEADER.size - 1:])
+
+    def fail(self, code, reason):
+        """Close the connection with a WebSocket status code"""
+        self.send_message(0x8, struct.pack(">H", code))
+        raise ConnectionError("WebSocket closed: " + reason)
+
+    async def receive(self):
+        """Return the next request; a text message is taken as SUBSCRIBE JSON
+
+        Fragmented messages are reassembled, up to WS_MAX_MESSAGE bytes. Client
+        frames must be masked, as RFC 6455 requires.
+        """
+        while True:
+            b0, b1 = await self.reader.readexactly(2)
+            fin = b0 & 0x80
+            opcode = b0 & 0x0F
+            n = b1 & 0x7F
+            if n == 126:
+                n = struct.unpack(">H", await self.reader.readexactly(2))[0]
+            elif n == 127:
+                n = struct.unpack(">Q", await self.reader.readexactly(8))[0]
+            if b0 & 0x70:
+                self.fail(WS_PROTOCOL_ERROR, "reserved bits set")
+            if not b1 & 0x80:
+                self.fail(WS_PROTOCOL_ERROR, "unmasked client frame")
+            if opcode >= 0x8 and (not fin or n > 125):
+                self.fail(WS_PROTOCOL_ERROR, "fragmented or long control frame")
+            buffered = sum(len(p) for p in self.fragments[1]) if self.fragments and opcode < 0x8 else 0
+            if buffered + n > WS_MAX_MESSAGE:
+                self.fail(WS_TOO_BIG, "message too long")
+            mask = await self.reader.readexactly(4)
+            data = await self.reader.readexactly(n)
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+            if opcode == 0x8:
+                raise ConnectionError("WebSocket closed by client")
+            if opcode == 0x9:
+                self.send_message(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            if opcode == 0x0:
+                if self.fragments is None:
+                    self.fail(WS_PROTOCOL_ERROR, "continuation without a message")
+                self.fragments[1].append(payload)
+            elif opcode in (0x1, 0x2):
+                if self.fragments is not None:
+                    self.fail(WS_PROTOCOL_ERROR, "new message before the last was finished")
+                self.fragments = (opcode, [payload])
+            else:
+                self.fail(WS_PROTOCOL_ERROR, "unknown opcode {}".format(opcode))
+            if not fin:
+                continue
+            opcode, parts = self.fragments
+            self.fragments = None
+            message = b"".join(parts)
+            if opcode == 0x1:
+                return FRAME_SUBSCRIBE, message
+            if message:
+                return message[0], message[1:]
+
+
+async def feed_ring(server, channel, ring, rules=None, poll=0.1):
+    """Publish a ring's records, and the breaths and alarms found in them, until its producer finishes"""
+    cursor = ring.cursor()
+    detector = BreathDetector()
+    sample_rate = (ring.meta() or {}).get("sample_rate") or 50.0
+    alarms = AlarmEngine(rules, sample_rate)
+    last_t = None
+    backlog = METRICS.histogram("net.backlog", DEPTH_BOUNDS)
+    publish_ms = METRICS.histogram("net.publish_ms")
+    while True:
+        view = cursor.read()
+        if view.size:
+            backlog.observe(view.size)
+            t0 = time.perf_counter()
+            server.publish_waveform(channel, view)
+            # Breath detection and alarm timers start afresh where the time stamps jump, as after a playback seek
+            for start, stop, restart in continuous_spans(view["t"], last_t):
+                if restart:
+                    detector = BreathDetector()
+                    alarms = AlarmEngine(rules, sample_rate)
+                span = view[start:stop]
+                for t, tidal in detector.process(span["t"], span["V"], span["cmH2O"]):
+                    server.publish_tidal(channel, t, tidal)
+                for event in alarms.process(span["t"], span["slm"], span["cmH2O"], span["V"]):
+                    server.publish_alarm(channel, event)
+            last_t = float(view["t"][-1])
+            publish_ms.observe((time.perf_counter() - t0) * 1000.0)
+            METRICS.gauge("net.overruns.ch{}".format(channel)).set(cursor.overruns)
+        elif ring.closed:
+            return
+        await asyncio.sleep(poll)
+
+
+async def serve(rings, host="0.0.0.0", port=DEFAULT_PORT, maxframes=256, names=None, ready=None, meta_timeout=5.0,
+                alarms=None):
+    # Producers publish sensor details before their first sample; wait briefly for them for the HELLO frame
+    deadline = time.time() + meta_timeout
+    while time.time() < deadline and not all(ring.write_count or ring.closed for ring in rings):
+        await asyncio.sleep(0.05)
+    channels = []
+    for c, ring in enumerate(rings):
+        meta = ring.meta() or {}
+        channels.append({"channel": c, "name": names[c] if names else "ch{}".format(c),
+                         "sample_rate": meta.get("sample_rate"), "sensors": meta})
+    server = StreamServer(channels, maxframes)
+    listener = await asyncio.start_server(server.handle, host, port)
+    print("Streaming {} channels on {}:{}".format(len(rings), host, port))
+    if ready is not None:
+        ready.put(port)
+    rules = parse_rules(alarms)
+    feeds = [asyncio.ensure_future(feed_ring(server, c, ring, rules)) for c, ring in enumerate(rings)]
+    try:
+        while not all(f.done() for f in feeds):
+            await asyncio.sleep(1.0)
+            server.report()
+            METRICS.gauge("net.subscribers").set(len(server.subscribers))
+            METRICS.gauge("net.queued_frames").set(sum(len(sub.frames) for sub in server.subscribers))
+            METRICS.maybe_dump()
+    finally:
+        listener.close()
+        for f in feeds:
+            f.cancel()
+
+
+def serve_rings(rings, host="0.0.0.0", port=DEFAULT_PORT, maxframes=256, names=None, alarms=None):
+    """Process entry point: serve until every ring's producer has finished
+
+    `alarms` are alarm rule specs added to or replacing the defaults, as for parse_rules.
+    """
+    configure_process("netstream")
+    try:
+        asyncio.run(serve(rings, host, port, maxframes, names, alarms=alarms))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        METRICS.dump()
+
+
+class StreamClient(object):
+    """Subscribe to a StreamServer over TCP and iterate over decoded frames"""
+
+    def __init__(self, host, port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.hello = None
+
+    async def connect(self, channels=None, decimate=1, tidal=True):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        request = {"decimate": decimate, "tidal": tidal}
+        if channels is not None:
+            request["channels"] = list(channels)
+        self.writer.write(encode_json(FRAME_SUBSCRIBE, request))
+        await self.writer.drain()
+        ftype, self.hello = await self.receive()
+        return self.hello
+
+    async def query_trend(self, channel=0, t0=None, t1=None, resolution=None, max_points=1000):
+        """Ask for a channel's trend; the answer arrives as a FRAME_TREND among the other frames"""
+        self.writer.write(encode_json(FRAME_TREND_QUERY, {"channel": channel, "t0": t0, "t1": t1,
+                                                          "resolution": resolution, "max_points": max_points}))
+        await self.writer.drain()
+
+    async def receive(self):
+        length, ftype = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))
+        return ftype, decode_payload(ftype, await self.reader.readexactly(length - 1))
+
+    async def frames(self):
+        try:
+            while True:
+                yield await self.receive()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def watch(address, channels=None, decimate=1):
+    """Print a line per second of sample rates per channel, and each breath, from one server"""
+    host, _, port = address.partition(":")
+    client = StreamClient(host or "localhost", int(port or DEFAULT_PORT))
+    hello = await client.connect(channels, decimate)
+    names = dict((c["channel"], c["name"]) for c in hello["channels"])
+    print("{}: {} channels".format(address, len(names)))
+    counts = {}
+    t_report = time.time()
+    async for ftype, body in client.frames():
+        if ftype == FRAME_WAVEFORM:
+            counts[body[0]] = counts.get(body[0], 0) + body[2].size
+        elif ftype == FRAME_TIDAL:
+            c, t, tidal = body
+            print("{} {:>8}  VTi:{:>4.0f} VTe:{:>4.0f} RR:{:4.1f} MVe:{:5.1f} PPk:{:5.1f} PEEP:{:5.1f}".format(
+                address, names.get(c, c), *tidal))
+        elif ftype == FRAME_STATUS:
+            if "dropped" in body:
+                print("{} dropped {} frames".format(address, body["dropped"]))
+            if "error" in body:
+                print("{} error: {}".format(address, body["error"]))
+        elif ftype == FRAME_ALARM:
+            print("{} {:>8}  {}".format(address, names.get(body["channel"], body["channel"]),
+                                        format_event(AlarmEvent(*[body[f] for f in AlarmEvent._fields]))))
+        now = time.time()
+        if now - t_report >= 5.0:
+            print("{} {}".format(address, "  ".join("{}: {:.1f}/s".format(names.get(c, c), n / (now - t_report))
+                                                    for c, n in sorted(counts.items()))))
+            counts = {}
+            t_report = now
+    client.close()
+
+
+async def loopback_check(maxframes=8, decimate=5):
+    """Serve two channels on a local port and check what one StreamClient receives
+
+    The client subscribes to channel 1 only, at `decimate`. First one batch per
+    channel checks the channel filter and decimation by sample number; then
+    many batches are published without yielding, so all but the newest
+    `maxframes` must be dropped and reported in a STATUS frame. Last, while
+    the client does not read and large batches back up the connection, trend
+    queries, valid and not, are sent and the frame queue is overflowed again;
+    each query must still be answered, in order.
+    :return: A list of failures, empty if all is well
+    """
+    server = StreamServer([{"channel": 0, "name": "ch0"}, {"channel": 1, "name": "ch1"}], maxframes)
+    listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    client = StreamClient("127.0.0.1", listener.sockets[0].getsockname()[1])
+    failures = []
+
+    def batch(start, size=100):
+        records = np.zeros(size, dtype=INTEGRATED_DTYPE)
+        records["n"] = np.arange(start, start + size)
+        records["t"] = records["n"] / 50.0
+        return records
+
+    async def expect(ftype):
+        got, body = await asyncio.wait_for(client.receive(), 5.0)
+        if got != ftype:
+            raise AssertionError("expected frame type {}, got {} {}".format(ftype, got, body))
+        return body
+
+    try:
+        await client.connect(channels=[1], decimate=decimate)
+        while not any(sub.subscribed for sub in server.subscribers):
+            await asyncio.sleep(0.01)
+        # Invalid requests are answered with errors and leave the subscription as it was
+        for request in ([1], {"channels": ["a"]}, {"decimate": 0}):
+            client.writer.write(encode_json(FRAME_SUBSCRIBE, request))
+        client.writer.write(encode_frame(FRAME_SUBSCRIBE, b"\xff"))
+        for i in range(4):
+            if "error" not in await expect(FRAME_STATUS):
+                failures.append("an invalid SUBSCRIBE was not answered with an error")
+        server.publish_waveform(0, batch(0))
+        server.publish_waveform(1, batch(0))
+        channel, k, records = await expect(FRAME_WAVEFORM)
+        if channel != 1 or k != decimate:
+            failures.append("waveform frame for channel {} at decimation {}".format(channel, k))
+        if not np.array_equal(np.round(records["t"] * 50.0), np.arange(0, 100, decimate)):
+            failures.append("decimated samples are not every {}th: {}".format(decimate, records["t"] * 50.0))
+
+        burst = maxframes * 3
+        for i in range(burst):
+            server.publish_waveform(1, batch(100 * (i + 1)))
+        server.report()
+        received = []
+        for i in range(maxframes - 1):
+            received.append((await expect(FRAME_WAVEFORM))[2])
+        status = await expect(FRAME_STATUS)
+        # Queueing the STATUS frame itself drops one more, which the next report counts
+        if status.get("dropped") != burst - maxframes:
+            failures.append("STATUS reported {} dropped, expected {}".format(status, burst - maxframes))
+        first = int(round(received[0]["t"][0] * 50.0))
+        if first != 100 * (burst - maxframes + 2):
+            failures.append("oldest frames were not the ones dropped: first kept sample {}".format(first))
+
+        for i in range(10):
+            server.trends[1].add(4.0 * i, TidalData(500.0, 490.0, 15.0, 7.4, 25.0, 5.0))
+        queries = [{"channel": 1, "t0": 0.0, "resolution": 0}, {"channel": 1, "resolution": 7},
+                   {"channel": 1, "t0": 0.0, "max_points": None}, {"channel": 3}, {"channel": 1, "t0": "yesterday"}]
+        for query in queries:
+            client.writer.write(encode_json(FRAME_TREND_QUERY, query))
+        client.writer.write(encode_frame(FRAME_TREND_QUERY, b"{"))
+        # Stop reading, and send more than the socket buffers hold, so the server is stuck waiting to drain
+        client.writer.transport.pause_reading()
+        for i in range(maxframes):
+            server.publish_waveform(1, batch(0, 400000))
+        await asyncio.sleep(0.2)
+        await client.writer.drain()
+        await asyncio.sleep(0.2)
+        for i in range(burst):
+            server.publish_waveform(1, batch(0))
+        client.writer.transport.resume_reading()
+        answers = []
+        while len(answers) < len(queries) + 1:
+            try:
+                ftype, body = await asyncio.wait_for(client.receive(), 5.0)
+            except asyncio.TimeoutError:
+                break
+            if ftype == FRAME_TREND:
+                answers.append(body[2].size)
+            elif ftype == FRAME_STATUS and "error" in body:
+                answers.append(None)
+        if answers != [10, None, 10, None, None, None]:
+            failures.append("trend answers {}, expected 10 breaths or an error for each query in turn".format(answers))
+    except (AssertionError, asyncio.TimeoutError, asyncio.IncompleteReadError) as ex:
+        failures.append(str(ex) or type(ex).__name__)
+    finally:
+        client.close()
+        listener.close()
+        await listener.wait_closed()
+    return failures
+
+
+async def websocket_check():
+    """Check a fragmented WebSocket SUBSCRIBE with a ping between its fragments, then that an unmasked frame
+    is refused with close code 1002
+
+    :return: A list of failures, empty if all is well
+    """
+    server = StreamServer([{"channel": 0, "name": "ch0"}, {"channel": 1, "name": "ch1"}])
+    listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    reader, writer = await asyncio.open_connection("127.0.0.1", listener.sockets[0].getsockname()[1])
+    failures = []
+
+    def client_frame(b0, payload, masked=True):
+        mask = b"\x01\x02\x03\x04"
+        body = bytes(b ^ mask[i % 4] for i, b in enumerate(payload)) if masked else payload
+        return struct.pack(">BB", b0, (0x80 if masked else 0) | len(payload)) + (mask if masked else b"") + body
+
+    async def server_message():
+        b0, b1 = await asyncio.wait_for(reader.readexactly(2), 5.0)
+        n = b1 & 0x7F
+        if n == 126:
+            n = struct.unpack(">H", await reader.readexactly(2))[0]
+        elif n == 127:
+            n = struct.unpack(">Q", await reader.readexactly(8))[0]
+        return b0 & 0x0F, await reader.readexactly(n)
+
+    try:
+        writer.write(b"GET / HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+        response = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+        if not response.startswith(b"HTTP/1.1 101"):
+            failures.append("upgrade refused: {!r}".format(response))
+        request = json.dumps({"channels": [0]}).encode("utf-8")
+        writer.write(client_frame(0x01, request[:5]) + client_frame(0x89, b"hi") + client_frame(0x80, request[5:]))
+        opcode, payload = await server_message()
+        if opcode != 0x2 or payload[0] != FRAME_HELLO:
+            failures.append("expected the HELLO first, got opcode {}".format(opcode))
+        opcode, payload = await server_message()
+        if (opcode, payload) != (0xA, b"hi"):
+            failures.append("ping between fragments answered with {} {!r}".format(opcode, payload))
+        await asyncio.sleep(0.1)
+        if [sub.channels for sub in server.subscribers] != [{0}]:
+            failures.append("fragmented SUBSCRIBE gave {}".format([sub.channels for sub in server.subscribers]))
+        writer.write(client_frame(0x81, request, masked=False))
+        opcode, payload = await server_message()
+        if opcode != 0x8 or struct.unpack(">H", payload)[0] != WS_PROTOCOL_ERROR:
+            failures.append("unmasked frame answered with opcode {} {!r}, not a 1002 close".format(opcode, payload))
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError) as ex:
+        failures.append("WebSocket: " + (str(ex) or type(ex).__name__))
+    finally:
+        writer.close()
+        listener.close()
+        await listener.wait_closed()
+    return failures
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Serve splitvent waveforms and breaths over the network, or watch servers.')
+
+    parser.add_argument("--connect", dest='connect', action='append', default=None, metavar="HOST:PORT",
+                        help='Watch a server instead of serving; repeat to watch several units')
+
+    parser.add_argument("--subscribe", dest='subscribe', default=None, metavar="CHANNELS",
+                        help='Comma-separated channels to watch (default: all)')
+
+    parser.add_argument("--decimate", dest='decimate', type=int, default=1,
+                        help='Receive every Nth sample')
+
+    parser.add_argument("--sim", dest='sim', action='append', default=None, metavar="SETTINGS",
+                        help='Serve simulated patients, e.g. --sim "vc,rr=20"; repeat for a mix')
+
+    parser.add_argument("--fake", dest='fake', action='store_const', const=True, default=False,
+                        help='Serve synthetic sensor data')
+
+    parser.add_argument("--channels", dest='channels', type=int, default=1,
+                        help='Number of simulated or synthetic channels')
+
+    parser.add_argument("--samplerate", dest='sample_rate', type=float, default=50.0,
+                        help='Flow measurement sampling rate')
+
+    parser.add_argument("--host", dest='host', default="0.0.0.0", help='Address to listen on')
+
+    parser.add_argument("--port", dest='port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+
+    parser.add_argument("--maxframes", dest='maxframes', type=int, default=256,
+                        help='Frames queued per client before the oldest are dropped')
+
+    parser.add_argument("--stats", dest='stats', default=None, metavar="FILE",
+                        help='Append timing and backlog statistics of every process to FILE as JSON lines')
+
+    parser.add_argument("--check", dest='check', action='store_const', const=True, default=False,
+                        help='Run a local loopback check of subscriptions, decimation and dropping, then exit')
+
+    parser.add_argument("--alarm", dest='alarms', action='append', default=None, metavar="RULE",
+                        help='Add or replace an alarm rule (see alarms.py); "name: off" removes one')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    if args.check:
+        failures = asyncio.run(loopback_check()) + asyncio.run(websocket_check())
+        for failure in failures:
+            print("FAIL: " + failure)
+        print("Loopback check {}".format("failed" if failures else "passed"))
+        return 1 if failures else 0
+    if args.connect:
+        channels = None if args.subscribe is None else [int(c) for c in args.subscribe.split(",")]
+
+        async def watch_all():
+            await asyncio.gather(*[watch(address, channels, args.decimate) for address in args.connect])
+        try:
+            asyncio.run(watch_all())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.stats:
+        metrics.enable(args.stats)
+    # Every channel is read by one acquisition process, as in multichannel.py
+    if args.sim:
+        channels = sim_channels([parse_settings(spec) for spec in args.sim], args.channels)
+    elif args.fake:
+        channels = fake_channels(args.channels)
+    else:
+        channels = hardware_channels([RASPI_DEFAULT_I2C_BUS])
+    rings = [SharedRing(int(args.sample_rate * 10)) for ch in channels]
+    finishq = mp.Queue()
+    acquisition = mp.Process(target=stream_multichannel_rings, args=(channels, args.sample_rate, rings, finishq))
+    acquisition.start()
+    try:
+        serve_rings(rings, args.host, args.port, args.maxframes, names=[ch.name for ch in channels],
+                    alarms=args.alarms)
+    finally:
+        finishq.put("Finish")
+        acquisition.join()
+        for ring in rings:
+            ring.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+import os, time, json, queue
+from collections import namedtuple
+
+import numpy as np
+
+from calculations import *
+from binlog import *
+from logwriter import segment_name
+from metrics import METRICS, configure_process
+import startup
+
+
+"""Random-access playback of recorded sessions: seek, pause, scrub and play at 0.25x-32x
+
+A session is one log or the segments of a rotated one (see logwriter.py),
+binary or JSON-lines, compressed or not. Each file gets a sparse index,
+cached beside it as FILE.idx.npz and rebuilt whenever the file's size or
+modification time changes: for a binary log the start time and first
+record of every chunk, for JSON lines the timestamp and byte offset of
+every INDEX_EVERY-th line. A seek decodes only the chunks (or reads only
+the block of lines) around the new position, so jumping anywhere in an
+eight-hour session reads a few pages. Uncompressed binary logs stay
+memory-mapped; only the compressed segment being played is held in memory.
+
+Positions are seconds since the session's meta["t0"], as in the log records.
+"""
+
+INDEX_EVERY = 4096
+INDEX_VERSION = 2
+MIN_SPEED = 0.25
+MAX_SPEED = 32.0
+
+Readings = namedtuple("Readings", ["t", "slm", "cmH2O"])
+
+_EMPTY = Readings(np.zeros(0), np.zeros(0, np.float32), np.zeros(0, np.float32))
+
+
+def segment_files(filename):
+    """The files of a session: filename, then filename's rotated segments, each possibly compressed"""
+    method = compression_of(filename)
+    base = filename[:-len(COMPRESSED_EXTENSIONS[method])] if method else filename
+    files = []
+    for i in range(1 << 20):
+        name = segment_name(base, i)
+        found = [name + ext for ext in [""] + list(COMPRESSED_EXTENSIONS.values()) if os.path.exists(name + ext)]
+        if not found:
+            break
+        files.append(found[0])
+    return files or [filename]
+
+
+class LogSegment(object):
+    """One log file with its sparse time index; read() returns the readings in a time range"""
+
+    def __init__(self, filename, every=INDEX_EVERY):
+        self.filename = filename
+        self.binary = is_binary_log(filename)
+        self.every = every
+        self.log = None
+        self.jsonfile = None
+        self.index_t, self.index_pos, self.count, self.t_end = self._load_index()
+        self.release()
+        self.t_start = float(self.index_t[0]) if self.count else 0.0
+
+    def _stat(self):
+        st = os.stat(self.filename)
+        return np.array([st.st_size, st.st_mtime_ns, self.every, INDEX_VERSION], dtype=np.int64)
+
+    def _load_index(self):
+        cache = self.filename + ".idx.npz"
+        stat = self._stat()
+        try:
+            with np.load(cache) as z:
+                if np.array_equal(z["stat"], stat):
+                    return z["t"], z["pos"], int(z["count"]), float(z["t_end"])
+        except (OSError, ValueError, KeyError, EOFError):
+            pass
+        index = self._build_index()
+        try:
+            tmp = "{}.{}.tmp.npz".format(cache[:-4], os.getpid())
+            np.savez(tmp, stat=stat, t=index[0], pos=index[1], count=index[2], t_end=index[3])
+            os.replace(tmp, cache)
+        except OSError:
+            pass  # A read-only directory only costs rebuilding the index next time
+        return index
+
+    def _build_index(self):
+        if self.binary:
+            # The chunk headers already index a binary log
+            log = self.binary_log()
+            order = np.argsort(log.chunk_t0, kind="stable")
+            return log.chunk_t0[order], np.cumsum(log.chunk_count)[order] - log.chunk_count[order], len(log), log.duration
+        t, pos = [], []
+        count = 0
+        t_end = 0.0
+        offset = 0
+        with open_log(self.filename) as f:
+            for line in f:
+                if line.strip():
+                    t_end = json.loads(line)["t"]
+                    if count % self.every == 0:
+                        t.append(t_end)
+                        pos.append(offset)
+                    count = count + 1
+                offset = offset + len(line)
+        return np.array(t, dtype=np.float64), np.array(pos, dtype=np.int64), count, t_end
+
+    def binary_log(self):
+        if self.log is None:
+            self.log = BinaryLog(self.filename)
+        return self.log
+
+    def release(self):
+        """Drop decompressed records and open files until the segment is next read"""
+        self.log = None
+        if self.jsonfile is not None:
+            self.jsonfile.close()
+            self.jsonfile = None
+
+    def read(self, t0, t1):
+        """Readings with t0 <= t < t1"""
+        if not self.count:
+            return _EMPTY
+        if self.binary:
+            span = self.binary_log().between(t0, t1)
+            return Readings(np.array(span["t"]), np.array(span["slm"]), np.array(span["cmH2O"]))
+        block = max(0, int(np.searchsorted(self.index_t, t0, side="right")) - 1)
+        if self.jsonfile is None:
+            self.jsonfile = open_log(self.filename)
+        self.jsonfile.seek(int(self.index_pos[block]))
+        rows = []
+        for line in self.jsonfile:
+            if not line.strip():
+                continue
+            js = json.loads(line)
+            if js["t"] >= t1:
+                break
+            if js["t"] >= t0:
+                rows.append((js["t"], js["slm"], js["cmH2O"]))
+        if not rows:
+            return _EMPTY
+        t, slm, cmH2O = np.array(rows).T
+        return Readings(t, slm.astype(np.float32), cmH2O.astype(np.float32))
+
+
+class Playback(object):
+    """Play a recorded session against a clock, with seeking, pausing and variable speed
+
+    :param clock: A monotonic clock in seconds
+    :param max_chunk: Most seconds of recording that one advance() returns; playback slips behind the clock beyond it
+    """
+
+    def __init__(self, filename, clock=time.monotonic, max_chunk=2.0):
+        self.segments = [LogSegment(f) for f in segment_files(filename)]
+        self.meta = BinaryLog(self.segments[0].filename).meta if self.segments[0].binary else {}
+        self.clock = clock
+        self.max_chunk = max_chunk
+        self.start = self.segments[0].t_start
+        self.end = max(s.t_end for s in self.segments)
+        self.position = self.start
+        self.speed = 1.0
+        self.paused = False
+        self.last_clock = clock()
+        self.current = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def seek(self, t):
+        """Move to recording time t, clamped to the session"""
+        self.position = min(max(t, self.start), self.end)
+        self.last_clock = self.clock()
+
+    def scrub(self, dt):
+        self.seek(self.position + dt)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.last_clock = self.clock()
+
+    def set_speed(self, speed):
+        self.speed = min(max(speed, MIN_SPEED), MAX_SPEED)
+
+    def advance_position(self):
+        now = self.clock()
+        elapsed = 0.0 if self.paused else (now - self.last_clock) * self.speed
+        self.last_clock = now
+        return min(elapsed, self.max_chunk)
+
+    def advance(self):
+        """The readings played since the last call, in order"""
+        t0 = self.position
+        t1 = min(self.end + 1e-9, t0 + self.advance_position())
+        self.position = t1
+        return self.read(t0, t1)
+
+    def read(self, t0, t1):
+        parts = []
+        for segment in self.segments:
+            if segment.t_end < t0 or segment.t_start >= t1:
+                continue
+            if segment is not self.current:
+                if self.current is not None:
+                    self.current.release()
+                self.current = segment
+            parts.append(segment.read(t0, t1))
+        if not parts:
+            return _EMPTY
+        if len(parts) == 1:
+            return parts[0]
+        return Readings(*[np.concatenate(cols) for cols in zip(*parts)])
+
+    def at_end(self):
+        return self.position >= self.end
+
+
+PlaybackCommand = namedtuple("PlaybackCommand", ["action", "value"])
+
+def apply_command(player, command):
+    """Carry out a PlaybackCommand; returns True if it moved the position"""
+    action, value = command
+    if action == "seek":
+        player.seek(value)
+    elif action == "scrub":
+        player.scrub(value)
+    elif action == "fraction":
+        player.seek(player.start + value * player.duration)
+    elif action == "speed":
+        player.set_speed(value)
+    elif action == "pause":
+        player.pause()
+    elif action == "resume":
+        player.resume()
+    return action in ("seek", "scrub", "fraction")
+
+
+def stream_playback(filename, samplerate, ring, finishq, controlq, tick=0.02):
+    """Acquisition process for playback: publish IntegratedVolumes of a recording to a SharedRing
+
+    PlaybackCommands on controlq seek, pause and change speed. After a seek the
+    volume integrator starts afresh, and the time stamps jump, so consumers see
+    a discontinuity rather than a bogus breath.
+    """
+    configure_process("acquisition")
+    startup.mark("acquisition started")
+    player = Playback(filename)
+    t0 = player.meta.get("t0", 0.0)
+    samplerate = player.meta.get("sample_rate") or samplerate
+    info = dict(player.meta, sample_rate=samplerate, source=filename, playback_start=player.start,
+                playback_end=player.end)
+    integrator = VolumeIntegrator(samplerate)
+    read_ms = METRICS.histogram("playback.read_ms")
+    n = 0
+    last_t = None
+    try:
+        while finishq.empty():
+            while True:
+                try:
+                    command = controlq.get_nowait()
+                except queue.Empty:
+                    break
+                if apply_command(player, command):
+                    integrator = VolumeIntegrator(samplerate)
+                    last_t = None
+            started = time.perf_counter()
+            readings = player.advance()
+            read_ms.observe((time.perf_counter() - started) * 1000.0)
+            if ring.write_count == 0 and readings.t.size:
+                startup.mark("first sample")
+                ring.set_meta(info)
+            for t, slm, cmH2O in zip(readings.t.tolist(), readings.slm.tolist(), readings.cmH2O.tolist()):
+                dT = (t - last_t) if last_t is not None else 1.0 / samplerate
+                last_t = t
+                r = integrator.push(TReading(n, t0 + t, dT, FlowPressureReading(slm, cmH2O)))
+                n = n + 1
+                if r is not None:
+                    ring.write_one(r)
+            METRICS.gauge("playback.position").set(player.position)
+            METRICS.maybe_dump()
+            time.sleep(tick)
+    finally:
+        ring.finish()
+        METRICS.dump()
@@ -0,0 +1,197 @@
+import os, sys, time, math, ctypes, ctypes.util, argparse
+
+import numpy as np
+
+
+"""Drift-free sample scheduling on a monotonic clock
+
+Sample k is due at t0 + k/sr on time.monotonic, so timing errors never
+accumulate and NTP adjustments of the wall clock cannot disturb the rate or
+make dT negative. Sample timestamps come from wallclock(), the monotonic
+clock offset once per process to the wall clock, so they stay comparable
+with other processes and hosts but never step.
+
+Waiting for a deadline either sleeps, sleeps until `spin` seconds before it
+and then busy-waits (more precise, at the cost of CPU), or blocks on a Linux
+timerfd armed with absolute deadlines. When a read overruns past the next
+deadline, the scheduler either skips the missed deadlines (OVERRUN_SKIP,
+keeping the sample grid) or takes them back to back until it has caught up
+(OVERRUN_CATCH_UP, keeping the sample count).
+"""
+
+OVERRUN_SKIP = "skip"
+OVERRUN_CATCH_UP = "catchup"
+OVERRUN_POLICIES = (OVERRUN_SKIP, OVERRUN_CATCH_UP)
+
+_WALL_OFFSET = time.time() - time.monotonic()
+
+
+def wallclock():
+    """Seconds since the epoch, advancing with time.monotonic; never steps backwards"""
+    return _WALL_OFFSET + time.monotonic()
+
+
+CLOCK_MONOTONIC = 1
+TFD_TIMER_ABSTIME = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+class _itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", _timespec), ("it_value", _timespec)]
+
+
+def _timespec_of(seconds):
+    sec = math.floor(seconds)
+    return _timespec(int(sec), int(round((seconds - sec) * 1e9)))
+
+
+class TimerFD(object):
+    """A periodic CLOCK_MONOTONIC timerfd: wait() blocks until the next expiry and returns how many have passed"""
+
+    def __init__(self, first, period):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "timerfd_create"):
+            raise OSError("timerfd is not available on this platform")
+        self.fd = libc.timerfd_create(CLOCK_MONOTONIC, 0)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "timerfd_create failed")
+        spec = _itimerspec(_timespec_of(period), _timespec_of(first))
+        if libc.timerfd_settime(self.fd, TFD_TIMER_ABSTIME, ctypes.byref(spec), None) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "timerfd_settime failed")
+
+    def wait(self):
+        return int.from_bytes(os.read(self.fd, 8), sys.byteorder)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SampleScheduler(object):
+    """Wait for the deadlines t0 + k/sr of a clock, counting overruns and skipped samples
+
+    :param clock: A monotonic clock in seconds; inject one (e.g. VirtualClock.clock) with `sleep` for tests
+    :param spin: Seconds before each deadline to stop sleeping and busy-wait
+    :param overrun: OVERRUN_SKIP or OVERRUN_CATCH_UP
+    :param timer: Wait on a Linux timerfd instead of sleeping; needs the real monotonic clock
+    """
+
+    def __init__(self, sr, clock=None, sleep=time.sleep, spin=0.0, overrun=OVERRUN_SKIP, timer=False):
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError("Overrun policy must be one of " + ", ".join(OVERRUN_POLICIES))
+        if timer and clock is not None:
+            raise ValueError("A timerfd runs on the system monotonic clock; it cannot be used with an injected clock")
+        self.sr = float(sr)
+        self.period = 1.0 / self.sr
+        self.clock = clock or time.monotonic
+        self.sleep = sleep
+        self.spin = spin
+        self.overrun = overrun
+        self.t0 = self.clock()
+        self.k = 0               # index of the next deadline
+        self.overruns = 0        # waits that found the following deadline already passed
+        self.skipped = 0         # deadlines dropped under OVERRUN_SKIP
+        self.pending = 0         # expiries already reported by the timerfd but not yet taken
+        self.timer = TimerFD(self.t0, self.period) if timer else None
+
+    def deadline(self, k=None):
+        return self.t0 + (self.k if k is None else k) * self.period
+
+    def wait(self):
+        """Block until the next deadline; returns the deadline it waited for"""
+        if self.timer is not None:
+            return self._wait_timer()
+        due = self.deadline()
+        now = self.clock()
+        if now >= due + self.period:
+            self.overruns = self.overruns + 1
+            if self.overrun == OVERRUN_SKIP:
+                behind = int((now - due) / self.period)
+                self.skipped = self.skipped + behind
+                self.k = self.k + behind
+                due = self.deadline()
+        elif now < due:
+            if due - now > self.spin:
+                self.sleep(due - now - self.spin)
+            if self.spin > 0:
+                while self.clock() < due:
+                    pass
+        self.k = self.k + 1
+        return due
+
+    def _wait_timer(self):
+        if self.pending:
+            self.pending = self.pending - 1
+        else:
+            expired = self.timer.wait()
+            if expired > 1:
+                self.overruns = self.overruns + 1
+                if self.overrun == OVERRUN_SKIP:
+                    self.skipped = self.skipped + expired - 1
+                    self.k = self.k + expired - 1
+                else:
+                    self.pending = expired - 1
+        due = self.deadline()
+        self.k = self.k + 1
+        return due
+
+    def rate(self):
+        """Achieved deadlines per second since the start, counting skipped ones as missed
+
+        The first deadline is t0 itself, so k deadlines span k - 1 periods.
+        """
+        elapsed = self.clock() - self.t0
+        return (self.k - 1 - self.skipped) / elapsed if elapsed > 0 and self.k > 1 else 0.0
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.close()
+            self.timer = None
+
+
+def measure(sr, seconds, **kwargs):
+    """Run a scheduler with no work per sample; returns (achieved rate, lateness in ms, interval error in ms)"""
+    sched = SampleScheduler(sr, **kwargs)
+    n = int(sr * seconds)
+    late = np.empty(n)
+    stamps = np.empty(n)
+    try:
+        for i in range(n):
+            due = sched.wait()
+            stamps[i] = time.monotonic()
+            late[i] = stamps[i] - due
+        rate = sched.rate()
+    finally:
+        sched.close()
+    return rate, late * 1000.0, (np.diff(stamps) - 1.0 / sr) * 1000.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure sample scheduling precision on this machine.')
+    parser.add_argument("--samplerate", dest='rates', type=float, action='append', default=None,
+                        help='Sampling rates to try (default 200, 1000, 2000)')
+    parser.add_argument("--duration", dest='duration', type=float, default=3.0, help='Seconds per run')
+    parser.add_argument("--spin", dest='spin', type=float, default=0.0002,
+                        help='Busy-wait margin for the spin run, in seconds')
+    args = parser.parse_args(argv)
+    configs = [("sleep", {}), ("sleep+spin", {"spin": args.spin})]
+    if sys.platform.startswith("linux"):
+        configs.append(("timerfd", {"timer": True}))
+    print("{:>6} {:<11} {:>9} {:>11} {:>11} {:>11} {:>11}".format(
+        "Hz", "wait", "rate", "late p50", "late p99", "late max", "|dT err| p99"))
+    for sr in args.rates or [200.0, 1000.0, 2000.0]:
+        for name, kwargs in configs:
+            rate, late, err = measure(sr, args.duration, **kwargs)
+            print("{:>6.0f} {:<11} {:>9.1f} {:>8.3f} ms {:>8.3f} ms {:>8.3f} ms {:>8.3f} ms".format(
+                sr, name, rate, np.percentile(late, 50), np.percentile(late, 99), late.max(),
+                np.percentile(np.abs(err), 99)))
+
+
+if __name__ == "__main__":
+    main()
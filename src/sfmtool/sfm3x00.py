@@ -2,6 +2,8 @@
 from fcntl import ioctl
 import struct, time, collections
 
+from metrics import METRICS
+
 
 """Pure-python interface for SFM3X00 mass flow sensors"""
 
@@ -22,12 +24,50 @@ SENSIRION_SFM3x00_I2C_ADDR = 0x40
 
 SfmReading = collections.namedtuple("SfmReading", ["slm"])
 
+
+def _crc8_table(polynomial=0x31):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ polynomial) if crc & 0x80 else (crc << 1)
+        table.append(crc & 0xFF)
+    return bytes(table)
+
+SENSIRION_CRC8_TABLE = _crc8_table()
+
+def sensirion_crc8(data, crc=0x00):
+    """CRC-8 as used by SFM3x00, polynomial x^8 + x^5 + x^4 + 1, initialization 0x00"""
+    for b in data:
+        crc = SENSIRION_CRC8_TABLE[crc ^ b]
+    return crc
+
+def check_crc(bytes):
+    """Validate each 2-byte word + CRC triplet in a Sensirion response and return the data bytes
+
+    For commands run once, such as reading the calibration; measurements use SFM3x00.decode_raw.
+    """
+    data = b""
+    for i in range(0, len(bytes), 3):
+        word = bytes[i:i+2]
+        if sensirion_crc8(word) != bytes[i+2]:
+            raise IOError("SFM3x00 CRC mismatch on {}: sensor or wiring fault".format(bytes.hex()))
+        data += word
+    return data
+
+
 class SFM3x00(object):
     """Read Sensirion SFM3x00 sensor readings over I2C"""
+
+    RAW_READ_LEN = 3
+    START_DELAY = 0.100  # seconds from the start command to the first valid measurement
     
     def __init__(self, bus=RASPI_DEFAULT_I2C_BUS, address=SENSIRION_SFM3x00_I2C_ADDR):
         self.address = address
+        self.bus = None
         self._device = None
+        self.last_raw = None
+        self.crc_errors = METRICS.counter("read.crc_errors")
         if bus is not None:
             self.open(bus)
         
@@ -40,9 +80,11 @@ class SFM3x00(object):
         devicename = '/dev/i2c-{0}'.format(bus)
         try:
             self._device = open(devicename, 'r+b', buffering=0)
+            self.bus = bus
             self._select_device(self.address)
             self.offset = float(self.read_offset())
             self.scale = float(self.read_scale())
+            self.last_raw = int(self.offset)
             self.serial_number = self.read_serial_number()
             print('Opened {} for device communications'.format(devicename))
         except IOError:
@@ -77,31 +119,42 @@ class SFM3x00(object):
     def start_sensor(self):
         self.write_bytes(CMD_START_FLOW)
                          
+    def decode_raw(self, bytes):
+        """Convert a RAW_READ_LEN byte measurement response to counts
+
+        A response failing its CRC is counted in read.crc_errors and the last good
+        counts are returned instead, so one corrupted byte cannot stop acquisition.
+        """
+        if sensirion_crc8(bytes[:2]) != bytes[2]:
+            self.crc_errors.inc()
+            return self.last_raw
+        self.last_raw = struct.unpack(">H", bytes[:2])[0]
+        return self.last_raw
+
     def read_value(self):
-        bytes = self.read_bytes(3)
-        return struct.unpack(">H", bytes[:2])[0]
+        return self.decode_raw(self.read_bytes(self.RAW_READ_LEN))
                          
     def read_serial_number(self):
         self.write_bytes(CMD_RD_SERNUM_1)
         bytes = self.read_bytes(6)
-        return struct.unpack(">I", bytes[0:2] + bytes[3:5])[0]
+        return struct.unpack(">I", check_crc(bytes))[0]
 
     def read_offset(self):
         self.write_bytes(CMD_RD_OFFSET)
         bytes = self.read_bytes(3)
-        return struct.unpack(">H", bytes[:2])[0]
+        return struct.unpack(">H", check_crc(bytes))[0]
                          
     def read_scale(self):
         self.write_bytes(CMD_RD_SCALE)
         bytes = self.read_bytes(3)
-        return struct.unpack(">H", bytes[:2])[0]
+        return struct.unpack(">H", check_crc(bytes))[0]
     
     def scale_value(self, value):
         return (value - self.offset) / self.scale
 
     def prepare(self):
         self.start_sensor()
-        time.sleep(0.100)
+        time.sleep(self.START_DELAY)
         self.read_value()
 
     def read_scaled(self):
@@ -0,0 +1,245 @@
+import time, json
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+
+"""Single-producer / multi-consumer ring of structured records in shared memory
+
+The producer writes records and then advances a shared write counter. Each
+consumer keeps its own read cursor and receives new records as a numpy view
+of the shared block, so nothing is pickled or copied between processes.
+Storage is mirrored (see CircularBuffer) so any span of up to `capacity`
+records is contiguous.
+
+A cursor never starts a view closer than `guard` records (about one write
+burst) to the slot the producer writes next, so the producer can write that
+many more before a view read just now is touched. A consumer that fell
+further behind skips the oldest records, counted as overruns, and is given a
+copy, checked after copying so records overwritten meanwhile are dropped
+too. Consumers keeping a zero-copy view longer can ask lapped() afterwards.
+
+The write counter is published with a store after the record stores. Python
+has no portable memory fence: x86 keeps stores in order, so a consumer that
+sees the count sees the records, but weakly ordered CPUs do not promise it.
+"""
+
+INTEGRATED_DTYPE = np.dtype([
+    ("n", np.int64),
+    ("t", np.float64),
+    ("dT", np.float64),
+    ("slm", np.float64),
+    ("cmH2O", np.float64),
+    ("dV", np.float64),
+    ("V", np.float64),
+])
+
+HEADER_WORDS = 8
+HDR_WRITE_COUNT = 0
+HDR_CAPACITY = 1
+HDR_CLOSED = 2
+HDR_META_LEN = 3
+
+META_BYTES = 4096
+
+
+class SharedRing(object):
+    """Ring buffer of `dtype` records in a multiprocessing.shared_memory block
+
+    Create it in the parent; pass it to child processes as an argument and it
+    re-attaches by name there.
+    :param guard: Records kept between a consumer's view and the producer; default min(64, capacity / 4)
+    """
+
+    def __init__(self, capacity, dtype=INTEGRATED_DTYPE, name=None, guard=None):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.guard = max(1, min(64, capacity // 4)) if guard is None else guard
+        nbytes = HEADER_WORDS * 8 + META_BYTES + 2 * capacity * self.dtype.itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+        else:
+            self.shm = _attach(name)
+            self.owner = False
+        self.name = self.shm.name
+        self.header = np.ndarray(HEADER_WORDS, dtype=np.int64, buffer=self.shm.buf)
+        self.metabuf = np.ndarray(META_BYTES, dtype=np.uint8, buffer=self.shm.buf, offset=HEADER_WORDS * 8)
+        self.store = np.ndarray(2 * capacity, dtype=self.dtype, buffer=self.shm.buf, offset=HEADER_WORDS * 8 + META_BYTES)
+        if self.owner:
+            self.header[:] = 0
+            self.header[HDR_CAPACITY] = capacity
+
+    def __reduce__(self):
+        return (SharedRing, (self.capacity, self.dtype, self.name, self.guard))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.header = None
+        self.metabuf = None
+        self.store = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A consumer still holds a view; the mapping goes away with the process
+            pass
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+    @property
+    def write_count(self):
+        return int(self.header[HDR_WRITE_COUNT])
+
+    @property
+    def closed(self):
+        return bool(self.header[HDR_CLOSED])
+
+    def write(self, records):
+        """Producer only: append an array of records, then publish them"""
+        records = np.asarray(records, dtype=self.dtype)
+        w = self.write_count
+        total = records.size
+        k = min(total, self.capacity)
+        records = records[total - k:]
+        start = (w + total - k) % self.capacity
+        first = min(k, self.capacity - start)
+        rest = k - first
+        self.store[start:start + first] = records[:first]
+        self.store[start + self.capacity:start + self.capacity + first] = records[:first]
+        self.store[:rest] = records[first:]
+        self.store[self.capacity:self.capacity + rest] = records[first:]
+        self.header[HDR_WRITE_COUNT] = w + total
+
+    def write_one(self, record):
+        """Producer only: append a single record given as a tuple"""
+        w = self.write_count
+        idx = w % self.capacity
+        self.store[idx] = record
+        self.store[idx + self.capacity] = record
+        self.header[HDR_WRITE_COUNT] = w + 1
+
+    def set_meta(self, meta):
+        """Producer only: publish a JSON-serializable dict describing the stream (sensors, rates)"""
+        body = np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)
+        if body.size > META_BYTES:
+            raise ValueError("Ring metadata does not fit in {} bytes".format(META_BYTES))
+        self.metabuf[:body.size] = body
+        self.header[HDR_META_LEN] = body.size
+
+    def meta(self):
+        """The dict most recently published with set_meta, or {}"""
+        length = int(self.header[HDR_META_LEN])
+        return json.loads(self.metabuf[:length].tobytes().decode("utf-8")) if length else {}
+
+    def finish(self):
+        """Producer only: tell consumers no more records will arrive"""
+        self.header[HDR_CLOSED] = 1
+
+    def cursor(self, from_start=False):
+        return RingCursor(self, from_start)
+
+
+class RingCursor(object):
+    """A consumer's read position in a SharedRing
+
+    `overruns` counts records the producer overwrote, or was about to, before this
+    consumer read them. Views returned by read() alias shared storage unless the
+    consumer had fallen behind: use or copy them before the producer writes
+    `guard` more records, or check lapped() after using them.
+    """
+
+    def __init__(self, ring, from_start=False):
+        self.ring = ring
+        self.pos = max(0, ring.write_count - (ring.capacity - ring.guard)) if from_start else ring.write_count
+        self.view_start = self.pos
+        self.overruns = 0
+
+    def backlog(self):
+        return self.ring.write_count - self.pos
+
+    def read(self):
+        """Return a view of all records written since the last read (possibly empty)"""
+        w = self.ring.write_count
+        limit = self.ring.capacity - self.ring.guard
+        behind = w - self.pos > limit
+        if behind:
+            self.overruns = self.overruns + (w - self.pos - limit)
+            self.pos = w - limit
+        start = self.pos % self.ring.capacity
+        view = self.ring.store[start:start + (w - self.pos)]
+        self.view_start = self.pos
+        self.pos = w
+        if behind:
+            # The producer is close behind the oldest of these: copy, then drop any it reached meanwhile
+            view = view.copy()
+            lost = min(self.lapped(), view.size)
+            if lost:
+                self.overruns = self.overruns + lost
+                self.view_start = self.view_start + lost
+                view = view[lost:]
+        return view
+
+    def lapped(self):
+        """How many records at the start of the last view the producer may have overwritten since it was read"""
+        return max(0, self.ring.write_count + self.ring.guard - (self.view_start + self.ring.capacity))
+
+    def wait(self, timeout=3.0, poll=0.002, sleep=time.sleep, clock=time.monotonic):
+        """Block until new records arrive, and return them. Returns None on
+        timeout, or once the producer has finished and everything is read."""
+        deadline = clock() + timeout
+        while True:
+            view = self.read()
+            if view.size:
+                return view
+            if self.ring.closed or clock() > deadline:
+                return None
+            sleep(poll)
+
+
+def receive_ring(cursor, timeout=3.0, idle=None):
+    """Receive batches of records from a RingCursor, like receive_readings does for a Queue
+
+    With `idle`, an empty batch is yielded after each `idle` seconds without
+    records instead of giving up, for producers that may pause (playback).
+    """
+    while True:
+        view = cursor.wait(timeout if idle is None else idle)
+        if view is None:
+            if cursor.ring.closed:
+                return
+            if idle is not None:
+                yield cursor.ring.store[:0]
+                continue
+            print("ERROR: Failed to get readings from background process.")
+            return
+        yield view
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before Python 3.13 attaching registers the block for cleanup by the resource
+    # tracker, which child processes share with the creator. Unregistering afterwards
+    # would remove the creator's registration too, so the registration is skipped.
+    register = resource_tracker.register
+
+    def register_others(rname, rtype):
+        if rtype != "shared_memory":
+            register(rname, rtype)
+
+    resource_tracker.register = register_others
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
@@ -0,0 +1,123 @@
+import os, sys, time, json, argparse
+import multiprocessing as mp
+from multiprocessing import forkserver
+
+import numpy as np
+
+
+"""Fast startup: cached filter designs, preloaded worker processes and a startup profile
+
+Filter coefficients are designed once and kept as .npy files under
+SPLITVENT_CACHE (~/.cache/splitvent by default), keyed by design name and
+parameters, so a restart loads them instead of importing scipy.signal.
+
+worker_context() returns a multiprocessing context whose workers fork from a
+forkserver that has already imported the acquisition and analysis modules,
+so each worker starts in milliseconds instead of re-importing numpy and the
+pipeline. The GUI process alone imports pygame.
+
+With SPLITVENT_STARTUP_PROFILE naming a file, mark() appends one JSON line
+per startup milestone of any process, timed from the launch of the first
+process. `python startup.py FILE` prints the timeline again.
+"""
+
+CACHE_ENV = "SPLITVENT_CACHE"
+PROFILE_ENV = "SPLITVENT_STARTUP_PROFILE"
+T0_ENV = "SPLITVENT_STARTUP_T0"
+
+# Modules every worker needs; scipy, biopeaks and pygame are deliberately absent
+WORKER_PRELOAD = ["numpy", "metrics", "scheduler", "shmring", "binlog", "calculations", "multirate",
+                  "sfm3x00", "HoneywellSSC", "VirtualSensor", "lungsim", "i2crdwr", "aiosensors",
+                  "alarms", "netstream"]
+
+
+def cache_dir():
+    return os.environ.get(CACHE_ENV) or os.path.join(os.path.expanduser("~"), ".cache", "splitvent")
+
+
+_filters = {}
+
+def cached_filter(name, design, *params):
+    """Coefficients from design(*params), cached in memory and on disk under `name` and the parameters"""
+    key = "-".join([name] + [str(p) for p in params])
+    if key in _filters:
+        return _filters[key]
+    path = os.path.join(cache_dir(), key + ".npy")
+    try:
+        taps = np.load(path)
+    except (OSError, ValueError, EOFError):
+        taps = np.asarray(design(*params))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp, "wb") as f:
+                np.save(f, taps)
+            os.replace(tmp, path)
+        except OSError:
+            pass  # A read-only cache only costs the design time
+    _filters[key] = taps
+    return taps
+
+
+def worker_context(method="forkserver"):
+    """A multiprocessing context for pipeline workers, preloading WORKER_PRELOAD into the forkserver"""
+    if method not in mp.get_all_start_methods():
+        return mp.get_context()
+    ctx = mp.get_context(method)
+    if method == "forkserver":
+        ctx.set_forkserver_preload(WORKER_PRELOAD)
+        # Start the server now, so it imports in parallel with whatever the caller does next
+        forkserver.ensure_running()
+    return ctx
+
+
+def process_start_time():
+    """Wall-clock time this process was created, from /proc where available, else now"""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may hold spaces, so count fields from its closing parenthesis
+            starttime = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            btime = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return btime + starttime / float(os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+def begin(filename):
+    """Start a startup profile in FILENAME, timed from the launch of this process; children inherit it"""
+    open(filename, "w").close()
+    os.environ[PROFILE_ENV] = filename
+    os.environ[T0_ENV] = repr(process_start_time())
+
+
+def mark(label):
+    """Record that this process reached a startup milestone"""
+    filename = os.environ.get(PROFILE_ENV)
+    if not filename:
+        return
+    line = json.dumps({"t": time.time() - float(os.environ[T0_ENV]), "pid": os.getpid(),
+                       "process": mp.current_process().name, "mark": label})
+    with open(filename, "a") as f:
+        f.write(line + "\n")
+
+
+def report(filename=None, out=sys.stdout):
+    filename = filename or os.environ.get(PROFILE_ENV)
+    if not filename:
+        return
+    with open(filename) as f:
+        marks = sorted((json.loads(line) for line in f if line.strip()), key=lambda m: m["t"])
+    print("Startup profile, seconds from launch:", file=out)
+    for m in marks:
+        print("  {:>7.3f}  {:<12} {}".format(m["t"], m["process"], m["mark"]), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print a startup profile written with --startup-profile.')
+    parser.add_argument("filename")
+    report(parser.parse_args(argv).filename)
+
+
+if __name__ == "__main__":
+    main()
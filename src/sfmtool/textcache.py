@@ -0,0 +1,98 @@
+from collections import OrderedDict
+
+import pygame
+
+
+"""Caches of rendered text, so fonts are rasterized once rather than every frame
+
+SurfaceCache is a bounded LRU of whole rendered strings. GlyphAtlas holds one
+surface per character of a font, and composes numeric readouts by blitting
+cached glyphs side by side.
+"""
+
+
+class SurfaceCache(object):
+    """Bounded LRU cache of rendered text surfaces keyed by (font, text, antialias, color, background)"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def render(self, font, text, antialias, color, background=None):
+        key = (font, text, antialias, color, background)
+        surf = self.surfaces.get(key)
+        if surf is not None:
+            self.hits = self.hits + 1
+            self.surfaces.move_to_end(key)
+            return surf
+        self.misses = self.misses + 1
+        surf = font.render(text, antialias, color, background)
+        self.surfaces[key] = surf
+        if len(self.surfaces) > self.maxsize:
+            self.surfaces.popitem(last=False)
+            self.evictions = self.evictions + 1
+        return surf
+
+    def clear(self):
+        self.surfaces.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.surfaces), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / float(lookups) if lookups else 0.0}
+
+
+class GlyphAtlas(object):
+    """Pre-rendered characters of one font and color, composed into strings by blitting
+
+    Characters outside `chars` are rendered through `fallback`, a SurfaceCache.
+    Glyphs are placed at their advance widths, which for the tabular digits
+    of most fonts matches rendering the string whole.
+    """
+
+    def __init__(self, font, color, background=None, antialias=True, chars="0123456789.-+ ", fallback=None):
+        self.font = font
+        self.color = color
+        self.background = background
+        self.antialias = antialias
+        self.fallback = fallback if fallback is not None else SurfaceCache(64)
+        self.glyphs = {}
+        for c in chars:
+            self.glyphs[c] = font.render(c, antialias, color, background)
+        self.height = font.get_height()
+        self.hits = 0
+        self.misses = 0
+
+    def glyph(self, c):
+        surf = self.glyphs.get(c)
+        if surf is not None:
+            self.hits = self.hits + 1
+            return surf
+        self.misses = self.misses + 1
+        return self.fallback.render(self.font, c, self.antialias, self.color, self.background)
+
+    def size(self, text):
+        return sum(self.glyph(c).get_width() for c in text), self.height
+
+    def blit(self, surf, text, **anchor):
+        """Blit text onto surf, positioned like Rect keyword arguments, e.g. center=(x, y); returns its rect"""
+        glyphs = [self.glyph(c) for c in text]
+        rect = pygame.Rect(0, 0, sum(g.get_width() for g in glyphs), self.height)
+        for name, value in anchor.items():
+            setattr(rect, name, value)
+        x = rect.left
+        for g in glyphs:
+            surf.blit(g, (x, rect.top))
+            x = x + g.get_width()
+        return rect
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"glyphs": len(self.glyphs), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / float(lookups) if lookups else 0.0}
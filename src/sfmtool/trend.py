@@ -0,0 +1,161 @@
+import numpy as np
+
+from calculations import CircularBuffer, TidalData
+
+
+"""Long-term trends of breath values in fixed memory
+
+A TrendStore keeps the min, mean and max of every TidalData field at
+cascading resolutions: each breath, then 10 s, 1 min and 15 min buckets.
+Every level is a preallocated CircularBuffer of TREND_DTYPE records, so
+memory is fixed when the store is created and stays so over multi-day runs;
+with the default TREND_LEVELS it is about 4 MB and reaches back roughly
+3 hours per breath, a day at 10 s, a week at 1 min and a month at 15 min.
+
+Buckets are aligned to multiples of their width, so every coarse bucket
+covers exactly a whole number of finer ones. The open bucket of every level
+is updated as each breath arrives, in one vectorized step over all levels,
+and is appended to its ring once a breath falls in a later bucket. Buckets
+without breaths are not stored; a gap in `t` is a gap in the trend.
+
+query() picks the finest level that still holds the requested range within
+a point budget and returns it with binary searches on `t`, for a trend view
+or for sending over the network. Times only run forward: a breath earlier
+than the last one, as after a playback seek, starts the history afresh.
+"""
+
+TREND_FIELDS = list(TidalData._fields)
+TREND_STATS = ["min", "mean", "max"]
+
+# t is the breath time, or the start of the bucket; n is the number of breaths in it
+TREND_DTYPE = np.dtype([("t", "<f8"), ("n", "<u4")] +
+                       [("{}_{}".format(field, stat), "<f4") for field in TREND_FIELDS for stat in TREND_STATS])
+
+# The same layout with the statistics as one array, for filling a record in one assignment
+_PACKED_DTYPE = np.dtype([("t", "<f8"), ("n", "<u4"), ("stats", "<f4", (len(TREND_FIELDS), len(TREND_STATS)))])
+assert _PACKED_DTYPE.itemsize == TREND_DTYPE.itemsize
+
+# (bucket width in seconds, buckets kept); width 0 keeps every breath
+TREND_LEVELS = [(0, 4096), (10, 8640), (60, 10080), (900, 2880)]
+
+
+class TrendStore(object):
+    """Min/mean/max trends of TidalData at several resolutions, in preallocated rings
+
+    :param levels: (width in seconds, capacity) pairs, finest first; a width of 0 keeps each breath
+    """
+
+    def __init__(self, levels=TREND_LEVELS):
+        self.levels = list(levels)
+        self.resolutions = [width for width, capacity in self.levels]
+        self.rings = [CircularBuffer(capacity, TREND_DTYPE) for width, capacity in self.levels]
+        self.breaths = self.resolutions[0] == 0
+        widths = self.resolutions[1:] if self.breaths else self.resolutions
+        self.widths = np.array(widths, dtype=np.float64)
+        # The open bucket of each aggregated level, one row per level
+        self.bucket = np.full(len(widths), -1, dtype=np.int64)
+        self.n = np.zeros(len(widths), dtype=np.int64)
+        self.lo = np.zeros((len(widths), len(TREND_FIELDS)))
+        self.hi = np.zeros((len(widths), len(TREND_FIELDS)))
+        self.total = np.zeros((len(widths), len(TREND_FIELDS)))
+        self.last_t = None
+
+    @property
+    def nbytes(self):
+        return sum(ring.store.nbytes for ring in self.rings) + self.lo.nbytes * 3
+
+    def clear(self):
+        for ring in self.rings:
+            ring.idx = 0
+            ring.count = 0
+            ring.full = False
+        self.bucket[:] = -1
+        self.n[:] = 0
+        self.last_t = None
+
+    def add(self, t, tidal):
+        """Add the TidalData of the breath ending at t, in seconds"""
+        if self.last_t is not None and t < self.last_t:
+            self.clear()
+        self.last_t = t
+        values = np.array(tidal, dtype=np.float64)
+        if self.breaths:
+            self.rings[0].append(self._record(t, 1, values, values, values))
+        bucket = np.floor(t / self.widths).astype(np.int64)
+        closed = bucket != self.bucket
+        for i in np.flatnonzero(closed & (self.n > 0)).tolist():
+            self._close(i)
+        self.bucket[closed] = bucket[closed]
+        self.n[closed] = 0
+        self.lo[closed] = values
+        self.hi[closed] = values
+        self.total[closed] = 0.0
+        np.minimum(self.lo, values, out=self.lo)
+        np.maximum(self.hi, values, out=self.hi)
+        self.total += values
+        self.n += 1
+
+    def _record(self, t, n, lo, mean, hi):
+        record = np.zeros(1, dtype=_PACKED_DTYPE)
+        record["t"] = t
+        record["n"] = n
+        record["stats"][0] = np.column_stack((lo, mean, hi))
+        return record.view(TREND_DTYPE)[0]
+
+    def _open_record(self, i):
+        return self._record(self.bucket[i] * self.widths[i], self.n[i], self.lo[i], self.total[i] / self.n[i],
+                            self.hi[i])
+
+    def _close(self, i):
+        self.rings[i + self.breaths].append(self._open_record(i))
+
+    def oldest(self):
+        """Time of the oldest record held on any level, counting the open buckets, or None if empty"""
+        times = [float(ring.last(min(ring.count, ring.n))["t"][0]) for ring in self.rings if ring.count]
+        times.extend((self.bucket[self.n > 0] * self.widths[self.n > 0]).tolist())
+        return min(times) if times else None
+
+    def level_for(self, t0, t1, max_points):
+        """Index of the finest level holding records back to t0 in at most max_points records up to t1"""
+        for level, (width, ring) in enumerate(zip(self.resolutions, self.rings)):
+            held = ring.last(min(ring.count, ring.n))["t"]
+            if ring.full and held.size and held[0] > t0:
+                continue
+            if width:
+                count = (t1 - t0) / width
+            else:
+                count = np.searchsorted(held, t1) - np.searchsorted(held, t0)
+            if count <= max_points:
+                return level
+        return len(self.rings) - 1
+
+    def query(self, t0=None, t1=None, resolution=None, max_points=1000):
+        """Records in [t0, t1), oldest first, as a new array
+
+        A bucket is included if any part of it falls in the range, and the
+        open bucket of an aggregated level is included as it stands.
+        :param resolution: A bucket width from the levels; by default the finest that fits max_points
+        :return: (resolution, records)
+        """
+        if self.last_t is None:
+            return (resolution or 0), np.zeros(0, dtype=TREND_DTYPE)
+        t1 = self.last_t + 1.0 if t1 is None else t1
+        if t0 is None:
+            t0 = self.oldest()
+        if resolution is None:
+            level = self.level_for(t0, t1, max_points)
+        else:
+            level = self.resolutions.index(resolution)
+        width = self.resolutions[level]
+        ring = self.rings[level]
+        held = ring.last(min(ring.count, ring.n))
+        ts = held["t"]
+        start = np.searchsorted(ts, t0 - width, side="right" if width else "left")
+        stop = np.searchsorted(ts, t1, side="left")
+        records = held[start:stop]
+        if width:
+            i = level - self.breaths
+            open_t = self.bucket[i] * width
+            if self.n[i] > 0 and open_t < t1 and open_t + width > t0:
+                records = np.concatenate((records, [self._open_record(i)]))
+        return width, np.array(records)